@@ -0,0 +1,472 @@
+#####################################################################
+# Benchmarks for the 4DEnVar analysis using toy observation models #
+#####################################################################
+# core python modules:
+import sys
+import json
+import time
+import platform
+# 3rd party modules:
+import numpy as np
+import scipy.optimize as spop
+# local modules:
+import fourdenvar
+import emulator
+import obs_error
+import experiment_setup as es
+
+
+class LinearToy:
+    """
+    Linear toy model, H(x) = H x, standing in for JULES so that the 4DEnVar analysis can be run without model output.
+    The exact posterior of the linear Gaussian problem is known, which allows the analysis error to be measured
+    :param n_param: number of parameters (int)
+    :param n_obs: number of observations (int)
+    :param seed_val: seed value used to create the toy problem (int)
+    :param prior_err: relative error on prior parameter estimates (float)
+    :param ob_err: relative error on observations (float)
+    """
+    def __init__(self, n_param=7, n_obs=100, seed_val=0, prior_err=es.prior_err, ob_err=0.05):
+        rng = np.random.default_rng(seed_val)
+        self.x_true = rng.uniform(0.5, 2.0, n_param)
+        self.h_mat = rng.standard_normal((n_obs, n_param)) / np.sqrt(n_param)
+        self.xb = self.x_true * (1 + prior_err * np.clip(rng.standard_normal(n_param), -2., 2.))
+        self.xb_sd = self.xb * prior_err
+        y_true = self.hx(self.x_true)
+        self.yerr = np.ones(n_obs) * ob_err * np.mean(np.abs(y_true))
+        self.yobs = y_true + self.yerr * rng.standard_normal(n_obs)
+        # bounds are wide enough not to truncate the prior so the exact posterior is Gaussian
+        self.p_dict = {'toy_params': {'jules_toyparm': {
+            'p' + str(i): [0, self.xb[i], (self.xb[i] - 10 * self.xb_sd[i], self.xb[i] + 10 * self.xb_sd[i])]
+            for i in range(n_param)}}}
+        self.obs_dic = {'obs': (self.yobs,), 'obs_err': (self.yerr,)}
+
+    def hx(self, x):
+        """
+        Toy observation operator
+        :param x: parameter vector or ensemble of parameter vectors, one per row (arr)
+        :return: modelled observations (arr)
+        """
+        return np.dot(x, self.h_mat.T)
+
+    def posterior(self):
+        """
+        Calculates the exact posterior mean and standard deviation of the linear Gaussian problem, which the analysis is
+        measured against
+        :return: posterior parameter vector and posterior standard deviations (tuple)
+        """
+        r_inv = 1. / self.yerr**2
+        pa = np.linalg.inv(np.diag(1. / self.xb_sd**2) + np.dot(self.h_mat.T * r_inv, self.h_mat))
+        xa = self.xb + np.dot(pa, np.dot(self.h_mat.T * r_inv, self.yobs - self.hx(self.xb)))
+        return xa, np.sqrt(np.diag(pa))
+
+
+class NonlinearToy(LinearToy):
+    """
+    Nonlinear toy model, H(x) = H x + a (H x)^2, used to benchmark the 4DEnVar analysis when the ensemble perturbations
+    only approximate the observation operator
+    :param n_param: number of parameters (int)
+    :param n_obs: number of observations (int)
+    :param seed_val: seed value used to create the toy problem (int)
+    :param prior_err: relative error on prior parameter estimates (float)
+    :param ob_err: relative error on observations (float)
+    :param nonlin: strength of quadratic term (float)
+    """
+    def __init__(self, n_param=7, n_obs=100, seed_val=0, prior_err=es.prior_err, ob_err=0.05, nonlin=0.5):
+        self.nonlin = nonlin
+        LinearToy.__init__(self, n_param, n_obs, seed_val, prior_err, ob_err)
+
+    def hx(self, x):
+        """
+        Toy observation operator
+        :param x: parameter vector or ensemble of parameter vectors, one per row (arr)
+        :return: modelled observations (arr)
+        """
+        hx_lin = np.dot(x, self.h_mat.T)
+        return hx_lin + self.nonlin * hx_lin**2
+
+    def jac(self, x):
+        """
+        Jacobian of the toy observation operator
+        :param x: parameter vector (arr)
+        :return: Jacobian matrix, one row per observation (arr)
+        """
+        return (1. + 2. * self.nonlin * np.dot(self.h_mat, x))[:, np.newaxis] * self.h_mat
+
+    def posterior(self):
+        """
+        Finds the posterior mode by a dense minimisation of the nonlinear cost function in parameter space, run to a
+        tight tolerance. The posterior is not Gaussian, the standard deviations are those of the Laplace approximation
+        from the Hessian at the mode
+        :return: posterior parameter vector and posterior standard deviations (tuple)
+        """
+        r_inv = 1. / self.yerr**2
+
+        def cost(x):
+            return 0.5 * np.sum(((x - self.xb) / self.xb_sd)**2) + 0.5 * np.sum((self.hx(x) - self.yobs)**2 * r_inv)
+
+        def grad(x):
+            return (x - self.xb) / self.xb_sd**2 + np.dot(self.jac(x).T, (self.hx(x) - self.yobs) * r_inv)
+
+        def hess(x):
+            jac = self.jac(x)
+            curv = 2. * self.nonlin * (self.hx(x) - self.yobs) * r_inv
+            return np.diag(1. / self.xb_sd**2) + np.dot(jac.T * r_inv, jac) + np.dot(self.h_mat.T * curv, self.h_mat)
+
+        res = spop.minimize(cost, self.xb, jac=grad, hess=hess, method='trust-exact', options={'gtol': 1e-10})
+        return res.x, np.sqrt(np.diag(np.linalg.inv(hess(res.x))))
+
+
+toy_models = {'linear': LinearToy, 'nonlinear': NonlinearToy}
+
+
+def toy_fourdenvar(toy, size_ens, design='random', seed_val=0, prior_err=None):
+    """
+    Creates an instance of FourDEnVar for a toy model, running the toy model for the prior and its ensemble
+    :param toy: toy model instance (obj)
+    :param size_ens: size of ensemble (int)
+    :param design: design used to draw prior ensemble (str)
+    :param seed_val: seed value used to draw prior ensemble (int)
+    :param prior_err: relative error on prior parameter estimates, default es.prior_err (float)
+    :return: FourDEnVar instance ready for running data assimilation routines (obj)
+    """
+    jda = fourdenvar.FourDEnVar(seed_val=seed_val, size_ens=size_ens, design=design, p_dict=toy.p_dict,
+                                obs_dic=toy.obs_dic, prior_err=prior_err)
+    jda.make_hxb(toy.hx(jda.xb))
+    jda.create_ensemble(toy.hx(jda.xbs))
+    return jda
+
+
+def bench_designs(sizes=(8, 16, 32, 64, 128, 256), designs=('random', 'lhs', 'sobol', 'antithetic'), n_rep=20,
+                  toy=None):
+    """
+    Reports the error in the posterior estimate against ensemble size for different prior ensemble designs
+    :param sizes: ensemble sizes to test (tuple)
+    :param designs: ensemble designs to test (tuple)
+    :param n_rep: number of repeated experiments with different seed values for each design and size (int)
+    :param toy: toy model instance, default LinearToy() (obj)
+    :return: dictionary of mean errors for each design and ensemble size (dict)
+    """
+    if toy is None:
+        toy = LinearToy()
+    xa_exact, xa_sd_exact = toy.posterior()
+    results = {}
+    print('%-12s%8s%12s%12s%12s%12s' % ('design', 'size', 'xb_mean', 'xb_sd', 'xa', 'xa_sd'))
+    for design in designs:
+        results[design] = {}
+        for size_ens in sizes:
+            errs = np.zeros((n_rep, 4))
+            for seed_val in range(n_rep):
+                jda = toy_fourdenvar(toy, size_ens, design=design, seed_val=seed_val)
+                xa = jda.find_min_ens_inc(method='direct')[1]
+                # errors are root mean square over parameters, normalised by the prior or posterior standard deviation
+                errs[seed_val] = [np.sqrt(np.mean(((np.mean(jda.xbs, axis=0) - jda.xb) / jda.xb_sd)**2)),
+                                  np.sqrt(np.mean((np.std(jda.xbs, axis=0, ddof=1) / jda.xb_sd - 1)**2)),
+                                  np.sqrt(np.mean(((xa - xa_exact) / xa_sd_exact)**2)),
+                                  np.sqrt(np.mean((jda.xa_sd() / xa_sd_exact - 1)**2))]
+            err = np.mean(errs, axis=0)
+            results[design][size_ens] = {'xb_mean': err[0], 'xb_sd': err[1], 'xa': err[2], 'xa_sd': err[3]}
+            print('%-12s%8d%12.4f%12.4f%12.4f%12.4f' % ((design, size_ens) + tuple(err)))
+    return results
+
+
+def best_time(func, n_rep=3):
+    """
+    Times a function, taking the best of repeated calls to reduce noise from other processes
+    :param func: function to time, called with no arguments (func)
+    :param n_rep: number of repeated calls (int)
+    :return: best wall clock time in seconds (float)
+    """
+    times = []
+    for i in range(n_rep):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def clear_cache(jda):
+    """
+    Clears the cached factorisations of a FourDEnVar instance so that they are timed from scratch
+    :param jda: FourDEnVar instance (obj)
+    :return: n/a
+    """
+    jda._hess_eig = None
+    jda._a_cov = None
+    jda._pa_cov = None
+
+
+def bench_case(toy_name, size_ens, n_obs, n_param, n_rep=3, methods=('direct', 'ncg'), seed_val=0):
+    """
+    Times the 4DEnVar analysis for a single toy problem
+    :param toy_name: name of toy model in toy_models (str)
+    :param size_ens: size of ensemble (int)
+    :param n_obs: number of observations (int)
+    :param n_param: number of parameters (int)
+    :param n_rep: number of repeated calls to time each step with (int)
+    :param methods: minimisation methods to time (tuple)
+    :param seed_val: seed value used to create the toy problem and prior ensemble (int)
+    :return: dictionary of best times in seconds for each step of the analysis (dict)
+    """
+    toy = toy_models[toy_name](n_param=n_param, n_obs=n_obs, seed_val=seed_val)
+    hxb = toy.hx(toy.xb)
+    times = {}
+    t0 = time.perf_counter()
+    jda = fourdenvar.FourDEnVar(seed_val=seed_val, size_ens=size_ens, p_dict=toy.p_dict, obs_dic=toy.obs_dic)
+    times['init'] = time.perf_counter() - t0
+    hm_xbs = toy.hx(jda.xbs)
+    t0 = time.perf_counter()
+    jda.make_hxb(hxb)
+    jda.create_ensemble(hm_xbs)
+    times['create_ensemble'] = time.perf_counter() - t0
+    wvals = np.random.default_rng(seed_val).standard_normal(size_ens)
+    times['cost'] = best_time(lambda: jda.cost_ens_inc(wvals), n_rep)
+    times['grad'] = best_time(lambda: jda.gradcost_ens_inc(wvals), n_rep)
+    for method in methods:
+        times['find_min_' + method] = best_time(lambda: (clear_cache(jda), jda.find_min_ens_inc(dispp=0,
+                                                                                               method=method)), n_rep)
+    xa = jda.find_min_ens_inc(method='direct')[1]
+    times['a_cov'] = best_time(lambda: (clear_cache(jda), jda.a_cov()), n_rep)
+    times['a_ens'] = best_time(lambda: jda.a_ens(xa), n_rep)
+    return times
+
+
+def bench_scaling(sizes=(50, 100, 500, 1000, 5000), n_obs=(100, 1000, 10000, 100000), n_params=(7, 20, 100),
+                  base=(100, 1000, 7), toys=('linear', 'nonlinear'), n_rep=3, methods=('direct', 'ncg'),
+                  out_file=None):
+    """
+    Times the 4DEnVar analysis against ensemble size, number of observations and number of parameters for toy models.
+    Each dimension is scaled in turn with the others held at their base values
+    :param sizes: ensemble sizes to test (tuple)
+    :param n_obs: numbers of observations to test (tuple)
+    :param n_params: numbers of parameters to test (tuple)
+    :param base: base ensemble size, number of observations and number of parameters (tuple)
+    :param toys: names of toy models in toy_models to test (tuple)
+    :param n_rep: number of repeated calls to time each step with (int)
+    :param methods: minimisation methods to time (tuple)
+    :param out_file: JSON file to write results to !optional! (str)
+    :return: dictionary of results (dict)
+    """
+    cases = [(size_ens, base[1], base[2]) for size_ens in sizes] + \
+            [(base[0], n_ob, base[2]) for n_ob in n_obs] + \
+            [(base[0], base[1], n_param) for n_param in n_params]
+    # remove repeated base case while keeping order
+    cases = [case for i, case in enumerate(cases) if case not in cases[:i]]
+    results = {'meta': {'numpy': np.__version__, 'python': platform.python_version(), 'machine': platform.machine(),
+                        'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'n_rep': n_rep},
+               'cases': []}
+    print('%-10s%8s%8s%8s  %s' % ('toy', 'size', 'n_obs', 'n_param', 'times (s)'))
+    for toy_name in toys:
+        for size_ens, n_ob, n_param in cases:
+            case = {'toy': toy_name, 'size_ens': size_ens, 'n_obs': n_ob, 'n_param': n_param}
+            case['times'] = bench_case(toy_name, size_ens, n_ob, n_param, n_rep=n_rep, methods=methods)
+            print('%-10s%8d%8d%8d  ' % (toy_name, size_ens, n_ob, n_param) +
+                  ' '.join('%s=%.2e' % (k, v) for k, v in case['times'].items()))
+            results['cases'].append(case)
+    if out_file is not None:
+        with open(out_file, 'w') as f:
+            json.dump(results, f, indent=1)
+    return results
+
+
+def find_regressions(results, baseline, factor=1.5, min_time=1e-3):
+    """
+    Compares benchmark results against a baseline and reports steps that have slowed down
+    :param results: results as returned by bench_scaling (dict)
+    :param baseline: baseline results as returned by bench_scaling or loaded from its JSON output (dict)
+    :param factor: slow down factor above which a step is reported (float)
+    :param min_time: baseline time in seconds below which steps are ignored as too noisy (float)
+    :return: list of tuples of case, step and slow down factor (lst)
+    """
+    def case_key(case):
+        return case['toy'], case['size_ens'], case['n_obs'], case['n_param']
+    base_times = {case_key(case): case['times'] for case in baseline['cases'] if 'times' in case}
+    regressions = []
+    for case in results['cases']:
+        if 'times' not in case or case_key(case) not in base_times:
+            continue
+        for step, t in case['times'].items():
+            t_base = base_times[case_key(case)].get(step)
+            if t_base is not None and t_base > min_time and t > factor * t_base:
+                regressions.append((case_key(case), step, t / t_base))
+                print('Regression: %s %s %.2fx slower' % (str(case_key(case)), step, t / t_base))
+    return regressions
+
+
+def bench_batch(n_seeds=50, prior_errs=(0.1, 0.25, 0.5, 1.0), size_ens=20, n_obs=100, n_param=7, toy=None):
+    """
+    Compares solving a sweep of seed values and prior errors one problem at a time with solving them in a single
+    batched call to fourdenvar.batch_find_min
+    :param n_seeds: number of seed values in sweep (int)
+    :param prior_errs: relative prior errors in sweep (tuple)
+    :param size_ens: size of ensemble (int)
+    :param n_obs: number of observations of toy problem, used if toy is not given (int)
+    :param n_param: number of parameters of toy problem, used if toy is not given (int)
+    :param toy: toy model instance, default LinearToy (obj)
+    :return: dictionary of times in seconds and largest difference between batched and looped posteriors (dict)
+    """
+    if toy is None:
+        toy = LinearToy(n_param=n_param, n_obs=n_obs)
+    jdas = [toy_fourdenvar(toy, size_ens, seed_val=seed_val, prior_err=prior_err)
+            for prior_err in prior_errs for seed_val in range(n_seeds)]
+    results = {'n_problems': len(jdas)}
+    t0 = time.perf_counter()
+    loop_direct = [jda.direct_min_ens_inc() for jda in jdas]
+    results['loop_direct'] = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    wvals, xa, xa_ens = fourdenvar.batch_find_min(jdas)
+    results['batch'] = time.perf_counter() - t0
+    results['max_xa_ens_diff'] = float(np.max(np.abs(xa_ens - np.array([res[2] for res in loop_direct])) /
+                                              np.abs(xa_ens)))
+    print('%d problems: loop direct %.3fs, batch %.3fs, max relative difference %.1e' %
+          (len(jdas), results['loop_direct'], results['batch'], results['max_xa_ens_diff']))
+    return results
+
+
+def bench_stream(size_max=500, tol=0.005, min_size=20, patience=10, n_rep=10, toy=None):
+    """
+    Reports the ensemble size at which a streaming analysis (fourdenvar.EnsembleStream) stops adding members and the
+    difference between its posterior and the posterior of the full ensemble
+    :param size_max: size of full ensemble (int)
+    :param tol: tolerance on change in posterior estimate and spread between members (float)
+    :param min_size: smallest ensemble size at which to test for convergence (int)
+    :param patience: number of consecutive members that must each change the posterior by less than tol (int)
+    :param n_rep: number of repeated experiments with different seed values (int)
+    :param toy: toy model instance, default NonlinearToy() (obj)
+    :return: dictionary of ensemble sizes stopped at and errors relative to the full ensemble for each seed value
+             (dict)
+    """
+    if toy is None:
+        toy = NonlinearToy()
+    results = {'size_ens': [], 'xa': [], 'xa_sd': []}
+    for seed_val in range(n_rep):
+        jda = toy_fourdenvar(toy, size_max, seed_val=seed_val)
+        xa_full = jda.find_min_ens_inc(method='direct')[1]
+        xa_sd_full = jda.xa_sd()
+        stream = fourdenvar.EnsembleStream(jda)
+        for num in range(size_max):
+            stream.add(num, jda.hm_xbs[num])
+            if stream.converged(tol, min_size, patience) is True:
+                break
+        rec = stream.history[-1]
+        results['size_ens'].append(rec['size_ens'])
+        results['xa'].append(float(np.max(np.abs(rec['xa'] - xa_full) / jda.xb_sd)))
+        results['xa_sd'].append(float(np.max(np.abs(rec['xa_sd'] / xa_sd_full - 1.))))
+    print('Stream stopped at %.0f of %d members (min/max %d/%d), error against full ensemble: xa %.4f prior sd, '
+          'xa_sd %.4f' % (np.mean(results['size_ens']), size_max, min(results['size_ens']), max(results['size_ens']),
+                          np.mean(results['xa']), np.mean(results['xa_sd'])))
+    return results
+
+
+def bench_emulator(size_ens=50, n_test=200, n_rep=5, toy=None):
+    """
+    Reports the leave one out and held out error of an emulator trained on the prior ensemble, the time for a single
+    prediction and the error of the emulator warm start against the maximum a posteriori estimate
+    :param size_ens: size of prior ensemble used to train emulator (int)
+    :param n_test: number of held out parameter vectors drawn from the prior (int)
+    :param n_rep: number of repeated experiments with different seed values (int)
+    :param toy: toy model instance, default NonlinearToy() (obj)
+    :return: dictionary of errors and prediction time for each seed value (dict)
+    """
+    if toy is None:
+        toy = NonlinearToy()
+    results = {'loo_rmse': [], 'test_rmse': [], 'coverage': [], 'predict': [], 'xa': [], 'x_warm': []}
+    for seed_val in range(n_rep):
+        jda = toy_fourdenvar(toy, size_ens, seed_val=seed_val)
+        emu = emulator.from_fourdenvar(jda)
+        x_test = jda.generate_param_ens(n_test, design='lhs')
+        validation = emu.validate(x_test, toy.hx(x_test))
+        results['loo_rmse'].append(emu.validate()['rmse'])
+        results['test_rmse'].append(validation['rmse'])
+        results['coverage'].append(validation['coverage'])
+        results['predict'].append(best_time(lambda: emu.predict(x_test[0]), 100))
+
+        # maximum a posteriori estimate of toy problem
+        def cost(xvals):
+            return 0.5 * np.sum(((xvals - jda.xb) / jda.xb_sd)**2) + \
+                0.5 * np.sum(((toy.hx(xvals) - jda.yoblist) / jda.yerr)**2)
+        x_map = spop.minimize(cost, jda.xb, method='BFGS').x
+        results['xa'].append(float(np.max(np.abs(jda.direct_min_ens_inc()[1] - x_map) / jda.xb_sd)))
+        results['x_warm'].append(float(np.max(np.abs(emu.find_min(jda) - x_map) / jda.xb_sd)))
+    print('Emulator error (observation errors): leave one out %.3f, held out %.3f, %.1f%% within 2 sd, prediction '
+          '%.0fus' % (np.mean(results['loo_rmse']), np.mean(results['test_rmse']), 100 * np.mean(results['coverage']),
+                      1e6 * np.mean(results['predict'])))
+    print('Error against MAP estimate (prior sd): 4DEnVar %.4f, emulator warm start %.4f' %
+          (np.mean(results['xa']), np.mean(results['x_warm'])))
+    return results
+
+
+def bench_obs_error(n_obs=(1000, 5000, 100000), size_ens=50, corr_len=5., max_dense=5000, n_rep=3, seed_val=0):
+    """
+    Times whitening an ensemble with a structured correlated observation error covariance matrix against a diagonal
+    covariance matrix and a dense Cholesky factorisation, and reports the error in the whitened ensemble Gram matrix
+    against the dense factorisation. Observations are split into three types with time correlated errors, time
+    correlated errors with a shared error and uncorrelated errors with a shared error
+    :param n_obs: numbers of observations to test (tuple)
+    :param size_ens: size of ensemble (int)
+    :param corr_len: e-folding length of time correlation in days (float)
+    :param max_dense: largest number of observations to factorise a dense covariance matrix for (int)
+    :param n_rep: number of repeated calls to time each step with (int)
+    :param seed_val: seed value used to create the ensemble (int)
+    :return: dictionary of times in seconds and relative errors for each number of observations (dict)
+    """
+    rng = np.random.default_rng(seed_val)
+    results = {}
+    print('%8s%12s%12s%12s%12s' % ('n_obs', 'diag (s)', 'struct (s)', 'dense (s)', 'gram err'))
+    for n_ob in n_obs:
+        sizes = [n_ob // 2, n_ob // 4, n_ob - n_ob // 2 - n_ob // 4]
+        sd = [rng.uniform(0.5, 2., size) for size in sizes]
+        pos = [np.arange(size) for size in sizes]
+        r_cov = obs_error.BlockDiagCov([obs_error.obs_var_cov(sd[0], pos[0], corr_len=corr_len),
+                                        obs_error.obs_var_cov(sd[1], pos[1], corr_len=corr_len, bias_err=0.5),
+                                        obs_error.obs_var_cov(sd[2], pos[2], bias_err=0.5)])
+        diag_cov = obs_error.DiagonalCov(r_cov.variances())
+        hmx_mat = rng.standard_normal((n_ob, size_ens))
+        res = {'diag': best_time(lambda: diag_cov.whiten(hmx_mat), n_rep),
+               'struct': best_time(lambda: r_cov.whiten(hmx_mat), n_rep)}
+        if n_ob <= max_dense:
+            dense_cov = obs_error.DenseCov(r_cov.dense())
+            res['dense'] = best_time(lambda: obs_error.DenseCov(r_cov.dense()).whiten(hmx_mat), 1)
+            gram = np.dot(r_cov.whiten(hmx_mat).T, r_cov.whiten(hmx_mat))
+            gram_dense = np.dot(dense_cov.whiten(hmx_mat).T, dense_cov.whiten(hmx_mat))
+            res['gram_err'] = float(np.max(np.abs(gram - gram_dense)) / np.max(np.abs(gram_dense)))
+        results[n_ob] = res
+        print('%8d%12.2e%12.2e%12s%12s' % (n_ob, res['diag'], res['struct'],
+                                          '%.2e' % res['dense'] if 'dense' in res else 'skipped',
+                                          '%.1e' % res['gram_err'] if 'gram_err' in res else '-'))
+    return results
+
+
+def arg_value(flag, default=None):
+    """
+    Returns the command line argument following a flag
+    :param flag: flag to look for in system arguments (str)
+    :param default: value to return if flag is not given (str)
+    :return: argument value (str)
+    """
+    if flag in sys.argv and sys.argv.index(flag) + 1 < len(sys.argv):
+        return sys.argv[sys.argv.index(flag) + 1]
+    return default
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 1 or 'designs' in sys.argv:
+        bench_designs()
+    # python benchmark.py scaling [quick] [--out results.json] [--baseline baseline.json]
+    if 'scaling' in sys.argv:
+        if 'quick' in sys.argv:
+            res = bench_scaling(sizes=(50, 200), n_obs=(100, 1000), n_params=(7, 20), base=(50, 100, 7),
+                                out_file=arg_value('--out', 'benchmark_scaling.json'))
+        else:
+            res = bench_scaling(out_file=arg_value('--out', 'benchmark_scaling.json'))
+        if arg_value('--baseline') is not None:
+            with open(arg_value('--baseline'), 'r') as f:
+                find_regressions(res, json.load(f))
+    if 'batch' in sys.argv:
+        bench_batch()
+    if 'stream' in sys.argv:
+        bench_stream()
+    if 'emulator' in sys.argv:
+        bench_emulator()
+    if 'obs_error' in sys.argv:
+        bench_obs_error()
@@ -0,0 +1,229 @@
+# 3rd party modules:
+import numpy as np
+import scipy.optimize as spop
+import scipy.linalg as splinal
+# local modules:
+import sampling
+
+
+class Emulator:
+    """
+    Statistical emulator of the modelled observations H(x), trained on an ensemble of parameter vectors and their JULES
+    modelled observations (e.g. FourDEnVar.xbs and FourDEnVar.hm_xbs). Each modelled observation is emulated with a
+    linear mean plus a Gaussian process with a squared exponential covariance. The length scales and nugget are shared
+    by all modelled observations and fitted by maximum likelihood on the leading principal components of the modelled
+    observations, so a prediction costs a single kernel vector of length N_train and one (N_train x n_obs) product
+    :param x_train: parameter vectors, one per row (arr)
+    :param hx_train: modelled observations of parameter vectors, one per row (arr)
+    :param y_err: observation errors, modelled observations are scaled by these, default standard deviation of training
+                  modelled observations (arr)
+    :param var_frac: fraction of variance of scaled modelled observations in principal components used to fit the
+                     length scales and nugget (float)
+    :param max_pc: maximum number of principal components used to fit the length scales and nugget (int)
+    """
+    def __init__(self, x_train, hx_train, y_err=None, var_frac=0.99, max_pc=10):
+        self.x_train = np.asarray(x_train, dtype=float)
+        hx_train = np.asarray(hx_train, dtype=float)
+        self.n_train, self.n_param = self.x_train.shape
+        # standardise inputs and scale outputs
+        self.x_mean = np.mean(self.x_train, axis=0)
+        self.x_sd = np.std(self.x_train, axis=0)
+        self.x_sd[self.x_sd == 0] = 1.
+        self.x_std = (self.x_train - self.x_mean) / self.x_sd
+        self.hx_mean = np.mean(hx_train, axis=0)
+        if y_err is None:
+            y_err = np.std(hx_train, axis=0)
+            y_err[y_err == 0] = 1.
+        self.y_scale = np.asarray(y_err, dtype=float)
+        hx_scaled = (hx_train - self.hx_mean) / self.y_scale
+        self.spread = np.sqrt(np.mean(hx_scaled**2))
+        # linear mean of each modelled observation, Gaussian process on the residuals
+        self.f_train = self.basis(self.x_std)
+        self.beta = np.linalg.lstsq(self.f_train, hx_scaled, rcond=None)[0]
+        self.resid = hx_scaled - np.dot(self.f_train, self.beta)
+        # leading principal components of the residuals, used to fit the length scales and nugget
+        u_mat, sing, vt_mat = np.linalg.svd(self.resid, full_matrices=False)
+        var_cum = np.cumsum(sing**2) / max(np.sum(sing**2), 1e-300)
+        self.n_pc = int(max(min(np.searchsorted(var_cum, var_frac) + 1, max_pc, len(sing)), 1))
+        self.resid_pc = u_mat[:, :self.n_pc] * sing[:self.n_pc]
+        self.fit()
+
+    def basis(self, x_std):
+        """
+        Evaluates the basis functions of the linear mean at standardised parameter vectors
+        :param x_std: standardised parameter vectors, one per row (arr)
+        :return: basis function values (arr)
+        """
+        return np.hstack([np.ones((len(x_std), 1)), x_std])
+
+    def kernel(self, x1_std, x2_std, log_len=None):
+        """
+        Squared exponential correlation between two sets of standardised parameter vectors
+        :param x1_std: standardised parameter vectors, one per row (arr)
+        :param x2_std: standardised parameter vectors, one per row (arr)
+        :param log_len: log length scales, default fitted values (arr)
+        :return: correlation matrix (arr)
+        """
+        if log_len is None:
+            log_len = self.log_len
+        len_scale = np.exp(log_len)
+        x1 = x1_std / len_scale
+        x2 = x2_std / len_scale
+        sq_dist = np.sum(x1**2, axis=1)[:, np.newaxis] + np.sum(x2**2, axis=1) - 2. * np.dot(x1, x2.T)
+        return np.exp(-0.5 * np.maximum(sq_dist, 0.))
+
+    def neg_log_lik(self, theta):
+        """
+        Negative log marginal likelihood of the principal components of the residuals from the linear mean, with the
+        variance of each component profiled out
+        :param theta: log length scales and log nugget (arr)
+        :return: negative log likelihood (float)
+        """
+        k_mat = self.kernel(self.x_std, self.x_std, theta[:-1]) + np.exp(theta[-1]) * np.eye(self.n_train)
+        try:
+            chol = splinal.cho_factor(k_mat, lower=True)
+        except np.linalg.LinAlgError:
+            return 1e10
+        sig2 = np.sum(self.resid_pc * splinal.cho_solve(chol, self.resid_pc), axis=0) / self.n_train
+        return 0.5 * self.n_train * np.sum(np.log(np.maximum(sig2, 1e-300))) + \
+            self.n_pc * np.sum(np.log(np.diag(chol[0])))
+
+    def fit(self):
+        """
+        Fits the length scales and nugget by maximum likelihood and precomputes the quantities needed for prediction
+        :return: n/a
+        """
+        theta0 = np.concatenate([np.zeros(self.n_param), [np.log(1e-4)]])
+        bnds = [(np.log(0.05), np.log(100.))] * self.n_param + [(np.log(1e-6), np.log(1.))]
+        res = spop.minimize(self.neg_log_lik, theta0, method='L-BFGS-B', bounds=bnds)
+        self.log_len = res.x[:-1]
+        self.nugget = np.exp(res.x[-1])
+        k_mat = self.kernel(self.x_std, self.x_std) + self.nugget * np.eye(self.n_train)
+        self.k_chol = splinal.cho_factor(k_mat, lower=True)
+        self.k_inv = splinal.cho_solve(self.k_chol, np.eye(self.n_train))
+        self.alpha = np.dot(self.k_inv, self.resid)
+        self.sig2 = np.sum(self.resid * self.alpha, axis=0) / self.n_train
+
+    def predict(self, x_ens):
+        """
+        Predicts the modelled observations H(x) and their variances
+        :param x_ens: parameter vector or parameter vectors, one per row (arr)
+        :return: predicted modelled observations and their variances, one row per parameter vector if x_ens is an
+                 ensemble, as a tuple of arrays
+        """
+        x_std = (np.atleast_2d(x_ens) - self.x_mean) / self.x_sd
+        r_mat = self.kernel(x_std, self.x_std)
+        hx = self.hx_mean + (np.dot(self.basis(x_std), self.beta) + np.dot(r_mat, self.alpha)) * self.y_scale
+        corr = np.maximum(1. + self.nugget - np.sum(np.dot(r_mat, self.k_inv) * r_mat, axis=1), 0.)
+        hx_var = corr[:, np.newaxis] * self.sig2 * self.y_scale**2
+        if np.ndim(x_ens) == 1:
+            return hx[0], hx_var[0]
+        return hx, hx_var
+
+    def validate(self, x_test=None, hx_test=None):
+        """
+        Reports the error of the emulator, by leave one out cross validation of the training ensemble or against a
+        held out test ensemble. Errors are in units of the output scaling, i.e. observation errors if y_err was given
+        :param x_test: held out parameter vectors, one per row, default leave one out cross validation (arr)
+        :param hx_test: modelled observations of held out parameter vectors (arr)
+        :return: dictionary of root mean square error, root mean square error as a fraction of the spread of the
+                 training modelled observations and fraction of errors within two predicted standard deviations (dict)
+        """
+        if x_test is None:
+            # closed form leave one out residuals and variances
+            k_inv_diag = np.diag(self.k_inv)[:, np.newaxis]
+            err = self.alpha / k_inv_diag
+            err_var = self.sig2 / k_inv_diag
+        else:
+            hx, hx_var = self.predict(x_test)
+            err = (np.asarray(hx_test) - hx) / self.y_scale
+            err_var = hx_var / self.y_scale**2
+        rmse = float(np.sqrt(np.mean(err**2)))
+        return {'rmse': rmse, 'nrmse': rmse / self.spread,
+                'coverage': float(np.mean(np.abs(err) < 2. * np.sqrt(err_var)))}
+
+    def implausibility(self, x_ens, y, y_err):
+        """
+        Calculates the implausibility of parameter vectors given observations, the largest standardised distance between
+        an observation and its emulated value, accounting for observation and emulator error
+        :param x_ens: parameter vector or parameter vectors, one per row (arr)
+        :param y: observations (arr)
+        :param y_err: observation errors (arr)
+        :return: implausibility of each parameter vector (arr)
+        """
+        hx, hx_var = self.predict(np.atleast_2d(x_ens))
+        return np.max(np.abs(hx - y) / np.sqrt(hx_var + np.asarray(y_err)**2), axis=1)
+
+    def screen(self, x_ens, y, y_err, val_bnds, cut=3.):
+        """
+        Screens an ensemble of parameter vectors before running JULES, rejecting members outside the parameter bounds or
+        with an implausibility above cut
+        :param x_ens: ensemble of parameter vectors, one per row (arr)
+        :param y: observations (arr)
+        :param y_err: observation errors (arr)
+        :param val_bnds: list of (low, high) bounds for each parameter (lst)
+        :param cut: largest implausibility of members to keep (float)
+        :return: boolean mask that is True for members to run (arr)
+        """
+        return sampling.in_bnds(x_ens, val_bnds) & (self.implausibility(x_ens, y, y_err) <= cut)
+
+    def cost(self, xvals, jda):
+        """
+        Calculates the nonlinear 4DVar cost function with the emulated modelled observations, with the emulator variance
+        added to the observation error variance, and its gradient
+        :param xvals: parameter vector (arr)
+        :param jda: FourDEnVar instance providing the prior and observations (obj)
+        :return: value of cost function (float) and its gradient (arr) as a tuple
+        """
+        x_std = (xvals - self.x_mean) / self.x_sd
+        r_vec = self.kernel(x_std[np.newaxis], self.x_std)[0]
+        k_inv_r = np.dot(self.k_inv, r_vec)
+        hx = self.hx_mean + (np.dot(self.basis(x_std[np.newaxis])[0], self.beta) + np.dot(r_vec, self.alpha)) * \
+            self.y_scale
+        corr = max(1. + self.nugget - np.dot(r_vec, k_inv_r), 0.)
+        var = jda.yerr**2 + corr * self.sig2 * self.y_scale**2
+        innov = hx - jda.yoblist
+        dx = xvals - jda.xb
+        b_inv_dx = np.linalg.solve(jda.b_mat, dx)
+        cost = 0.5 * np.dot(dx, b_inv_dx) + 0.5 * np.sum(innov**2 / var)
+        # derivatives of kernel vector, modelled observations and correlation with respect to parameters
+        dr_mat = -r_vec * (x_std[:, np.newaxis] - self.x_std.T) / np.exp(2. * self.log_len)[:, np.newaxis]
+        dhx = (self.beta[1:] + np.dot(dr_mat, self.alpha)) * self.y_scale / self.x_sd[:, np.newaxis]
+        dcorr = -2. * np.dot(dr_mat, k_inv_r) / self.x_sd if corr > 0 else np.zeros(self.n_param)
+        grad = b_inv_dx + np.dot(dhx, innov / var) - \
+            0.5 * dcorr * np.sum(innov**2 / var**2 * self.sig2 * self.y_scale**2)
+        return cost, grad
+
+    def find_min(self, jda, x0=None):
+        """
+        Minimises the nonlinear cost function with the emulated modelled observations, e.g. to give a warm start to
+        FourDEnVar.outer_loop_min_ens_inc. The search is kept within the parameter bounds and the range of the training
+        ensemble, outside which the emulator is extrapolating
+        :param jda: FourDEnVar instance providing the prior, observations and parameter bounds (obj)
+        :param x0: parameter vector to start from, default the 4DEnVar estimate from jda (arr)
+        :return: parameter vector minimising the emulated cost function (arr)
+        """
+        lower = np.maximum(np.min(self.x_train, axis=0), np.asarray(jda.val_bnds, dtype=float)[:, 0])
+        upper = np.minimum(np.max(self.x_train, axis=0), np.asarray(jda.val_bnds, dtype=float)[:, 1])
+        if x0 is None:
+            x0 = jda.direct_min_ens_inc()[1]
+        x0 = np.clip(x0, lower, upper)
+
+        # minimise in units of the prior standard deviation so that parameters are similarly scaled
+        def cost_z(z):
+            cost, grad = self.cost(jda.xb + z * jda.xb_sd, jda)
+            return cost, grad * jda.xb_sd
+        res = spop.minimize(cost_z, (x0 - jda.xb) / jda.xb_sd, jac=True, method='L-BFGS-B',
+                            bounds=list(zip((lower - jda.xb) / jda.xb_sd, (upper - jda.xb) / jda.xb_sd)))
+        return jda.xb + res.x * jda.xb_sd
+
+
+def from_fourdenvar(jda, **kwargs):
+    """
+    Trains an emulator on the prior ensemble of a FourDEnVar instance, with modelled observations scaled by the
+    observation errors
+    :param jda: FourDEnVar instance on which create_ensemble has been called (obj)
+    :param kwargs: further arguments passed to Emulator
+    :return: Emulator instance (obj)
+    """
+    return Emulator(jda.xbs, jda.hm_xbs, y_err=jda.yerr, **kwargs)
@@ -0,0 +1,217 @@
+# core python modules:
+import os
+import json
+import multiprocessing as mp
+# 3rd party modules:
+import numpy as np
+import netCDF4 as nc
+# local modules:
+import instrument
+import scheduler
+
+
+class EnsembleStore:
+    """
+    Consolidated store of the output of a JULES ensemble. Each output variable is held in a .npy file with a leading
+    ensemble member dimension, opened as a memory map so that slices across members are read without opening the member
+    netCDF files. The member parameter vectors are stored alongside in params.npy
+    :param store_dir: directory of consolidated store, as written by consolidate (str)
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.variables = sorted(self.meta['variables'].keys())
+        self.size_ens = self.meta['size_ens']
+        self.stamps = self.meta['stamps']
+        # members for which output was found when the store was written
+        self.members = [i for i in range(self.size_ens) if self.stamps[i] is not None]
+        self._vars = {}
+
+    def __contains__(self, var):
+        return var in self.meta['variables']
+
+    def var(self, var):
+        """
+        Returns an output variable for all ensemble members
+        :param var: JULES output variable name (str)
+        :return: memory mapped array with a leading ensemble member dimension (arr)
+        """
+        if var not in self._vars:
+            self._vars[var] = np.load(os.path.join(self.store_dir, var + '.npy'), mmap_mode='r')
+        return self._vars[var]
+
+    def params(self):
+        """
+        Returns the parameter vectors of the ensemble members
+        :return: parameter names (lst) and ensemble of parameter vectors, one per row, None if not stored (tuple)
+        """
+        if not os.path.exists(os.path.join(self.store_dir, 'params.npy')):
+            return self.meta['params'], None
+        return self.meta['params'], np.load(os.path.join(self.store_dir, 'params.npy'), mmap_mode='r')
+
+    def times(self):
+        """
+        Returns the output times of the ensemble
+        :return: array of datetimes (arr)
+        """
+        return nc.num2date(np.load(os.path.join(self.store_dir, 'time.npy')), self.meta['time_units'])
+
+    def is_current(self, nc_files):
+        """
+        Tests if the store was written from the current version of the member output files
+        :param nc_files: list of member netCDF files (lst)
+        :return: Bool
+        """
+        return len(nc_files) == self.size_ens and [file_stamp(f) for f in nc_files] == self.stamps
+
+
+def member_files(ens_dir, size_ens):
+    """
+    Returns the daily output files of the members of an ensemble
+    :param ens_dir: directory of ensemble output (str)
+    :param size_ens: size of ensemble (int)
+    :return: list of netCDF files (lst)
+    """
+    return [os.path.join(ens_dir, 'ens' + str(i) + '.daily.nc') for i in range(size_ens)]
+
+
+def store_dir_for(ens_dir):
+    """
+    Returns the location of the consolidated store of an ensemble directory
+    :param ens_dir: directory of ensemble output (str)
+    :return: store directory (str)
+    """
+    return ens_dir.rstrip('/') + '_store'
+
+
+def open_store(ens_dir, size_ens=None):
+    """
+    Opens the consolidated store of an ensemble directory if it is up to date with the member output files
+    :param ens_dir: directory of ensemble output (str)
+    :param size_ens: size of ensemble, default size recorded in store (int)
+    :return: EnsembleStore instance, None if there is no current store (obj)
+    """
+    store_dir = store_dir_for(ens_dir)
+    if not os.path.exists(os.path.join(store_dir, 'meta.json')):
+        return None
+    store = EnsembleStore(store_dir)
+    if size_ens is None:
+        size_ens = store.size_ens
+    if not store.is_current(member_files(ens_dir, size_ens)):
+        return None
+    return store
+
+
+@instrument.traced()
+def consolidate(ens_dir, size_ens, x_ens=None, params=None, processes=None):
+    """
+    Packs the output of an ensemble into a consolidated store of one memory mapped .npy file per output variable. Each
+    member netCDF file is opened once, members are read in parallel and only members whose output has changed since
+    the store was last written are read again
+    :param ens_dir: directory of ensemble output (str)
+    :param size_ens: size of ensemble (int)
+    :param x_ens: ensemble of parameter vectors to store alongside output !optional! (arr)
+    :param params: list of parameter names corresponding to x_ens !optional! (lst)
+    :param processes: number of processes to use for reading files, default derived from available cores (int)
+    :return: EnsembleStore instance (obj)
+    """
+    store_dir = store_dir_for(ens_dir)
+    nc_files = member_files(ens_dir, size_ens)
+    stamps = [file_stamp(f) for f in nc_files]
+    present = [i for i in range(size_ens) if stamps[i] is not None]
+    if len(present) == 0:
+        raise ValueError('No ensemble output found in ' + ens_dir)
+    meta = {'size_ens': size_ens, 'variables': variable_specs(nc_files[present[0]]), 'stamps': [None] * size_ens,
+            'params': list(params) if params is not None else None}
+    stale = present
+    meta_file = os.path.join(store_dir, 'meta.json')
+    if os.path.exists(meta_file):
+        with open(meta_file, 'r') as f:
+            old_meta = json.load(f)
+        if old_meta['size_ens'] == size_ens and old_meta['variables'] == meta['variables']:
+            meta['stamps'] = old_meta['stamps']
+            if params is None:
+                meta['params'] = old_meta['params']
+            stale = [i for i in present if old_meta['stamps'][i] != stamps[i]]
+        # invalidate store while it is being updated
+        os.remove(meta_file)
+    else:
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+    if stale == present:
+        for var, spec in meta['variables'].items():
+            np.lib.format.open_memmap(os.path.join(store_dir, var + '.npy'), mode='w+', dtype=spec['dtype'],
+                                      shape=(size_ens,) + tuple(spec['shape']))
+    if len(stale) > 0:
+        jobs = [(store_dir, i, nc_files[i], sorted(meta['variables'].keys())) for i in stale]
+        if processes is None:
+            processes = scheduler.default_workers(len(stale))
+        if processes > 1 and len(stale) > 1:
+            pool = mp.Pool(processes=min(processes, len(stale)))
+            for i in pool.imap_unordered(consolidate_member, jobs):
+                meta['stamps'][i] = stamps[i]
+            pool.close()
+            pool.join()
+        else:
+            for job in jobs:
+                i = consolidate_member(job)
+                meta['stamps'][i] = stamps[i]
+    for i in range(size_ens):
+        if stamps[i] is None:
+            meta['stamps'][i] = None
+    nc_dat = nc.Dataset(nc_files[present[0]], 'r')
+    nc_dat.set_auto_mask(False)
+    np.save(os.path.join(store_dir, 'time.npy'), nc_dat.variables['time'][:])
+    meta['time_units'] = nc_dat.variables['time'].units
+    nc_dat.close()
+    if x_ens is not None:
+        np.save(os.path.join(store_dir, 'params.npy'), np.asarray(x_ens, dtype=float))
+    with open(meta_file + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.rename(meta_file + '.tmp', meta_file)
+    return EnsembleStore(store_dir)
+
+
+def consolidate_member(job):
+    """
+    Copies the output of a single ensemble member into the consolidated store, used by consolidate
+    :param job: tuple of store directory (str), ensemble member number (int), netCDF file (str) and list of variables
+                (lst)
+    :return: ensemble member number (int)
+    """
+    store_dir, i, nc_file, variables = job
+    nc_dat = nc.Dataset(nc_file, 'r')
+    nc_dat.set_auto_mask(False)
+    for var in variables:
+        arr = np.load(os.path.join(store_dir, var + '.npy'), mmap_mode='r+')
+        arr[i] = nc_dat.variables[var][:]
+        arr.flush()
+        del arr
+    nc_dat.close()
+    return i
+
+
+def variable_specs(nc_file):
+    """
+    Finds the shape and data type of the time varying output variables in a JULES netCDF file
+    :param nc_file: JULES netCDF file (str)
+    :return: dictionary of shape and data type for each variable (dict)
+    """
+    nc_dat = nc.Dataset(nc_file, 'r')
+    specs = {var: {'shape': list(v.shape), 'dtype': np.dtype(v.dtype).str} for var, v in nc_dat.variables.items()
+             if len(v.dimensions) > 0 and v.dimensions[0] == 'time' and var not in nc_dat.dimensions}
+    nc_dat.close()
+    return specs
+
+
+def file_stamp(fname):
+    """
+    Returns the modification time and size of a file, used to check if the store or other cached data is up to date
+    :param fname: file name (str)
+    :return: list of modification time and size of file, None if the file does not exist (lst)
+    """
+    if not os.path.exists(fname):
+        return None
+    stat = os.stat(fname)
+    return [stat.st_mtime, stat.st_size]
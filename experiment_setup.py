@@ -5,6 +5,7 @@
 import os
 # local modules:
 import observations
+import obs_operator
 import plot
 
 
@@ -14,13 +15,31 @@ output_directory = os.getcwd()+'/output'
 nml_directory = os.getcwd()+'/example_nml'
 # set model executable
 model_exe = '/home/users/ewanp82/models/jules4.9/build/bin/jules.exe'
+# set observation operator, defining the JULES output variables, positions and errors of the assimilated observations
+# (ObsVar corr_len and bias_err give time correlated and shared observation errors)
+obs_op = obs_operator.ObsOperator([
+    obs_operator.ObsVar('gpp', [141, 143, 146, 148, 155, 157, 158, 160, 161, 162, 163, 164, 165, 166, 167, 168, 169,
+                                170, 171, 172, 173, 175, 176, 177, 179, 180, 182, 183, 184, 186, 187, 190, 191, 194,
+                                196, 197, 198, 199, 200, 201, 202, 203, 204, 206, 207, 208, 209, 210, 211, 213, 214,
+                                215, 218, 219, 220, 222, 223, 225, 228, 229, 230, 231, 233, 234, 239, 240, 241, 242,
+                                243, 244, 245, 247, 248, 249, 251, 252, 259, 260],
+                        lvl_idx=7, transform=obs_operator.kg_s_to_g_day, err=0.1),
+    obs_operator.ObsVar('lai', [167, 187, 198, 209, 225], lvl_idx=7, err=0.05),
+    obs_operator.ObsVar('canht', [167, 187, 198, 225, 248, 262], lvl_idx=7, err=0.05)])
+# set JULES output variables used in plotting
+plot_vars = ['gpp', 'lai', 'canht', 'cropharvc']
+# set JULES output variables written by prior and posterior ensemble members, None to use the profile in output.nml
+xb_output_vars = sorted(set(obs_op.variables() + plot_vars))
+xa_output_vars = plot_vars
 # set function to extract JULES modelled observations for prior JULES
 jules_hxb = observations.extract_jules_hxb
 # set function to extract prior ensemble of modelled observations
 jules_hxb_ens = observations.extract_jules_hxb_ens
 # set function to extract observations to be assimilated
 obs_fn = observations.extract_twin_data
-# set JULES parameters to optimised during data assimilation
+# set JULES parameters to optimised during data assimilation, each as [level/pft index or 'None', prior value,
+# (low, high) bounds] with an optional fourth element 'log', 'logit' or 'none' choosing its transform, parameter names
+# must be unique across nml files and namelists
 opt_params = {'pft_params': {
                   'jules_pftparm': {
                       'neff_io': [7, 6.24155040e-04, (5e-05, 0.0015)],
@@ -34,10 +53,67 @@ opt_params = {'pft_params': {
                       'nu_io': [2, 4.16006288e+00, (0.0, 20.0)]}}}
 # set error on prior parameter estimates
 prior_err = 0.25
+# set switch to run the analysis and draw ensembles in an unbounded space of log/logit transformed parameters (logit
+# for parameters bounded on both sides by default), so that no ensemble member is outside the parameter bounds
+transform_params = False
 # set size of ensemble to be used in data assimilation experiments
 ensemble_size = 50
-# set number of processors to use in parallel runs of JULES ensemble
-num_processes = 100
+# set switch to stream prior ensemble members into the analysis as they finish and stop running JULES once the
+# posterior has stabilised, ensemble_size is then the largest ensemble run. The ensemble stops growing once, for each of
+# the last adaptive_patience members, no parameter estimate has moved by more than adaptive_tol prior standard
+# deviations and no posterior standard deviation has changed by more than a fraction adaptive_tol
+adaptive_ensemble = False
+adaptive_tol = 0.005
+adaptive_min_size = 20
+adaptive_patience = 10
+# set design used to draw the prior ensemble, 'random' (truncated normal for a diagonal prior error covariance,
+# rejection sampling otherwise), 'truncnorm', 'rejection' or the space filling designs 'lhs' (Latin hypercube),
+# 'sobol' (scrambled Sobol sequence, ensemble_size should be a power of 2) and 'antithetic' (antithetic pairs)
+ensemble_design = 'random'
+# set number of processors to use in parallel runs of JULES ensemble, None to derive from available cores and memory
+num_processes = None
+# set memory needed by a JULES run in bytes, used to derive number of processors
+member_memory = 1e9
+# set maximum runtime of a JULES ensemble member in seconds and number of times to retry failed members
+member_timeout = 60*60
+member_retries = 2
+# set data type of ensemble matrices in observation space ('float64' or 'float32' to halve their memory), a directory to
+# memory map them in (None to hold them in memory) and the size in bytes of the blocks they are processed in
+ensemble_dtype = 'float64'
+ensemble_mmap_dir = None
+block_bytes = 64e6
+# set method used to minimise the 4DEnVar cost function, 'ncg' (newton conjugate gradient) or 'direct' (closed form)
+min_method = 'ncg'
+# set maximum number of outer loops of the minimisation, 1 to linearise JULES once around the prior. Each further outer
+# loop reruns the ensemble recentred on the current estimate (scaling the prior perturbations by outer_loop_scale) and
+# the loops stop once no parameter changes by more than outer_loop_tol prior standard deviations
+outer_loops = 1
+outer_loop_tol = 0.05
+outer_loop_scale = 1.
+# set switches to train an emulator of the JULES modelled observations on the prior ensemble and use it to find a warm
+# start for the outer loops of the minimisation and to screen out posterior ensemble members that are outside the
+# parameter bounds or have an implausibility (largest standardised distance between an emulated and observed value)
+# above implausibility_cut before running JULES. The emulator is only used if its leave one out root mean square error
+# is below emulator_max_err observation errors
+emulator_warm_start = False
+emulator_screen = False
+implausibility_cut = 3.
+emulator_max_err = 0.5
+# set directory for cache of JULES runs, identical runs are copied from the cache instead of being run again
+run_cache_dir = os.getcwd()+'/output/run_cache'
+# set maximum size of run cache in bytes and maximum age of unused cache entries in seconds
+run_cache_max_bytes = 50e9
+run_cache_max_age = 30*24*60*60
+# set number of JULES spin-up cycles, 0 to start every run from the initial conditions in initial_conditions.nml. If
+# greater than 0 the spin-up is run once for each distinct set of values of the parameters in spinup_params (once with
+# the prior parameters if None) and ensemble members start from the dumped state at the start of the main run
+spinup_cycles = 0
+spinup_params = None
+# set directory for cache of spin-up dump files
+spinup_dir = os.getcwd()+'/output/spinup'
+# set directory to write a trace of the time, memory and I/O of each stage of an experiment to, None for no trace (e.g.
+# os.getcwd()+'/output/trace')
+trace_dir = None
 # set seed value for any random number generation within experiments
 seed_value = 0
 # plotting save function
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+#####################################################################################
+# Stand-in for the JULES executable, for running and timing experiments off-cluster #
+#####################################################################################
+# Reads the nml files in the current directory as written by jules.Jules.write_nml and writes JULES shaped netCDF
+# output from a simple daily crop model driven by the patched pft_params and crop_params, so that the nml handling,
+# ensemble scheduling, output I/O and extraction of an experiment can be exercised without JULES. Set model_exe in
+# experiment_setup.py to the location of this file to use it. Behaviour can be configured with environment variables:
+#   FAKE_JULES_RUNTIME    seconds to sleep for each run, to mimic the cost of a JULES run (default 0)
+#   FAKE_JULES_GRID       number of grid points as 'ny,nx', to scale the size of the output (default '1,1')
+#   FAKE_JULES_FAIL_RATE  probability that a run fails with a JULES style fatal error (default 0)
+#   FAKE_JULES_DUMP       set to 0 to stop dump files being written (default 1)
+# core python modules:
+import os
+import sys
+import time
+import datetime as dt
+# 3rd party modules:
+import numpy as np
+import netCDF4 as nc
+import f90nml
+
+# sizes of JULES output level dimensions for the example configuration
+level_dims = {'pft': 9, 'cpft': 4, 'tile': 13, 'soil': 4}
+# level dimensions of JULES output variables, variables not listed only have time, y and x dimensions
+var_levels = {'gpp': ('pft',), 'npp': ('pft',), 'lai': ('pft',), 'canht': ('pft',), 'fsmc': ('pft',),
+              'resp_p': ('pft',), 'cropharvc': ('cpft',), 'croprootc': ('cpft',), 'cropreservec': ('cpft',),
+              'cropstemc': ('cpft',), 'cropleafc': ('cpft',), 'cropyield': ('cpft',), 'cropdvi': ('cpft',),
+              'tstar': ('tile',), 'le': ('tile',), 'ftl': ('tile',), 'fqw': ('tile',), 'smcl': ('soil',),
+              't_soil': ('soil',), 'resp_s': ('scpool', 'sclayer')}
+var_units = {'gpp': 'kg m-2 s-1', 'npp': 'kg m-2 s-1', 'resp_p': 'kg m-2 s-1', 'resp_s': 'kg m-2 s-1',
+             'lai': '1', 'fsmc': '1', 'canht': 'm', 'precip': 'kg m-2 s-1', 'smcl': 'kg m-2', 't_soil': 'K',
+             'tstar': 'K', 't1p5m_gb': 'K', 'latent_heat': 'W m-2', 'le': 'W m-2', 'ftl_gb': 'W m-2', 'ftl': 'W m-2',
+             'fqw': 'kg m-2 s-1', 'qw1': 'kg kg-1', 'cropdvi': '1'}
+# pft index of each crop functional type (cpft)
+crop_pft = [5, 6, 7, 8]
+# day of year each crop functional type is sown
+sow_day = [100, 110, 120, 110]
+
+
+def read_nml():
+    """
+    Reads the nml files in the current directory
+    :return: dictionary of nml files (dict)
+    """
+    return {f[:-4]: f90nml.read(f) for f in os.listdir('.') if f.endswith('.nml')}
+
+
+def as_list(val):
+    """
+    Returns an nml value as a list
+    :param val: nml value (any)
+    :return: list of values (lst)
+    """
+    return list(val) if isinstance(val, list) else [val]
+
+
+def parse_time(time_str):
+    """
+    Parses a JULES date string
+    :param time_str: date string in the format 'YYYY-MM-DD HH:MM:SS' (str)
+    :return: datetime (dt.datetime)
+    """
+    return dt.datetime.strptime(time_str, '%Y-%m-%d %H:%M:%S')
+
+
+def fatal(msg):
+    """
+    Exits with a JULES style fatal error message
+    :param msg: error message (str)
+    :return: n/a
+    """
+    print('[FATAL ERROR] fake_jules: ' + msg)
+    sys.stdout.flush()
+    sys.exit(1)
+
+
+def climate(doy):
+    """
+    Daily climatology driving the model
+    :param doy: days since start of run (arr)
+    :return: air temperature in K, photosynthetically active radiation in MJ m-2 day-1 and precipitation in
+             kg m-2 s-1 (tuple)
+    """
+    season = np.sin(2 * np.pi * (doy - 105.) / 365.)
+    return 283. + 11. * season, 10. + 8. * season, 3e-5 * (1.2 + np.cos(2 * np.pi * doy / 9.7))
+
+
+def run_crop(doy, temp, par, pft, crop, k, c):
+    """
+    Runs a simple daily crop model for a single crop functional type. Development is driven by thermal time, leaf area
+    follows JULES-crop specific leaf area (gamma_io, delta_io) and canopy height the JULES-crop stem allometry
+    (allo1_io, allo2_io)
+    :param doy: days since start of run (arr)
+    :param temp: daily air temperature in K (arr)
+    :param par: daily photosynthetically active radiation in MJ m-2 day-1 (arr)
+    :param pft: jules_pftparm namelist (dict)
+    :param crop: jules_cropparm namelist (dict)
+    :param k: pft index of crop (int)
+    :param c: cpft index of crop (int)
+    :return: dictionary of daily output for crop (dict)
+    """
+    p = {name: as_list(pft[name])[k] for name in ('alpha_io', 'neff_io', 'fd_io', 'canht_ft_io')}
+    p.update({name: as_list(crop[name])[c] for name in ('mu_io', 'nu_io', 'gamma_io', 'delta_io', 't_bse_io',
+                                                          'tt_emr_io', 'allo1_io', 'allo2_io', 'cfrac_l_io',
+                                                          'cfrac_s_io', 'initial_carbon_io', 'yield_frac_io')})
+    n_days = len(doy)
+    out = {name: np.zeros(n_days) for name in ('gpp', 'npp', 'resp_p', 'lai', 'canht', 'cropdvi', 'cropleafc',
+                                                'cropstemc', 'croprootc', 'cropharvc', 'cropreservec', 'cropyield')}
+    tt = 0.
+    dvi = -1.
+    pools = np.zeros(5)  # leaf, stem, root, harvest, reserve
+    lai = 0.
+    for d in range(n_days):
+        if doy[d] % 365 == sow_day[c]:
+            tt = 0.
+            dvi = 0.
+            pools[:] = [0.4, 0.3, 0.3, 0., 0.]
+            pools *= p['initial_carbon_io']
+        if dvi >= 0.:
+            tt += max(temp[d] - p['t_bse_io'], 0.)
+            dvi = min(tt / (10. * p['tt_emr_io']), 2.)
+            sla = p['gamma_io'] * (dvi + 0.06)**p['delta_io']
+            lai = pools[0] / p['cfrac_l_io'] * sla
+            gpp = p['alpha_io'] * 0.03 * par[d] * (1 - np.exp(-0.5 * lai)) * (p['neff_io'] / 5.7e-4)**0.3
+            resp = gpp * (0.25 + 10. * p['fd_io'])
+            npp = max(gpp - resp, 0.)
+            # partition to leaf, stem and root before flowering and increasingly to harvest after
+            f_harv = np.clip(dvi - 1., 0., 1.)
+            f_veg = np.array([0.15 * np.exp(-dvi), 0.1, 0.45 * np.exp(-dvi)])
+            f_veg = (1 - f_harv) * f_veg / f_veg.sum()
+            # a fraction of stem growth goes to the reserve pool, which is remobilised to harvest after flowering
+            f_res = min(p['mu_io'] * p['nu_io'], 0.9)
+            pools[0:3] += npp * f_veg * [1., 1 - f_res, 1.]
+            pools[4] += npp * f_veg[1] * f_res
+            pools[3] += npp * f_harv
+            if dvi > 1.:
+                remob = 0.05 * pools[4]
+                pools[4] -= remob
+                pools[3] += remob
+                # leaf senescence
+                pools[0] *= 0.95
+            out['gpp'][d] = gpp / 86400.
+            out['npp'][d] = npp / 86400.
+            out['resp_p'][d] = resp / 86400.
+            out['lai'][d] = lai
+            out['canht'][d] = p['allo1_io'] * (pools[1] / p['cfrac_s_io'])**p['allo2_io']
+            out['cropdvi'][d] = dvi
+            out['cropleafc'][d], out['cropstemc'][d], out['croprootc'][d] = pools[0:3]
+            out['cropharvc'][d], out['cropreservec'][d] = pools[3:5]
+            out['cropyield'][d] = pools[3] * p['yield_frac_io']
+            if dvi >= 2.:
+                # harvest
+                dvi = -1.
+                pools[:] = 0.
+    return out
+
+
+def run_model(nml_dic, n_days, start):
+    """
+    Runs the model for all plant functional types
+    :param nml_dic: dictionary of nml files (dict)
+    :param n_days: number of days to run for (int)
+    :param start: start of main run (dt.datetime)
+    :return: dictionary of daily output on JULES level dimensions, each with time as the first dimension (dict)
+    """
+    doy = np.arange(n_days) + start.timetuple().tm_yday
+    temp, par, precip = climate(doy)
+    pft = nml_dic['pft_params']['jules_pftparm']
+    crop = nml_dic['crop_params']['jules_cropparm']
+    out = {var: np.zeros((n_days, level_dims[var_levels[var][0]])) for var in var_levels if len(var_levels[var]) == 1}
+    season = np.clip(np.sin(2 * np.pi * (doy - 80.) / 365.), 0., 1.)
+    for k in range(level_dims['pft']):
+        # natural plant functional types have a fixed canopy and a seasonal leaf area
+        alpha = as_list(pft['alpha_io'])[k]
+        out['lai'][:, k] = 1. + 3. * season
+        out['canht'][:, k] = as_list(pft['canht_ft_io'])[k]
+        out['gpp'][:, k] = alpha * 0.03 * par * (1 - np.exp(-0.5 * out['lai'][:, k])) / 86400.
+        out['resp_p'][:, k] = out['gpp'][:, k] * (0.25 + 10. * as_list(pft['fd_io'])[k])
+        out['npp'][:, k] = out['gpp'][:, k] - out['resp_p'][:, k]
+    for c, k in enumerate(crop_pft):
+        crop_out = run_crop(doy, temp, par, pft, crop, k, c)
+        for var in ('gpp', 'npp', 'resp_p', 'lai', 'canht'):
+            out[var][:, k] = crop_out[var]
+        for var in ('cropdvi', 'cropleafc', 'cropstemc', 'croprootc', 'cropharvc', 'cropreservec', 'cropyield'):
+            out[var][:, c] = crop_out[var]
+    out['fsmc'][:] = 0.8 + 0.2 * np.cos(2 * np.pi * doy / 365.)[:, np.newaxis]
+    for var in ('tstar', 't_soil'):
+        out[var][:] = temp[:, np.newaxis]
+    for var in ('le', 'ftl'):
+        out[var][:] = (60. + 50. * season)[:, np.newaxis]
+    out['fqw'][:] = out['le'] / 2.5e6
+    out['smcl'][:] = np.array([[30., 75., 195., 600.]]) * (1. - 0.1 * season[:, np.newaxis])
+    out['precip'] = precip
+    out['latent_heat'] = 60. + 50. * season
+    out['ftl_gb'] = 20. + 30. * season
+    out['t1p5m_gb'] = temp
+    out['qw1'] = 0.005 + 0.004 * season
+    out['resp_s'] = 2e-8 * (1. + season)[:, np.newaxis, np.newaxis]
+    return out
+
+
+def write_output(fname, out, var_names, out_vars, start, n_rec, period, grid):
+    """
+    Writes JULES shaped netCDF output
+    :param fname: file to write (str)
+    :param out: dictionary of daily model output (dict)
+    :param var_names: names to give variables in file (lst)
+    :param out_vars: JULES output variables to write (lst)
+    :param start: start of main run (dt.datetime)
+    :param n_rec: number of output records (int)
+    :param period: output period in seconds (int)
+    :param grid: number of grid points as (ny, nx) (tuple)
+    :return: n/a
+    """
+    dat = nc.Dataset(fname, 'w')
+    dat.createDimension('x', grid[1])
+    dat.createDimension('y', grid[0])
+    for dim, size in level_dims.items():
+        dat.createDimension(dim, size)
+    dat.createDimension('scpool', 1)
+    dat.createDimension('sclayer', 1)
+    dat.createDimension('time', None)
+    dat.createDimension('nt', 2)
+    units = 'seconds since ' + start.strftime('%Y-%m-%d %H:%M:%S')
+    times = period * (np.arange(n_rec) + 1.)
+    time_var = dat.createVariable('time', 'f4', ('time',))
+    time_var.setncatts({'standard_name': 'time', 'long_name': 'Time of data', 'units': units,
+                        'bounds': 'time_bounds', 'calendar': 'standard'})
+    time_var[:] = times
+    bnds = dat.createVariable('time_bounds', 'f4', ('time', 'nt'))
+    bnds[:] = np.column_stack((times - period, times))
+    for name in ('latitude', 'longitude'):
+        var = dat.createVariable(name, 'f4', ('y', 'x'))
+        var.units = 'degrees'
+        var[:] = 0.
+    # map output records on to the daily model output, output periods shorter than a day repeat the daily values
+    day_idx = np.minimum((times - 1) // 86400, len(out['precip']) - 1).astype(int)
+    # vary output slightly between grid points so that points are distinguishable
+    yx_scale = 1. + 0.01 * (np.arange(grid[0])[:, np.newaxis] + np.arange(grid[1])[np.newaxis, :])
+    for var, var_name in zip(out_vars, var_names):
+        if var not in out:
+            fatal('output variable ' + var + ' not available')
+        levels = var_levels.get(var, ())
+        nc_var = dat.createVariable(var_name, 'f4', ('time',) + levels + ('y', 'x'))
+        nc_var.units = var_units.get(var, 'kg m-2')
+        nc_var[:] = out[var][day_idx][..., np.newaxis, np.newaxis] * yx_scale
+    dat.close()
+
+
+def write_dump(fname, out, day):
+    """
+    Writes a dump file of the model state
+    :param fname: file to write (str)
+    :param out: dictionary of daily model output (dict)
+    :param day: index of day to write state for (int)
+    :return: n/a
+    """
+    dat = nc.Dataset(fname, 'w')
+    for dim, size in level_dims.items():
+        dat.createDimension(dim, size)
+    dat.createDimension('land', 1)
+    for var in ('canht', 'lai', 'smcl', 't_soil', 'cropdvi', 'cropleafc', 'cropstemc', 'croprootc', 'cropharvc',
+                'cropreservec'):
+        nc_var = dat.createVariable(var, 'f8', var_levels[var] + ('land',))
+        nc_var[:] = out[var][day][:, np.newaxis]
+    dat.close()
+
+
+def main():
+    t_start = time.time()
+    nml_dic = read_nml()
+    for filename in ('output', 'timesteps', 'pft_params', 'crop_params'):
+        if filename not in nml_dic:
+            fatal('could not find ' + filename + '.nml in ' + os.getcwd())
+    if np.random.uniform() < float(os.environ.get('FAKE_JULES_FAIL_RATE', 0.)):
+        fatal('random failure')
+    output = nml_dic['output']['jules_output']
+    out_dir = output['output_dir']
+    run_id = output['run_id']
+    if not os.path.isdir(out_dir):
+        fatal('output directory ' + out_dir + ' does not exist')
+    initial = nml_dic.get('initial_conditions', {}).get('jules_initial', {})
+    if initial.get('dump_file', False) and not os.path.exists(initial['file']):
+        fatal('initial conditions dump file ' + initial['file'] + ' does not exist')
+    timesteps = nml_dic['timesteps']
+    start = parse_time(timesteps['jules_time']['main_run_start'])
+    end = parse_time(timesteps['jules_time']['main_run_end'])
+    run_secs = (end - start).total_seconds()
+    n_days = int(np.ceil(run_secs / 86400.))
+    grid = tuple(int(n) for n in os.environ.get('FAKE_JULES_GRID', '1,1').split(','))
+    spin_cycles = timesteps.get('jules_spinup', {}).get('max_spinup_cycles', 0)
+    for cycle in range(spin_cycles):
+        print('[INFO] fake_jules: spin-up cycle ' + str(cycle + 1))
+    print('[INFO] fake_jules: running ' + run_id + ' for ' + str(n_days) + ' days')
+    sys.stdout.flush()
+    out = run_model(nml_dic, n_days, start)
+    write_dumps = os.environ.get('FAKE_JULES_DUMP', '1') != '0'
+    if write_dumps:
+        # JULES writes a dump at the start of the main run
+        write_dump(os.path.join(out_dir, run_id + '.dump.' + start.strftime('%Y%m%d') + '.' +
+                                str(start.hour * 3600 + start.minute * 60) + '.nc'), out, 0)
+    profiles = as_list(nml_dic['output'].get('jules_output_profile', []))
+    for profile in profiles[:output.get('nprofiles', len(profiles))]:
+        if not profile.get('output_main_run', True):
+            continue
+        out_vars = as_list(profile['var'])
+        var_names = as_list(profile.get('var_name', out_vars))
+        period = profile.get('output_period', 86400)
+        n_rec = int(run_secs // period)
+        write_output(os.path.join(out_dir, run_id + '.' + profile['profile_name'] + '.nc'), out, var_names,
+                     out_vars, start, n_rec, period, grid)
+    if write_dumps:
+        write_dump(os.path.join(out_dir, run_id + '.dump.' + end.strftime('%Y%m%d') + '.' +
+                                str(end.hour * 3600 + end.minute * 60) + '.nc'), out, n_days - 1)
+    time.sleep(max(float(os.environ.get('FAKE_JULES_RUNTIME', 0.)) - (time.time() - t_start), 0.))
+    print('[INFO] fake_jules: run completed')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,14 @@
+# core python modules:
+import tempfile
 # 3rd party modules:
 import numpy as np
 import scipy.optimize as spop
-import scipy.linalg as splinal
 # local modules:
 import experiment_setup as es
+import instrument
+import obs_error
+import param_space
+import sampling
 
 
 class FourDEnVar:
@@ -12,31 +17,48 @@ class FourDEnVar:
     :param assim: switch to create matrices necessary for running data assimilation routines (bool)
     :param run_xb: switch to run JULES for the prior values specified in experiment_setup module (bool)
     :param seed_val: seed value to use in any random drawing within class (int)
+    :param size_ens: size of ensemble, default es.ensemble_size (int)
+    :param design: design used to draw prior ensemble, default es.ensemble_design (str)
+    :param p_dict: dictionary of parameters to optimise, default es.opt_params (dict)
+    :param obs_dic: dictionary of observations and observation errors, default es.obs_fn() (dict)
+    :param prior_err: relative error on prior parameter estimates, default es.prior_err (float)
+    :param dtype: data type of ensemble matrices in observation space, default es.ensemble_dtype (str)
+    :param mmap_dir: directory for memory mapped ensemble matrices in observation space, None to hold them in memory,
+                     default es.ensemble_mmap_dir (str)
+    :param transform: switch to work with log and logit transformed parameters, see param_space.ParamSpace, in which
+                      case parameter vectors of the class are transformed and to_model gives the JULES parameter values,
+                      default es.transform_params (bool)
     """
-    def __init__(self, assim=False, seed_val=es.seed_value):
+    def __init__(self, assim=False, seed_val=es.seed_value, size_ens=None, design=None, p_dict=None, obs_dic=None,
+                 prior_err=None, dtype=None, mmap_dir=None, transform=None):
         # set parameters to optimize and prior values
-        self.p_dict = es.opt_params
-        self.p_keys = []
-        self.xb = []
-        self. val_bnds = []
-        for filename in self.p_dict.keys():
-            for nml in self.p_dict[filename].keys():
-                for param in self.p_dict[filename][nml].keys():
-                    self.p_keys.append(param)
-                    self.xb.append(self.p_dict[filename][nml][param][1])
-                    self.val_bnds.append(self.p_dict[filename][nml][param][2])
-        self.xb = np.array(self.xb)
+        self.p_dict = es.opt_params if p_dict is None else p_dict
+        self.space = param_space.default_space() if p_dict is None else param_space.ParamSpace(p_dict)
+        self.transform = es.transform_params if transform is None else transform
+        self.p_keys = list(self.space.names)
+        if self.transform is True:
+            self.xb = self.space.to_unbounded(self.space.xb)
+            self.val_bnds = self.space.unbounded_bnds()
+        else:
+            self.xb = self.space.xb.copy()
+            self.val_bnds = self.space.val_bnds
 
         # Set ensemble size and seed value
-        self.size_ens = es.ensemble_size
+        self.size_ens = es.ensemble_size if size_ens is None else size_ens
         self.seed_val = seed_val
+        self.design = es.ensemble_design if design is None else design
+        self.dtype = np.dtype(es.ensemble_dtype if dtype is None else dtype)
+        self.mmap_dir = es.ensemble_mmap_dir if mmap_dir is None else mmap_dir
 
         # set prior error and generate prior ensemble
-        self.prior_err = es.prior_err
-        self.xb_sd = self.xb * self.prior_err
+        self.prior_err = es.prior_err if prior_err is None else prior_err
+        self.xb_sd = np.abs(self.space.xb * self.prior_err)
+        if self.transform is True:
+            # prior standard deviations of the transformed parameters, linearised around the prior
+            self.xb_sd = self.xb_sd * self.space.jacobian(self.space.xb)
         self.b_mat = np.eye(len(self.xb))*((self.xb_sd)**2)
         self.xbs = self.generate_param_ens(self.size_ens)
-        self.make_obs()
+        self.make_obs(obs_dic)
 
         # create necessary matrices for running data assimilation routine if specified to at instantiation of JulesDA
         # class
@@ -45,24 +67,125 @@ class FourDEnVar:
             self.make_hxb()
             self.create_ensemble()
 
-    def make_obs(self):
+    def to_model(self, xvals):
+        """
+        Maps parameter vectors of the class to the parameter values to run JULES with, undoing any transform
+        :param xvals: parameter vector or ensemble of parameter vectors, one per row (arr)
+        :return: parameter values (arr)
+        """
+        if self.transform is True:
+            return self.space.to_model(xvals)
+        return np.asarray(xvals)
+
+    def make_obs(self, obs_dic=None):
         # extract observations using function specified in experiment_setup module
-        obs_dic = es.obs_fn()
+        if obs_dic is None:
+            obs_dic = es.obs_fn()
+        self.obs_dic = obs_dic
         self.yoblist = np.concatenate(obs_dic['obs'])
         self.yerr = np.concatenate(obs_dic['obs_err'])
-        self.rmatrix = np.eye(len(self.yerr))*self.yerr**2
+        # observation error covariance matrix, diagonal matrices are stored as a vector of variances
+        self.r_cov = obs_error.obs_cov(obs_dic)
 
-    def make_hxb(self):
-        # creates hxb and Xb ensemble matrix given function in experiment_setup module
-        hxb_dic = es.jules_hxb()
-        self.hxb = np.concatenate(hxb_dic['obs'])
-        self.xb_mat = (1./(np.sqrt(self.size_ens-1)))*np.array([xbi - self.xb for xbi in self.xbs])
+    @property
+    def rmatrix(self):
+        """
+        Observation error covariance matrix as a dense array, formed on request as it is n_obs x n_obs
+        :return: observation error covariance matrix (arr)
+        """
+        return self.r_cov.dense()
+
+    def whiten_obs(self, obs_arr):
+        """
+        Applies the inverse square root of the observation error covariance matrix to observation space vectors
+        :param obs_arr: observation space vector or matrix with observations along the first axis (arr)
+        :return: whitened vector or matrix, L^-1 obs_arr with R = L L^T (arr)
+        """
+        return self.r_cov.whiten(obs_arr)
+
+    def ens_array(self, shape):
+        """
+        Allocates an ensemble matrix in observation space with the data type of the instance, memory mapped to an
+        anonymous file in mmap_dir if set so that it is freed once no longer referenced
+        :param shape: shape of array (tuple)
+        :return: uninitialised array (arr)
+        """
+        if self.mmap_dir is None:
+            return np.empty(shape, dtype=self.dtype)
+        return np.memmap(tempfile.TemporaryFile(dir=self.mmap_dir), dtype=self.dtype, mode='w+', shape=shape)
+
+    def block_rows(self, n_rows, n_cols):
+        """
+        Splits the rows of an observation space matrix into blocks of about es.block_bytes
+        :param n_rows: number of rows (int)
+        :param n_cols: number of columns (int)
+        :return: list of (start, stop) row indices (lst)
+        """
+        step = max(int(es.block_bytes // (8 * max(n_cols, 1))), 1)
+        return [(i, min(i + step, n_rows)) for i in range(0, n_rows, step)]
+
+    def make_hxb(self, hxb=None):
+        # creates hxb and Xb ensemble matrix given function in experiment_setup module, unless hxb is given
+        if hxb is None:
+            hxb = np.concatenate(es.jules_hxb()['obs'])
+        self.hxb = hxb
+        self.xb_mat = (1./(np.sqrt(self.size_ens-1)))*(self.xbs - self.xb)
         self.xb_mat_inv = np.linalg.pinv(self.xb_mat.T)
 
-    def create_ensemble(self):
-        # creates HMXb matrix using function to extract modelled observations in experiment_setup module
-        self.hm_xbs = es.jules_hxb_ens()
-        self.hmx_mat = (1. / (np.sqrt(self.size_ens - 1))) * np.array([hmxb - self.hxb for hmxb in self.hm_xbs])
+    def create_ensemble(self, hm_xbs=None):
+        # creates HMXb matrix using function to extract modelled observations in experiment_setup module, unless
+        # hm_xbs is given
+        if hm_xbs is None:
+            hm_xbs = es.jules_hxb_ens() if self.mmap_dir is None else es.jules_hxb_ens(mmap=True)
+        self.hm_xbs = hm_xbs
+        self.whiten_ensemble(self.whiten_perturbations(self.hm_xbs, self.hxb, 1. / np.sqrt(self.size_ens - 1)))
+
+    def whiten_perturbations(self, hm_xs, hx, scale):
+        """
+        Forms the whitened ensemble perturbation matrix R^-1/2 HMXb, with HMXb^T = scale * (hm_xs - hx), in blocks of
+        members. Only a block of members is ever held in double precision and the ensemble of modelled observations
+        (e.g. a memory map from the extraction stage) is never copied in full
+        :param hm_xs: ensemble of modelled observations, one member per row (arr)
+        :param hx: modelled observations to take perturbations from (arr)
+        :param scale: scalar or vector of factors for each member (arr)
+        :return: whitened perturbation matrix, one member per column (arr)
+        """
+        scale = np.broadcast_to(np.asarray(scale, dtype=float), (len(hm_xs),))
+        hmx_mat_w = self.ens_array((len(hx), len(hm_xs)))
+        for i0, i1 in self.block_rows(len(hm_xs), len(hx)):
+            hmx_mat_w[:, i0:i1] = self.whiten_obs((scale[i0:i1, np.newaxis] *
+                                                   (np.asarray(hm_xs[i0:i1], dtype=float) - hx)).T)
+        return hmx_mat_w
+
+    def whiten_ensemble(self, hmx_mat_w, gram_ens_inc=None):
+        """
+        Precomputes the whitened innovation R^-1/2 (hxb - y) and the ensemble space projections of the whitened
+        perturbation matrix so that the cost function and its gradient only need a single (N_ens x N_ens) matrix
+        vector product
+        :param hmx_mat_w: whitened perturbation matrix R^-1/2 HMXb, see whiten_perturbations (arr)
+        :param gram_ens_inc: Gram matrix of the whitened perturbation matrix if already known, e.g. from an
+                             EnsembleStream (arr)
+        :return: n/a
+        """
+        n_obs = len(self.yoblist)
+        self.hmx_mat_w = hmx_mat_w
+        self.innov_w = self.whiten_obs(self.hxb - self.yoblist)
+        # accumulate ensemble space projections over blocks of observations in double precision
+        self.grad0_ens_inc = np.zeros(self.size_ens)
+        gram = np.zeros((self.size_ens, self.size_ens)) if gram_ens_inc is None else gram_ens_inc
+        for i0, i1 in self.block_rows(n_obs, self.size_ens):
+            block = np.asarray(self.hmx_mat_w[i0:i1], dtype=float)
+            if gram_ens_inc is None:
+                gram += np.dot(block.T, block)
+            self.grad0_ens_inc += np.dot(block.T, self.innov_w[i0:i1])
+        self.gram_ens_inc = gram
+        self.innov_cost = np.dot(self.innov_w, self.innov_w)
+        self.hess_ens_inc = np.eye(self.size_ens) + self.gram_ens_inc
+        self._hess_eig = None
+        self._a_cov = None
+        self._pa_cov = None
+        self._w_buf = np.empty(self.size_ens)
+        self._g_buf = np.empty(self.size_ens)
 
     def xvals2wvals(self, xvals):
         """
@@ -86,8 +209,8 @@ class FourDEnVar:
         :param wvals: array of ensemble weights, w
         :return: value of the observation part of cost function as float
         """
-        return np.dot(np.dot((np.dot(self.hmx_mat.T, wvals) + self.hxb - self.yoblist), np.linalg.inv(self.rmatrix)),
-                      (np.dot(self.hmx_mat.T, wvals) + self.hxb - self.yoblist).T)
+        np.dot(self.gram_ens_inc, wvals, out=self._w_buf)
+        return np.dot(wvals, self._w_buf) + 2. * np.dot(self.grad0_ens_inc, wvals) + self.innov_cost
 
     def cost_ens_inc(self, wvals):
         """
@@ -106,19 +229,30 @@ class FourDEnVar:
         :param wvals: array of ensemble weights, w
         :return: vector of the gradient of the cost function as array
         """
-        obcost = np.dot(self.hmx_mat, np.dot(np.linalg.inv(self.rmatrix),
-                                           (np.dot(self.hmx_mat.T, wvals) + self.hxb - self.yoblist).T))
-        gradcost = obcost + wvals  # + bnd_cost
-        return gradcost
+        np.dot(self.gram_ens_inc, wvals, out=self._g_buf)
+        self._g_buf += self.grad0_ens_inc
+        self._g_buf += wvals  # + bnd_cost
+        # fmin_ncg keeps gradients across its line searches, so the buffer is copied rather than returned
+        return self._g_buf.copy()
+
+    def hesscost_ens_inc(self, wvals):
+        """
+        Calculates the Hessian of the 4DEnVar cost function, which is constant as the cost function is quadratic in w
+        :param wvals: array of ensemble weights, w
+        :return: Hessian of the cost function as array
+        """
+        return self.hess_ens_inc
 
     def a_cov(self):
         """
-        Calculates the analysis (posterior) error covariance matrix
+        Calculates the analysis (posterior) error covariance matrix square root in ensemble space,
+        (I + HMXb^T R^-1 HMXb)^-1/2, from the cached eigendecomposition of the Hessian
         :return: analysis error covariance matrix as array
         """
-        a_cov = np.linalg.inv(splinal.sqrtm(np.eye(self.size_ens) + np.dot(self.hmx_mat,
-                        np.dot(np.linalg.inv(self.rmatrix), self.hmx_mat.T))))
-        return a_cov
+        if self._a_cov is None:
+            eigvals, eigvecs = self.hess_eig()
+            self._a_cov = np.dot(eigvecs / np.sqrt(eigvals), eigvecs.T)
+        return self._a_cov
 
     def a_ens(self, xa):
         """
@@ -126,21 +260,170 @@ class FourDEnVar:
         :param xa: posterior parameter vector as array
         :return: posterior parameter ensemble as array
         """
-        a_cov = self.a_cov()
-        xa_mat = np.dot(self.xb_mat.T, a_cov).T
-        a_ens = np.array([(xa + np.sqrt(self.size_ens-1)*xbi).real for xbi in xa_mat])
-        return a_ens
+        return xa + np.sqrt(self.size_ens - 1) * np.dot(self.a_cov(), self.xb_mat)
+
+    def pa_cov(self):
+        """
+        Calculates the analysis (posterior) parameter error covariance matrix, Xb (I + HMXb^T R^-1 HMXb)^-1 Xb^T
+        :return: posterior parameter error covariance matrix as array
+        """
+        if self._pa_cov is None:
+            eigvals, eigvecs = self.hess_eig()
+            xa_mat = np.dot(eigvecs.T, self.xb_mat) / np.sqrt(eigvals)[:, np.newaxis]
+            self._pa_cov = np.dot(xa_mat.T, xa_mat)
+        return self._pa_cov
+
+    def xa_sd(self):
+        """
+        Calculates the marginal standard deviations of the posterior parameter distribution
+        :return: posterior parameter standard deviations as array
+        """
+        return np.sqrt(np.diag(self.pa_cov()))
+
+    def hess_eig(self):
+        """
+        Calculates the symmetric eigendecomposition of the Hessian of the 4DEnVar cost function,
+        I + HMXb^T R^-1 HMXb. The decomposition is cached so that it is only computed once per ensemble
+        :return: eigenvalues and eigenvectors of the Hessian as a tuple of arrays
+        """
+        if getattr(self, '_hess_eig', None) is None:
+            self._hess_eig = np.linalg.eigh(self.hess_ens_inc)
+        return self._hess_eig
+
+    def direct_min_ens_inc(self):
+        """
+        Finds the minimum of the 4DEnVar cost function in closed form. As the cost function is quadratic in the ensemble
+        weights the minimum and the posterior ensemble both follow from a single eigendecomposition of the Hessian
+        :return: ensemble weights, posterior parameter vector and posterior parameter ensemble as a tuple of arrays
+        """
+        eigvals, eigvecs = self.hess_eig()
+        wvals = -np.dot(eigvecs, np.dot(eigvecs.T, self.grad0_ens_inc) / eigvals)
+        xa = self.wvals2xvals(wvals)
+        return wvals, xa, self.a_ens(xa)
 
-    def find_min_ens_inc(self, dispp=5):
+    def find_min_ens_inc(self, dispp=5, method='ncg'):
         """
-        Function minimises the 4DEnVar cost function using a newton conjugate gradient method
+        Function minimises the 4DEnVar cost function using a newton conjugate gradient method or directly from the
+        eigendecomposition of the Hessian
         :param dispp: amount of information to be printed to command line (int)
+        :param method: minimisation method, either 'ncg' (scipy.optimize.fmin_ncg) or 'direct' (str)
         :return: output of minimization as a tuple and posterior parameter vector as array
         """
-        wvals = self.xvals2wvals(self.xb)
-        find_min = spop.fmin_ncg(self.cost_ens_inc, wvals, fprime=self.gradcost_ens_inc, disp=dispp, full_output=1,
-                                 maxiter=20000)
-        xa = self.wvals2xvals(find_min[0])
+        with instrument.span('find_min_ens_inc', method=method, size_ens=self.size_ens,
+                             n_obs=len(self.yoblist)) as sp:
+            if method == 'direct':
+                wvals, xa, xa_ens = self.direct_min_ens_inc()
+                # match the output of fmin_ncg (xopt, fopt, fcalls, gcalls, hcalls, warnflag)
+                find_min = (wvals, self.cost_ens_inc(wvals), 0, 0, 0, 0)
+            elif method == 'ncg':
+                wvals = self.xvals2wvals(self.xb)
+                find_min = spop.fmin_ncg(self.cost_ens_inc, wvals, fprime=self.gradcost_ens_inc,
+                                         fhess=self.hesscost_ens_inc, disp=dispp, full_output=1, maxiter=20000)
+                xa = self.wvals2xvals(find_min[0])
+            else:
+                raise ValueError('Unknown minimisation method: ' + str(method))
+            sp.update({'cost': float(find_min[1]), 'fcalls': int(find_min[2]), 'gcalls': int(find_min[3]),
+                       'hcalls': int(find_min[4]), 'warnflag': int(find_min[5])})
+        return find_min, xa
+
+    def recentre_ens(self, x_centre, scale=1.):
+        """
+        Creates an ensemble centred on a parameter vector from the prior ensemble perturbations, used to relinearise
+        the model in the outer loops of outer_loop_min_ens_inc. Perturbations that would take a member outside the
+        parameter bounds are reflected through the centre, any member still outside the bounds is clipped to them
+        :param x_centre: parameter vector to centre ensemble on (arr)
+        :param scale: factor to scale the prior ensemble perturbations by (float)
+        :return: ensemble of parameter vectors (arr) and sign of each member perturbation (arr)
+        """
+        perts = scale * (self.xbs - self.xb)
+        signs = np.where(sampling.in_bnds(x_centre + perts, self.val_bnds) |
+                         ~sampling.in_bnds(x_centre - perts, self.val_bnds), 1., -1.)
+        x_ens = x_centre + signs[:, np.newaxis] * perts
+        bnds = np.asarray(self.val_bnds, dtype=float)
+        return np.clip(x_ens, bnds[:, 0], bnds[:, 1]), signs
+
+    def relinearise(self, hx, hm_xs, signs, scale=1.):
+        """
+        Replaces the modelled observations of the prior and its ensemble with those of an ensemble created by
+        recentre_ens, so that HMXb approximates the model linearised around the new centre
+        :param hx: modelled observations for the centre of the ensemble (arr)
+        :param hm_xs: ensemble of modelled observations, one member per row (arr)
+        :param signs: sign of each member perturbation as returned by recentre_ens (arr)
+        :param scale: factor the prior ensemble perturbations were scaled by in recentre_ens (float)
+        :return: n/a
+        """
+        self.hxb = np.asarray(hx)
+        self.hm_xbs = hm_xs
+        self.whiten_ensemble(self.whiten_perturbations(self.hm_xbs, self.hxb,
+                                                       signs / (scale * np.sqrt(self.size_ens - 1))))
+
+    def outer_loop_min_ens_inc(self, run_fn, max_outer=5, tol=0.01, scale=1., w0=None):
+        """
+        Minimises the 4DEnVar cost function with outer loops of a Gauss-Newton iteration in ensemble space. Each outer
+        loop after the first recentres the prior ensemble perturbations on the current estimate, runs the model for
+        the new ensemble and its centre with run_fn and takes a step from the Hessian of the relinearised problem. If
+        the cost at the new estimate increases the step is halved, if the last outer loop ends on such a step the best
+        estimate the model was run for is returned with its cost. Unless starting weights w0 are given the first outer
+        loop uses the prior ensemble if create_ensemble has been called, so with max_outer=1 this is the same as
+        find_min_ens_inc(method='direct')
+        :param run_fn: function returning the modelled observations for an ensemble of parameter values (see to_model),
+                       one member per row, with the centre of the ensemble as the first row (func)
+        :param max_outer: maximum number of outer loops, at least 1 (int)
+        :param tol: largest change in any parameter between outer loops, as a fraction of its prior standard deviation,
+                    at which to stop (float)
+        :param scale: factor to scale the ensemble perturbations by when relinearising, values below 1 give a more
+                      local linearisation (float)
+        :param w0: ensemble weights to start from, e.g. from an emulator warm start, default the prior (arr)
+        :return: output of minimization as a tuple, as find_min_ens_inc with the number of outer loops in place of the
+                 number of function calls, and posterior parameter vector as array
+        """
+        if max_outer < 1:
+            raise ValueError('max_outer must be at least 1, got ' + str(max_outer))
+        with instrument.span('outer_loop_min_ens_inc', size_ens=self.size_ens, max_outer=max_outer) as sp:
+            wvals = np.zeros(self.size_ens) if w0 is None else np.asarray(w0, dtype=float)
+            w_best = step = best = None
+            cost_best = np.inf
+            rejected = False
+            self.outer_history = []
+            for k in range(max_outer):
+                xvals = self.wvals2xvals(wvals)
+                if k > 0 or w0 is not None or getattr(self, 'hmx_mat_w', None) is None:
+                    x_ens, signs = self.recentre_ens(xvals, scale)
+                    hx_ens = np.asarray(run_fn(self.to_model(np.vstack([xvals, x_ens]))))
+                    self.relinearise(hx_ens[0], hx_ens[1:], signs, scale)
+                cost = 0.5 * np.dot(wvals, wvals) + 0.5 * self.innov_cost
+                self.outer_history.append({'outer_loop': k, 'cost': float(cost), 'xvals': xvals.tolist()})
+                if cost > cost_best:
+                    # step overshot the minimum, halve it from the best estimate
+                    step = 0.5 * step
+                    wvals = w_best + step
+                    rejected = True
+                    continue
+                w_best, cost_best = wvals, cost
+                rejected = False
+                best = (self.hxb, self.hm_xbs, self.hmx_mat_w)
+                eigvals, eigvecs = self.hess_eig()
+                step = -np.dot(eigvecs, np.dot(eigvecs.T, wvals + self.grad0_ens_inc) / eigvals)
+                x_new = self.wvals2xvals(wvals + step)
+                if self.test_bnds(x_new) is False:
+                    bnds = np.asarray(self.val_bnds, dtype=float)
+                    step = self.xvals2wvals(np.clip(x_new, bnds[:, 0], bnds[:, 1])) - wvals
+                wvals = wvals + step
+                if np.max(np.abs(np.dot(step, self.xb_mat)) / self.xb_sd) < tol:
+                    break
+            if rejected is True:
+                # the halved step has not been run with the model, fall back to the best estimate
+                wvals = w_best
+            if self.hmx_mat_w is not best[2]:
+                # keep the linearisation of the best estimate for the posterior ensemble
+                self.hxb, self.hm_xbs = best[:2]
+                self.whiten_ensemble(best[2])
+            xa = self.wvals2xvals(wvals)
+            # cost of the model linearised around the best estimate, equal to cost_best if wvals is the best estimate
+            cost = 0.5 * np.dot(wvals, wvals) + 0.5 * self.obcost_ens_inc(wvals - w_best)
+            find_min = (wvals, cost, len(self.outer_history), 0, 0, 0)
+            sp.update({'cost': float(find_min[1]), 'outer_loops': len(self.outer_history),
+                       'outer_costs': [hist['cost'] for hist in self.outer_history]})
         return find_min, xa
 
     def test_bnds(self, xbi):
@@ -149,35 +432,21 @@ class FourDEnVar:
         :param xbi: parameter vector to test as an array
         :return: Bool
         """
-        for xi in enumerate(xbi):
-            if self.val_bnds[xi[0]][0] <= xi[1] <= self.val_bnds[xi[0]][1]:
-                continue
-            else:
-                return False
-        return True
+        return bool(sampling.in_bnds(xbi, self.val_bnds)[0])
 
-    def generate_param_ens(self, size_ens, x=None):
+    def generate_param_ens(self, size_ens, x=None, design=None):
         """
         Generates a ensemble of parameter vectors given a mean (self.xb) and covariance matrix (self.b_mat)
         :param size_ens: size of ensemble to generate as int
         :param x: mean of distribution to draw from as array, default self.xb
+        :param design: sampling design as str, see sampling.bounded_ens, default self.design
         :return: ensemble of parameter vectors as array
         """
-        ens = []
-        i = 0
         if x is None:
             x = self.xb
-        else:
-            x = x
-        np.random.seed(self.seed_val)
-        while len(ens) < size_ens:
-            xbi = np.random.multivariate_normal(x, self.b_mat)
-            i += 1
-            if self.test_bnds(xbi) is True:
-                ens.append(xbi)
-            else:
-                continue
-        return np.array(ens)
+        if design is None:
+            design = self.design
+        return sampling.bounded_ens(x, self.b_mat, size_ens, self.val_bnds, seed_val=self.seed_val, design=design)
 
     def perturb_true_state(self, x_truth, err=0.05):
         """
@@ -187,12 +456,146 @@ class FourDEnVar:
         :param err: error with which to perturb paramters as float, default 5% (0.05)
         :return: perturbed paramter vector as array
         """
-        i = 0
-        np.random.seed(self.seed_val)
-        while i < 1:
-            xbi = np.random.multivariate_normal(x_truth, (err*self.x_true)**2 * np.eye(len(self.x_true)))
-            if self.test_bnds(xbi) is True:
-                i += 1
-            else:
-                continue
-        return np.array(xbi)
+        return sampling.bounded_ens(x_truth, (err*x_truth)**2 * np.eye(len(x_truth)), 1, self.space.val_bnds,
+                                    seed_val=self.seed_val, design='truncnorm')[0]
+
+
+class EnsembleStream:
+    """
+    Incremental 4DEnVar analysis of a prior ensemble whose members arrive one at a time, e.g. as JULES runs finish. As
+    each member arrives its whitened perturbation is appended to R^-1/2 HMXb and the Gram matrix HMXb^T R^-1 HMXb is
+    extended by one row and column, so adding a member costs O(n_obs N_ens) instead of reforming the ensemble. The
+    posterior estimate and spread of the members received so far come from the eigendecomposition of the
+    (N_ens x N_ens) Hessian
+    :param jda: FourDEnVar instance with its prior ensemble drawn and hxb set by make_hxb, the number of members drawn
+                is the largest ensemble that can be streamed (obj)
+    """
+    def __init__(self, jda):
+        self.jda = jda
+        n_max = len(jda.xbs)
+        n_obs = len(jda.yoblist)
+        self.innov_w = jda.whiten_obs(jda.hxb - jda.yoblist)
+        # unscaled whitened perturbations, their Gram matrix and projection of the innovation, members in arrival order
+        self.pert_w = jda.ens_array((n_obs, n_max))
+        self.gram = np.empty((n_max, n_max))
+        self.grad0 = np.empty(n_max)
+        self.hm_xs = jda.ens_array((n_max, n_obs))
+        self.members = []
+        self.history = []
+
+    def add(self, num, hx):
+        """
+        Adds an ensemble member to the analysis
+        :param num: number of member in the prior ensemble, jda.xbs (int)
+        :param hx: modelled observations of member (arr)
+        :return: n/a
+        """
+        n = len(self.members)
+        self.hm_xs[n] = hx
+        pert_w = self.jda.whiten_obs(np.asarray(hx, dtype=float) - self.jda.hxb)
+        self.pert_w[:, n] = pert_w
+        self.gram[n, :n] = np.dot(pert_w, self.pert_w[:, :n])
+        self.gram[:n, n] = self.gram[n, :n]
+        self.gram[n, n] = np.dot(pert_w, pert_w)
+        self.grad0[n] = np.dot(pert_w, self.innov_w)
+        self.members.append(num)
+
+    def estimate(self):
+        """
+        Finds the posterior parameter vector and the posterior standard deviations from the members received so far
+        :return: posterior parameter vector and posterior standard deviations as a tuple of arrays
+        """
+        n = len(self.members)
+        scale = 1. / np.sqrt(n - 1)
+        eigvals, eigvecs = np.linalg.eigh(np.eye(n) + scale**2 * self.gram[:n, :n])
+        wvals = -np.dot(eigvecs, np.dot(eigvecs.T, scale * self.grad0[:n]) / eigvals)
+        xb_mat = scale * (self.jda.xbs[self.members] - self.jda.xb)
+        xa_mat = np.dot(eigvecs.T, xb_mat) / np.sqrt(eigvals)[:, np.newaxis]
+        return self.jda.xb + np.dot(wvals, xb_mat), np.sqrt(np.sum(xa_mat**2, axis=0))
+
+    def converged(self, tol=0.005, min_size=20, patience=10):
+        """
+        Updates the posterior estimate and tests if it has stabilised, i.e. if for each of the last patience members
+        added no parameter estimate has moved by more than tol prior standard deviations and no posterior standard
+        deviation has changed by more than a fraction tol
+        :param tol: tolerance on change in posterior estimate and spread between members (float)
+        :param min_size: smallest ensemble size at which to test for convergence (int)
+        :param patience: number of consecutive members that must each change the posterior by less than tol (int)
+        :return: Bool
+        """
+        if len(self.members) < 2:
+            return False
+        xa, xa_sd = self.estimate()
+        change = np.inf
+        if len(self.history) > 0:
+            xa_prev, xa_sd_prev = self.history[-1]['xa'], self.history[-1]['xa_sd']
+            change = max(np.max(np.abs(xa - xa_prev) / self.jda.xb_sd), np.max(np.abs(xa_sd / xa_sd_prev - 1.)))
+        self.history.append({'size_ens': len(self.members), 'xa': xa, 'xa_sd': xa_sd, 'change': change})
+        if len(self.members) < min_size or len(self.history) < patience:
+            return False
+        return all(rec['change'] < tol for rec in self.history[-patience:])
+
+    def finish(self):
+        """
+        Sets up the FourDEnVar instance for the ensemble of members received, reusing the whitened perturbations and
+        Gram matrix so that the ensemble does not need to be formed again
+        :return: FourDEnVar instance ready for running data assimilation routines (obj)
+        """
+        jda = self.jda
+        n = len(self.members)
+        scale = 1. / np.sqrt(n - 1)
+        jda.size_ens = n
+        jda.xbs = jda.xbs[self.members]
+        jda.make_hxb(jda.hxb)
+        jda.hm_xbs = self.hm_xs[:n]
+        hmx_mat_w = jda.ens_array((len(jda.yoblist), n))
+        for i0, i1 in jda.block_rows(len(jda.yoblist), n):
+            hmx_mat_w[i0:i1] = scale * self.pert_w[i0:i1, :n]
+        jda.whiten_ensemble(hmx_mat_w=hmx_mat_w, gram_ens_inc=scale**2 * self.gram[:n, :n])
+        return jda
+
+
+def stack_problems(jdas):
+    """
+    Stacks the ensemble space Hessians, gradients at the prior and prior ensembles of several FourDEnVar instances so
+    that they can be solved together with batch_min_ens_inc. Only the (N_ens x N_ens) projections are stacked, not the
+    whitened perturbation matrices. All instances must have the same ensemble size and number of parameters and must
+    have had create_ensemble called
+    :param jdas: list of K FourDEnVar instances (lst)
+    :return: stacked Hessians I + HMXb^T R^-1 HMXb (K x N_ens x N_ens), gradients HMXb^T R^-1 (hxb - y) (K x N_ens),
+             xb (K x n_param) and Xb (K x N_ens x n_param) as a tuple of arrays
+    """
+    return (np.stack([jda.hess_ens_inc for jda in jdas]), np.stack([jda.grad0_ens_inc for jda in jdas]),
+            np.stack([jda.xb for jda in jdas]), np.stack([jda.xb_mat for jda in jdas]))
+
+
+def batch_min_ens_inc(hess_ens_inc, grad0_ens_inc, xb, xb_mat):
+    """
+    Finds the minimum of the 4DEnVar cost function and the posterior ensemble for K independent problems with the same
+    ensemble size in a single call. The problems are solved in closed form as in FourDEnVar.direct_min_ens_inc, with
+    the Hessians of all problems eigendecomposed as one stacked array
+    :param hess_ens_inc: stacked Hessians I + HMXb^T R^-1 HMXb (K x N_ens x N_ens) (arr)
+    :param grad0_ens_inc: stacked gradients at the prior HMXb^T R^-1 (hxb - y) (K x N_ens) (arr)
+    :param xb: stacked prior parameter vectors (K x n_param) (arr)
+    :param xb_mat: stacked prior ensemble perturbation matrices Xb (K x N_ens x n_param) (arr)
+    :return: stacked ensemble weights (K x N_ens), posterior parameter vectors (K x n_param) and posterior parameter
+             ensembles (K x N_ens x n_param) as a tuple of arrays
+    """
+    size_ens = hess_ens_inc.shape[1]
+    eigvals, eigvecs = np.linalg.eigh(hess_ens_inc)
+    wvals = -np.einsum('knm,km->kn', eigvecs, np.einsum('knm,kn->km', eigvecs, grad0_ens_inc) / eigvals)
+    xa = xb + np.einsum('kn,knp->kp', wvals, xb_mat)
+    a_cov = np.matmul(eigvecs / np.sqrt(eigvals)[:, np.newaxis, :], np.transpose(eigvecs, (0, 2, 1)))
+    xa_ens = xa[:, np.newaxis, :] + np.sqrt(size_ens - 1) * np.matmul(a_cov, xb_mat)
+    return wvals, xa, xa_ens
+
+
+def batch_find_min(jdas):
+    """
+    Finds the posterior estimates and ensembles for several FourDEnVar instances in a single batched call, see
+    stack_problems and batch_min_ens_inc
+    :param jdas: list of K FourDEnVar instances (lst)
+    :return: stacked ensemble weights (K x N_ens), posterior parameter vectors (K x n_param) and posterior parameter
+             ensembles (K x N_ens x n_param) as a tuple of arrays
+    """
+    return batch_min_ens_inc(*stack_problems(jdas))
@@ -0,0 +1,197 @@
+#########################################################################
+# Stage level timing and resource instrumentation of experiment runs #
+#########################################################################
+# Spans record the wall time, peak resident memory and I/O of a stage of an experiment as a line of JSON in a trace
+# file. Spans are only recorded once start_trace has been called, otherwise they cost a single check. Worker processes
+# forked after start_trace append to the same trace file.
+# core python modules:
+import os
+import sys
+import json
+import time
+import functools
+import contextlib
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+_trace_file = None
+_stack = []
+
+
+def start_trace(trace_file):
+    """
+    Starts recording spans to a trace file
+    :param trace_file: JSONL file to append spans to, None to stop recording (str)
+    :return: n/a
+    """
+    global _trace_file
+    if trace_file is not None and os.path.dirname(trace_file) != '' and \
+            not os.path.exists(os.path.dirname(trace_file)):
+        os.makedirs(os.path.dirname(trace_file))
+    _trace_file = trace_file
+
+
+def tracing():
+    """
+    Tests if spans are being recorded
+    :return: Bool
+    """
+    return _trace_file is not None
+
+
+def io_counters():
+    """
+    Reads the I/O counters of the current process from /proc/self/io
+    :return: dictionary of bytes read and written by the process, empty if not available (dict)
+    """
+    try:
+        with open('/proc/self/io', 'r') as f:
+            counters = dict(line.split(':') for line in f.read().splitlines())
+        return {'read_bytes': int(counters['read_bytes']), 'write_bytes': int(counters['write_bytes']),
+                'rchar': int(counters['rchar']), 'wchar': int(counters['wchar'])}
+    except (IOError, OSError, KeyError, ValueError):
+        return {}
+
+
+def usage():
+    """
+    Reads the resource usage of the current process and its waited for children (e.g. JULES)
+    :return: dictionary of peak resident memory in bytes and cpu times in seconds (dict)
+    """
+    if resource is None:
+        return {}
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    self_use = resource.getrusage(resource.RUSAGE_SELF)
+    child_use = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {'maxrss': self_use.ru_maxrss * scale, 'child_maxrss': child_use.ru_maxrss * scale,
+            'cpu': self_use.ru_utime + self_use.ru_stime, 'child_cpu': child_use.ru_utime + child_use.ru_stime}
+
+
+def write_record(record):
+    """
+    Appends a record to the trace file as a single line of JSON
+    :param record: record to write (dict)
+    :return: n/a
+    """
+    line = (json.dumps(record, default=str) + '\n').encode()
+    # a single append write keeps lines from concurrent worker processes intact
+    fd = os.open(_trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """
+    Context manager recording the wall time, peak memory, cpu time and I/O of a stage of an experiment. Further
+    attributes can be added to the yielded dictionary within the span, e.g. the number of iterations of a minimisation
+    :param name: name of stage (str)
+    :param attrs: attributes to record with the span, e.g. ensemble member number !optional!
+    :return: dictionary of span attributes (dict)
+    """
+    if _trace_file is None:
+        yield attrs
+        return
+    parent = _stack[-1] if len(_stack) > 0 else None
+    _stack.append(name)
+    use0 = usage()
+    io0 = io_counters()
+    t0 = time.time()
+    status = 'ok'
+    try:
+        yield attrs
+    except BaseException as err:
+        status = type(err).__name__
+        raise
+    finally:
+        wall = time.time() - t0
+        use1 = usage()
+        io1 = io_counters()
+        _stack.pop()
+        record = {'span': name, 'parent': parent, 'pid': os.getpid(), 'start': t0, 'wall': wall, 'status': status,
+                  'attrs': attrs}
+        if len(use1) > 0:
+            record.update({'maxrss': use1['maxrss'], 'child_maxrss': use1['child_maxrss'],
+                           'cpu': use1['cpu'] - use0['cpu'], 'child_cpu': use1['child_cpu'] - use0['child_cpu']})
+        record.update({key: io1[key] - io0[key] for key in io1 if key in io0})
+        write_record(record)
+
+
+def traced(name=None):
+    """
+    Decorator recording each call of a function as a span
+    :param name: name of span, default name of function (str)
+    :return: decorator (func)
+    """
+    def decorator(func):
+        span_name = func.__name__ if name is None else name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _trace_file is None:
+                return func(*args, **kwargs)
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def read_trace(trace_file):
+    """
+    Reads the spans recorded in a trace file
+    :param trace_file: JSONL trace file (str)
+    :return: list of span records (lst)
+    """
+    with open(trace_file, 'r') as f:
+        return [json.loads(line) for line in f if line.strip() != '']
+
+
+def report(trace_file, n_slowest=10):
+    """
+    Aggregates the spans in a trace file and prints a report of where an experiment spent its time, the slowest
+    ensemble members, minimisation iterations and I/O
+    :param trace_file: JSONL trace file (str)
+    :param n_slowest: number of slowest ensemble members to report (int)
+    :return: dictionary of aggregate statistics for each span name, slowest members and minimisations (dict)
+    """
+    records = read_trace(trace_file)
+    stages = {}
+    for rec in records:
+        stage = stages.setdefault(rec['span'], {'count': 0, 'wall': 0., 'max_wall': 0., 'maxrss': 0,
+                                                'child_maxrss': 0, 'read_bytes': 0, 'write_bytes': 0, 'rchar': 0,
+                                                'wchar': 0, 'errors': 0})
+        stage['count'] += 1
+        stage['wall'] += rec['wall']
+        stage['max_wall'] = max(stage['max_wall'], rec['wall'])
+        stage['errors'] += rec['status'] != 'ok'
+        for key in ('maxrss', 'child_maxrss'):
+            stage[key] = max(stage[key], rec.get(key, 0))
+        # I/O of nested spans is also counted in the spans enclosing them
+        for key in ('read_bytes', 'write_bytes', 'rchar', 'wchar'):
+            stage[key] += rec.get(key, 0)
+    members = sorted([rec for rec in records if rec['span'] == 'ens_member_run'], key=lambda rec: rec['wall'],
+                     reverse=True)
+    slowest = [(('xa' if rec['attrs'].get('xa') else 'xb') + str(rec['attrs'].get('member')), rec['wall'],
+                rec['status']) for rec in members[:n_slowest]]
+    minimisations = [dict(rec['attrs'], wall=rec['wall']) for rec in records if rec['span'] == 'find_min_ens_inc']
+    print('%-28s%8s%12s%12s%12s%12s%12s' % ('stage', 'count', 'total (s)', 'max (s)', 'peak rss MB', 'read MB',
+                                             'written MB'))
+    for name, stage in sorted(stages.items(), key=lambda item: item[1]['wall'], reverse=True):
+        print('%-28s%8d%12.2f%12.2f%12.1f%12.1f%12.1f' % (name, stage['count'], stage['wall'], stage['max_wall'],
+                                                           max(stage['maxrss'], stage['child_maxrss']) / 1e6,
+                                                           stage['rchar'] / 1e6, stage['wchar'] / 1e6))
+    if len(slowest) > 0:
+        print('Slowest ensemble members: ' + ', '.join('%s (%.1fs, %s)' % mem for mem in slowest))
+    for mini in minimisations:
+        print('Minimisation: ' + ', '.join('%s=%s' % (key, mini[key]) for key in sorted(mini)))
+    return {'stages': stages, 'slowest': slowest, 'minimisations': minimisations}
+
+
+if __name__ == "__main__":
+    # python instrument.py trace.jsonl
+    report(sys.argv[1])
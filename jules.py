@@ -1,12 +1,17 @@
 # core python modules:
 import subprocess
+import threading
+import asyncio
 import os
+import copy
+import shutil as sh
 # 3rd party modules:
 import sys
 import f90nml
 import glob
 # local modules:
 import experiment_setup as es
+import instrument
 
 
 class Jules():
@@ -16,14 +21,35 @@ class Jules():
     :type nml_dir: str
     :param jules_exe: location of JULES executable.
     :type jules_exe: str
+    :param template: parsed base nml files to use instead of reading nml_dir, only files changed with the nml method
+                     are written to nml_dir, the rest are linked to the template files.
+    :type template: NmlTemplate
 
     .. note:: You must have JULES installed on local system with a version of 4.8 or higher.
 
     """
-    def __init__(self, nml_dir, jules_exe=es.model_exe):
+    def __init__(self, nml_dir, jules_exe=es.model_exe, template=None):
         self.nml_dir = nml_dir
         self.jules = jules_exe
-        self.nml_dic = self.read_nml(nml_dir)
+        self.template = template
+        if template is None:
+            self.nml_dic = self.read_nml(nml_dir)
+            self.patched = set(self.nml_dic.keys())
+        else:
+            self.nml_dic = dict(template.nml_dic)
+            self.patched = set()
+
+    def nml(self, filename):
+        """
+        Returns the stored nml data of a file for editing. When using a template the data is copied on first access so
+        the template is left unchanged and the file is marked to be written.
+        :param filename: name of nml file without extension (str)
+        :return: nml data (f90nml.Namelist)
+        """
+        if filename not in self.patched:
+            self.nml_dic[filename] = copy.deepcopy(self.nml_dic[filename])
+            self.patched.add(filename)
+        return self.nml_dic[filename]
 
     def read_nml(self, nml_dir):
         """
@@ -38,70 +64,263 @@ class Jules():
 
     def write_nml(self):
         """
-        Function to write dictionary of stored nml data to nml files in current working dir.
+        Function to write dictionary of stored nml data to nml files in the nml directory. When using a template only
+        changed files are written, unchanged files are linked to the template files.
         :return: n/a
         """
+        run_dir = self.run_dir()
+        if not os.path.exists(run_dir):
+            os.makedirs(run_dir)
         for key in self.nml_dic.keys():
-            self.nml_dic[key].write(key + '.nml', force=True)
+            f_nml = os.path.join(run_dir, key + '.nml')
+            if key in self.patched:
+                if os.path.islink(f_nml):
+                    os.remove(f_nml)
+                self.nml_dic[key].write(f_nml, force=True)
+            elif os.path.realpath(f_nml) != self.template.files[key]:
+                if os.path.lexists(f_nml):
+                    os.remove(f_nml)
+                link_nml(self.template.files[key], f_nml)
 
-    def run_jules(self):
+    def run_dir(self):
+        """
+        Directory JULES is run from, the nml directory relative to this module unless an absolute path is given.
+        :return: run directory (str)
+        """
+        return os.path.join(os.path.dirname(os.path.realpath(__file__)), self.nml_dir)
+
+    def run_jules(self, timeout=None):
         """Write all NML files to disk. Run JULES in a subprocess. Check output for fatal errors.
 
+        :param timeout: maximum runtime of JULES in seconds, None for no limit (float)
         :return: stdout and stderr output from JULES model run.
         :rtype: tuple
         """
+        with instrument.span('run_jules', nml_dir=self.nml_dir):
+            # write all the nml files here so the
+            # user doesn't have to remember to...
+            with instrument.span('write_nml', n_patched=len(self.patched)):
+                self.write_nml()
+            # run JULES
+            return run_process([self.jules], self.run_dir(), timeout=timeout)
+
+    def run_jules_print(self, timeout=None):
+        """Write all NML files to disk. Run JULES in a subprocess, printing its output as it runs.
 
+        :param timeout: maximum runtime of JULES in seconds, None for no limit (float)
+        :return: string confirming model run (str)
+        :rtype: str
+        """
         # write all the nml files here so the
         # user doesn't have to remember to...
-
+        self.write_nml()
         # run JULES
-        dir_path = os.path.dirname(os.path.realpath(__file__))
-        cwd = os.getcwd()
-        os.chdir(dir_path+'/'+self.nml_dir)
+        run_process([self.jules], self.run_dir(), timeout=timeout, echo=True)
+        return 'Done', 'Done'
+
+    async def run_jules_async(self, timeout=None):
+        """Write all NML files to disk. Run JULES in an asyncio subprocess. Check output for fatal errors.
+
+        :param timeout: maximum runtime of JULES in seconds, None for no limit (float)
+        :return: stdout and stderr output from JULES model run.
+        :rtype: tuple
+        """
         self.write_nml()
-        cmd = []
-        cmd.append(self.jules)
+        return await run_process_async([self.jules], self.run_dir(), timeout=timeout)
 
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out = p.stdout.readlines()
-        err = p.stderr.readlines()
-        p.wait()
-        os.chdir(cwd)
 
-        # catch "fatal" errors
-        for line in out:
-            if len(line.split()) == 0: continue
-            if line.split()[0] == "[FATAL":
-                print >> sys.stderr, "*** runJules: caught fatal error in JULES run:"
-                print >> sys.stderr, line,
-                sys.exit()
-
-        # catch anything in stderr
-        if len(err) > 0:
-            for line in err:
-                print >> sys.stderr, "*** runJules: caught output on stderr in JULES run:"
-                print >> sys.stderr, line,
-                # sys.exit()
-        return (out, err)
-
-    def run_jules_print(self):
-        """Write all NML files to disk. Run JULES in a subprocess.
+class NmlTemplate():
+    """Base set of nml files parsed once per experiment and shared between JULES runs.
 
-        :return: string confirming model run (str)
-        :rtype: str
+    :param nml_dir: location of JULES nml file directory.
+    :type nml_dir: str
+    """
+    def __init__(self, nml_dir):
+        self.nml_dir = os.path.realpath(nml_dir)
+        self.files = {}
+        self.nml_dic = {}
+        for f_nml in glob.glob(self.nml_dir + '/*.nml'):
+            key = os.path.basename(f_nml)[:-4]
+            self.files[key] = f_nml
+            self.nml_dic[key] = f90nml.read(f_nml)
+        self.stamp = self.dir_stamp()
+
+    def dir_stamp(self):
+        """
+        Returns the modification times of the template nml files, used to check the template is up to date
+        :return: modification times (lst)
         """
+        return sorted((f, os.path.getmtime(f)) for f in glob.glob(self.nml_dir + '/*.nml'))
 
-        # write all the nml files here so the
-        # user doesn't have to remember to...
-        dir_path = os.path.dirname(os.path.realpath(__file__))
-        cwd = os.getcwd()
-        os.chdir(dir_path+'/'+self.nml_dir)
-        self.write_nml()
 
-        # run JULES
-        cmd = []
-        cmd.append(self.jules)
-        proc = subprocess.Popen(cmd, shell=False)
-        proc.communicate()
-        os.chdir(cwd)
-        return 'Done', 'Done'
+# templates parsed in this process, inherited by forked worker processes
+_templates = {}
+
+
+def nml_template(nml_dir):
+    """
+    Returns the parsed template for an nml directory, reading the nml files only if they have not already been read or
+    have changed since they were read
+    :param nml_dir: location of JULES nml file directory (str)
+    :return: nml template (NmlTemplate)
+    """
+    key = os.path.realpath(nml_dir)
+    template = _templates.get(key)
+    if template is None or template.stamp != template.dir_stamp():
+        template = NmlTemplate(nml_dir)
+        _templates[key] = template
+    return template
+
+
+def link_nml(src, dst):
+    """
+    Links an unchanged nml file into a run directory, with a symbolic link or a hard link if symbolic links are not
+    supported, falling back to a copy
+    :param src: template nml file (str)
+    :param dst: nml file in run directory (str)
+    :return: n/a
+    """
+    try:
+        os.symlink(src, dst)
+    except (OSError, AttributeError):
+        try:
+            os.link(src, dst)
+        except OSError:
+            sh.copy(src, dst)
+
+
+class JulesError(Exception):
+    """Raised when a JULES run reports a fatal error or exceeds its timeout."""
+    pass
+
+
+def is_fatal(line):
+    """
+    Tests if a line of JULES output reports a fatal error
+    :param line: line of JULES output (str)
+    :return: Bool
+    """
+    return len(line.split()) > 0 and line.split()[0] == "[FATAL"
+
+
+def report_stderr(err):
+    """
+    Prints anything JULES wrote to stderr
+    :param err: lines of JULES stderr output (lst)
+    :return: n/a
+    """
+    for line in err:
+        sys.stderr.write("*** runJules: caught output on stderr in JULES run:\n")
+        sys.stderr.write(line)
+
+
+def run_process(cmd, cwd, timeout=None, echo=False):
+    """
+    Runs JULES in a subprocess with an explicit working directory. Output is streamed and parsed line by line, the run
+    is killed as soon as a fatal error is reported. stderr is drained in a separate thread so the process can not
+    block on a full pipe.
+    :param cmd: command to run (lst)
+    :param cwd: working directory to run command in (str)
+    :param timeout: maximum runtime in seconds, None for no limit (float)
+    :param echo: switch to print output as it is read (bool)
+    :return: stdout and stderr output as lists of lines (tuple)
+    """
+    p = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    err = []
+    err_thread = threading.Thread(target=err.extend, args=(p.stderr,))
+    err_thread.daemon = True
+    err_thread.start()
+    timed_out = []
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, lambda: (timed_out.append(True), p.kill()))
+        timer.start()
+    out = []
+    fatal = None
+    for line in p.stdout:
+        out.append(line)
+        if echo:
+            sys.stdout.write(line)
+        # catch "fatal" errors
+        if is_fatal(line):
+            fatal = line
+            p.kill()
+            break
+    p.wait()
+    err_thread.join()
+    if timer is not None:
+        timer.cancel()
+    # catch anything in stderr
+    report_stderr(err)
+    if fatal is not None:
+        raise JulesError("*** runJules: caught fatal error in JULES run: " + fatal)
+    if len(timed_out) > 0:
+        raise JulesError("*** runJules: JULES run exceeded timeout of " + str(timeout) + "s")
+    return out, err
+
+
+async def read_lines(stream, lines, on_line=None):
+    """
+    Reads lines from an asyncio stream until it is exhausted or on_line returns True
+    :param stream: stream to read (asyncio.StreamReader)
+    :param lines: list to append lines to (lst)
+    :param on_line: function called with each line, reading stops if it returns True !optional! (func)
+    :return: line for which on_line returned True, else None
+    """
+    while True:
+        line = await stream.readline()
+        if not line:
+            return None
+        line = line.decode(errors='replace')
+        lines.append(line)
+        if on_line is not None and on_line(line):
+            return line
+
+
+async def run_process_async(cmd, cwd, timeout=None):
+    """
+    Asyncio version of run_process, allowing one process to supervise many concurrent JULES runs
+    :param cmd: command to run (lst)
+    :param cwd: working directory to run command in (str)
+    :param timeout: maximum runtime in seconds, None for no limit (float)
+    :return: stdout and stderr output as lists of lines (tuple)
+    """
+    p = await asyncio.create_subprocess_exec(*cmd, cwd=cwd, stdout=asyncio.subprocess.PIPE,
+                                             stderr=asyncio.subprocess.PIPE)
+    out = []
+    err = []
+    err_task = asyncio.ensure_future(read_lines(p.stderr, err))
+    try:
+        fatal = await asyncio.wait_for(read_lines(p.stdout, out, on_line=is_fatal), timeout)
+    except asyncio.TimeoutError:
+        p.kill()
+        await p.wait()
+        await err_task
+        raise JulesError("*** runJules: JULES run exceeded timeout of " + str(timeout) + "s")
+    if fatal is not None:
+        p.kill()
+    await p.wait()
+    await err_task
+    report_stderr(err)
+    if fatal is not None:
+        raise JulesError("*** runJules: caught fatal error in JULES run: " + fatal)
+    return out, err
+
+
+async def run_jules_many(jules_runs, max_concurrent=100, timeout=None):
+    """
+    Runs many JULES instances concurrently from a single process
+    :param jules_runs: instances of Jules class to run (lst)
+    :param max_concurrent: maximum number of JULES runs at any one time (int)
+    :param timeout: maximum runtime of each JULES run in seconds, None for no limit (float)
+    :return: list of (stdout, stderr) output for each run, or the JulesError raised by a failed run (lst)
+    """
+    sem = asyncio.Semaphore(max_concurrent)
+
+    async def run_one(j):
+        async with sem:
+            try:
+                return await j.run_jules_async(timeout=timeout)
+            except JulesError as e:
+                return e
+    return await asyncio.gather(*[run_one(j) for j in jules_runs])
@@ -0,0 +1,303 @@
+# 3rd party modules:
+import numpy as np
+import scipy.linalg as splinal
+
+
+class DiagonalCov:
+    """
+    Diagonal observation error covariance matrix, stored as a vector of variances
+    :param var: observation error variances (arr)
+    """
+    def __init__(self, var):
+        self.var = np.asarray(var, dtype=float)
+        self.size = len(self.var)
+        self.sd = np.sqrt(self.var)
+
+    def whiten(self, obs_arr):
+        """
+        Applies the inverse square root of the covariance matrix, L^-1 with R = L L^T, to observation space vectors
+        :param obs_arr: observation space vector or matrix with observations along the first axis (arr)
+        :return: whitened vector or matrix (arr)
+        """
+        obs_arr = np.asarray(obs_arr)
+        return obs_arr / self.sd.reshape((-1,) + (1,) * (obs_arr.ndim - 1))
+
+    def solve(self, obs_arr):
+        """
+        Applies the inverse of the covariance matrix to observation space vectors
+        :param obs_arr: observation space vector or matrix with observations along the first axis (arr)
+        :return: R^-1 obs_arr (arr)
+        """
+        obs_arr = np.asarray(obs_arr)
+        return obs_arr / self.var.reshape((-1,) + (1,) * (obs_arr.ndim - 1))
+
+    def variances(self):
+        """
+        Returns the diagonal of the covariance matrix
+        :return: observation error variances (arr)
+        """
+        return self.var
+
+    def dense(self):
+        """
+        Returns the covariance matrix as a dense array, only for small numbers of observations
+        :return: covariance matrix (arr)
+        """
+        return np.diag(self.var)
+
+
+class DenseCov:
+    """
+    Dense observation error covariance matrix, factorised once as R = L L^T
+    :param mat: observation error covariance matrix (arr)
+    """
+    def __init__(self, mat):
+        self.mat = np.asarray(mat, dtype=float)
+        self.size = len(self.mat)
+        self.chol = np.linalg.cholesky(self.mat)
+
+    def whiten(self, obs_arr):
+        """
+        Applies the inverse Cholesky factor of the covariance matrix, L^-1 with R = L L^T, to observation space vectors
+        :param obs_arr: observation space vector or matrix with observations along the first axis (arr)
+        :return: whitened vector or matrix (arr)
+        """
+        return splinal.solve_triangular(self.chol, obs_arr, lower=True)
+
+    def solve(self, obs_arr):
+        """
+        Applies the inverse of the covariance matrix to observation space vectors
+        :param obs_arr: observation space vector or matrix with observations along the first axis (arr)
+        :return: R^-1 obs_arr (arr)
+        """
+        return splinal.cho_solve((self.chol, True), obs_arr)
+
+    def variances(self):
+        """
+        Returns the diagonal of the covariance matrix
+        :return: observation error variances (arr)
+        """
+        return np.diag(self.mat)
+
+    def dense(self):
+        """
+        Returns the covariance matrix as a dense array
+        :return: covariance matrix (arr)
+        """
+        return self.mat
+
+
+class ExpCorrCov:
+    """
+    Observation error covariance matrix with exponential correlation in time, R_ij = sd_i sd_j exp(-|t_i - t_j| / L),
+    which is an AR(1) process for regularly spaced observations. The inverse of the correlation matrix of the time
+    ordered observations is tridiagonal and its Cholesky factor is bidiagonal, so the matrix is never formed
+    :param sd: observation error standard deviations (arr)
+    :param times: observation times, e.g. day indices of JULES output, all different (arr)
+    :param corr_len: e-folding length of the correlation in units of times (float)
+    """
+    def __init__(self, sd, times, corr_len):
+        self.sd = np.asarray(sd, dtype=float)
+        self.size = len(self.sd)
+        self.times = np.asarray(times, dtype=float)
+        self.corr_len = float(corr_len)
+        self.order = np.argsort(self.times, kind='stable')
+        d_times = np.diff(self.times[self.order])
+        if np.any(d_times <= 0):
+            raise ValueError('Observation times of a time correlated observation error covariance must be different')
+        # correlation of each time ordered observation with the one before it
+        self.rho = np.exp(-d_times / self.corr_len)
+        # inverse Cholesky factor of the correlation matrix is bidiagonal with diagonal a and sub diagonal b
+        self.a = np.ones(self.size)
+        self.a[1:] = 1. / np.sqrt(1. - self.rho**2)
+        self.b = -self.rho * self.a[1:]
+        # inverse of the correlation matrix is tridiagonal with diagonal prec_diag and off diagonal prec_off
+        self.prec_diag = self.a**2
+        self.prec_diag[:-1] += self.b**2
+        self.prec_off = self.b * self.a[1:]
+
+    def _sorted(self, obs_arr):
+        obs_arr = np.asarray(obs_arr, dtype=float)
+        shape = (-1,) + (1,) * (obs_arr.ndim - 1)
+        return obs_arr[self.order] / self.sd[self.order].reshape(shape), shape
+
+    def _unsorted(self, sorted_arr):
+        out = np.empty_like(sorted_arr)
+        out[self.order] = sorted_arr
+        return out
+
+    def whiten(self, obs_arr):
+        """
+        Applies the inverse of a square root L of the covariance matrix, R = L L^T, to observation space vectors using
+        the bidiagonal inverse Cholesky factor of the correlation matrix
+        :param obs_arr: observation space vector or matrix with observations along the first axis (arr)
+        :return: whitened vector or matrix (arr)
+        """
+        z_arr, shape = self._sorted(obs_arr)
+        white = z_arr * self.a.reshape(shape)
+        white[1:] += z_arr[:-1] * self.b.reshape(shape)
+        return self._unsorted(white)
+
+    def solve(self, obs_arr):
+        """
+        Applies the inverse of the covariance matrix to observation space vectors using the tridiagonal inverse of the
+        correlation matrix
+        :param obs_arr: observation space vector or matrix with observations along the first axis (arr)
+        :return: R^-1 obs_arr (arr)
+        """
+        z_arr, shape = self._sorted(obs_arr)
+        prec_z = z_arr * self.prec_diag.reshape(shape)
+        prec_z[:-1] += z_arr[1:] * self.prec_off.reshape(shape)
+        prec_z[1:] += z_arr[:-1] * self.prec_off.reshape(shape)
+        return self._unsorted(prec_z / self.sd[self.order].reshape(shape))
+
+    def variances(self):
+        """
+        Returns the diagonal of the covariance matrix
+        :return: observation error variances (arr)
+        """
+        return self.sd**2
+
+    def dense(self):
+        """
+        Returns the covariance matrix as a dense array, only for small numbers of observations
+        :return: covariance matrix (arr)
+        """
+        return np.outer(self.sd, self.sd) * np.exp(-np.abs(self.times[:, np.newaxis] - self.times) / self.corr_len)
+
+
+class LowRankCov:
+    """
+    Observation error covariance matrix of a structured covariance matrix plus a low rank update, R = B + U U^T, e.g.
+    for an error shared by many observations such as an instrument calibration error. Solves use the Woodbury identity
+    and whitening uses the square root (I + V V^T)^-1/2 L_B^-1 with V = L_B^-1 U, both only needing k x k matrices for
+    a rank k update
+    :param base: covariance matrix B, an instance of a class in this module (obj)
+    :param u_mat: n_obs x k matrix U of the low rank update (arr)
+    """
+    def __init__(self, base, u_mat):
+        self.base = base
+        self.size = base.size
+        self.u_mat = np.asarray(u_mat, dtype=float).reshape(self.size, -1)
+        v_mat = self.base.whiten(self.u_mat)
+        self.v_basis, v_sing, _ = np.linalg.svd(v_mat, full_matrices=False)
+        # (I + V V^T)^-1/2 = I - Q diag(shrink) Q^T with V = Q S W^T
+        self.shrink = 1. - 1. / np.sqrt(1. + v_sing**2)
+        # Woodbury identity, R^-1 = B^-1 - B^-1 U (I + V^T V)^-1 U^T B^-1
+        self.b_inv_u = self.base.solve(self.u_mat)
+        self.cap_chol = splinal.cho_factor(np.eye(self.u_mat.shape[1]) + np.dot(v_mat.T, v_mat), lower=True)
+
+    def whiten(self, obs_arr):
+        """
+        Applies the inverse of a square root L of the covariance matrix, R = L L^T, to observation space vectors
+        :param obs_arr: observation space vector or matrix with observations along the first axis (arr)
+        :return: whitened vector or matrix (arr)
+        """
+        base_w = self.base.whiten(obs_arr)
+        proj = np.dot(self.v_basis.T, base_w)
+        return base_w - np.dot(self.v_basis, self.shrink.reshape((-1,) + (1,) * (proj.ndim - 1)) * proj)
+
+    def solve(self, obs_arr):
+        """
+        Applies the inverse of the covariance matrix to observation space vectors using the Woodbury identity
+        :param obs_arr: observation space vector or matrix with observations along the first axis (arr)
+        :return: R^-1 obs_arr (arr)
+        """
+        base_inv = self.base.solve(obs_arr)
+        return base_inv - np.dot(self.b_inv_u, splinal.cho_solve(self.cap_chol, np.dot(self.u_mat.T, base_inv)))
+
+    def variances(self):
+        """
+        Returns the diagonal of the covariance matrix
+        :return: observation error variances (arr)
+        """
+        return self.base.variances() + np.sum(self.u_mat**2, axis=1)
+
+    def dense(self):
+        """
+        Returns the covariance matrix as a dense array, only for small numbers of observations
+        :return: covariance matrix (arr)
+        """
+        return self.base.dense() + np.dot(self.u_mat, self.u_mat.T)
+
+
+class BlockDiagCov:
+    """
+    Block diagonal observation error covariance matrix, with one block for each observed variable so that errors are
+    only correlated between observations of the same type
+    :param blocks: list of covariance matrices for consecutive observations, instances of classes in this module (lst)
+    """
+    def __init__(self, blocks):
+        self.blocks = list(blocks)
+        self.sizes = [block.size for block in self.blocks]
+        self.size = int(np.sum(self.sizes))
+        self.bounds = np.concatenate([[0], np.cumsum(self.sizes)]).astype(int)
+
+    def _apply(self, method, obs_arr):
+        obs_arr = np.asarray(obs_arr)
+        out = np.empty(obs_arr.shape)
+        for block, i0, i1 in zip(self.blocks, self.bounds[:-1], self.bounds[1:]):
+            out[i0:i1] = getattr(block, method)(obs_arr[i0:i1])
+        return out
+
+    def whiten(self, obs_arr):
+        """
+        Applies the inverse of a square root L of the covariance matrix, R = L L^T, to observation space vectors block
+        by block
+        :param obs_arr: observation space vector or matrix with observations along the first axis (arr)
+        :return: whitened vector or matrix (arr)
+        """
+        return self._apply('whiten', obs_arr)
+
+    def solve(self, obs_arr):
+        """
+        Applies the inverse of the covariance matrix to observation space vectors block by block
+        :param obs_arr: observation space vector or matrix with observations along the first axis (arr)
+        :return: R^-1 obs_arr (arr)
+        """
+        return self._apply('solve', obs_arr)
+
+    def variances(self):
+        """
+        Returns the diagonal of the covariance matrix
+        :return: observation error variances (arr)
+        """
+        return np.concatenate([block.variances() for block in self.blocks])
+
+    def dense(self):
+        """
+        Returns the covariance matrix as a dense array, only for small numbers of observations
+        :return: covariance matrix (arr)
+        """
+        return splinal.block_diag(*[block.dense() for block in self.blocks])
+
+
+def obs_var_cov(err, pos, corr_len=None, bias_err=None):
+    """
+    Creates the observation error covariance matrix of the observations of a single observed variable
+    :param err: observation errors not shared between observations (arr)
+    :param pos: time indices of observations (arr)
+    :param corr_len: e-folding length of the exponential time correlation of the errors in units of pos, None for
+                     uncorrelated errors (float)
+    :param bias_err: error shared by all observations of the variable, None for no shared error (float)
+    :return: observation error covariance matrix instance (obj)
+    """
+    if corr_len is None:
+        cov = DiagonalCov(np.asarray(err, dtype=float)**2)
+    else:
+        cov = ExpCorrCov(err, pos, corr_len)
+    if bias_err is not None:
+        cov = LowRankCov(cov, np.ones((cov.size, 1)) * bias_err)
+    return cov
+
+
+def obs_cov(obs_dic):
+    """
+    Creates the observation error covariance matrix for a dictionary of observations. A covariance given under the key
+    'r_cov' is used as is, otherwise the observation errors in 'obs_err' give a diagonal covariance matrix
+    :param obs_dic: dictionary of observations and observation errors (dict)
+    :return: observation error covariance matrix instance (obj)
+    """
+    if obs_dic.get('r_cov') is not None:
+        return obs_dic['r_cov']
+    return DiagonalCov(np.concatenate(obs_dic['obs_err'])**2)
@@ -0,0 +1,163 @@
+# core python modules:
+import hashlib
+# 3rd party modules:
+import numpy as np
+import netCDF4 as nc
+
+
+def kg_s_to_g_day(x):
+    """
+    Converts a JULES flux from kg m-2 s-1 to g m-2 day-1
+    :param x: flux in kg m-2 s-1 (arr)
+    :return: flux in g m-2 day-1 (arr)
+    """
+    return 1000 * 60 * 60 * 24 * x
+
+
+class ObsVar:
+    """
+    Specification of an observed JULES output variable
+    :param name: name of observation (str)
+    :param pos: time indices of observations in JULES output (arr)
+    :param var: JULES output variable name, default name (str)
+    :param lvl_idx: level/tile index of variable, None if variable has no level dimension (int)
+    :param yx_idx: (y, x) grid indices of variable (tuple)
+    :param transform: function applied to extracted values, e.g. a unit conversion (func)
+    :param err: observation error as a fraction of the mean positive observation (float)
+    :param noise: error used to perturb "model truth" observations in twin experiments as a fraction of the mean
+                  positive observation (float)
+    :param corr_len: e-folding length in days of the exponential time correlation of observation errors, None for
+                     uncorrelated errors (float)
+    :param bias_err: observation error shared by all observations of the variable, e.g. an instrument calibration
+                     error, as a fraction of the mean positive observation, None for no shared error (float)
+    """
+    def __init__(self, name, pos, var=None, lvl_idx=7, yx_idx=(0, 0), transform=None, err=0.05, noise=0.01,
+                 corr_len=None, bias_err=None):
+        self.name = name
+        self.pos = np.asarray(pos, dtype=int)
+        self.var = name if var is None else var
+        self.lvl_idx = lvl_idx
+        self.yx_idx = tuple(yx_idx)
+        self.transform = transform
+        self.err = err
+        self.noise = noise
+        self.corr_len = corr_len
+        self.bias_err = bias_err
+
+    def spec(self):
+        """
+        Returns a string describing the specification of the observed variable
+        :return: specification (str)
+        """
+        return repr((self.name, self.var, self.pos.tolist(), self.lvl_idx, self.yx_idx,
+                     getattr(self.transform, '__name__', None), self.err, self.noise, self.corr_len, self.bias_err))
+
+
+class ObsOperator:
+    """
+    Observation operator mapping JULES output files to the vector of modelled observations. A read plan is precomputed
+    so that each output file is opened once and each needed variable is read as a single contiguous slab, with all
+    indexing done in memory
+    :param obs_vars: list of observed variable specifications (lst)
+    """
+    def __init__(self, obs_vars):
+        self.obs_vars = list(obs_vars)
+        self.names = [ob.name for ob in self.obs_vars]
+        self.sizes = [len(ob.pos) for ob in self.obs_vars]
+        self.n_obs = int(np.sum(self.sizes))
+        self.read_plan = self.make_read_plan()
+
+    def make_read_plan(self):
+        """
+        Finds the range of time indices to read for each JULES output variable
+        :return: dictionary of (first, last + 1) time indices for each variable (dict)
+        """
+        read_plan = {}
+        for ob in self.obs_vars:
+            t0, t1 = ob.pos.min(), ob.pos.max() + 1
+            if ob.var in read_plan:
+                t0, t1 = min(t0, read_plan[ob.var][0]), max(t1, read_plan[ob.var][1])
+            read_plan[ob.var] = (int(t0), int(t1))
+        return read_plan
+
+    def variables(self):
+        """
+        Returns the JULES output variables needed by the observation operator
+        :return: list of variable names (lst)
+        """
+        return list(self.read_plan.keys())
+
+    def key(self):
+        """
+        Returns a hash of the observation operator specification, used to check the validity of cached extractions
+        :return: hash (str)
+        """
+        return hashlib.sha1(''.join(ob.spec() for ob in self.obs_vars).encode()).hexdigest()
+
+    def read(self, nc_file):
+        """
+        Reads the slabs of JULES output needed by the observation operator
+        :param nc_file: JULES netCDF file to read (str)
+        :return: dictionary of slabs for each variable (dict)
+        """
+        nc_dat = nc.Dataset(nc_file, 'r')
+        nc_dat.set_auto_mask(False)
+        slabs = {var: nc_dat.variables[var][t0:t1] for var, (t0, t1) in self.read_plan.items()}
+        nc_dat.close()
+        return slabs
+
+    def read_store(self, store):
+        """
+        Reads the slabs of output needed by the observation operator for all members of a consolidated ensemble store
+        :param store: consolidated ensemble store, see ensemble_store.EnsembleStore (obj)
+        :return: dictionary of slabs for each variable with a leading ensemble member dimension (dict)
+        """
+        return {var: store.var(var)[:, t0:t1] for var, (t0, t1) in self.read_plan.items()}
+
+    def apply(self, slabs):
+        """
+        Indexes slabs of JULES output to find the modelled observations
+        :param slabs: dictionary of slabs for each variable as returned by read, or by read_store in which case the
+                      modelled observations have a leading ensemble member dimension (dict)
+        :return: tuple of modelled observations for each observed variable (tuple)
+        """
+        hx = []
+        for ob in self.obs_vars:
+            t_idx = ob.pos - self.read_plan[ob.var][0]
+            # index from the last dimension so that a leading ensemble member dimension is kept
+            if ob.lvl_idx is None:
+                hxi = slabs[ob.var][(Ellipsis, t_idx) + ob.yx_idx]
+            else:
+                hxi = slabs[ob.var][(Ellipsis, t_idx, ob.lvl_idx) + ob.yx_idx]
+            if ob.transform is not None:
+                hxi = ob.transform(hxi)
+            hx.append(hxi)
+        return tuple(hx)
+
+    def extract(self, nc_file):
+        """
+        Extracts modelled observations from a JULES netCDF file
+        :param nc_file: JULES netCDF file to extract observations from (str)
+        :return: dictionary containing observations (dict)
+        """
+        return {'obs': self.apply(self.read(nc_file))}
+
+    def extract_vec(self, nc_file, out=None):
+        """
+        Extracts the vector of modelled observations from a JULES netCDF file
+        :param nc_file: JULES netCDF file to extract observations from (str)
+        :param out: array of length n_obs to write observations into !optional! (arr)
+        :return: vector of modelled observations (arr)
+        """
+        if out is None:
+            out = np.empty(self.n_obs)
+        np.concatenate(self.apply(self.read(nc_file)), out=out)
+        return out
+
+    def extract_store(self, store):
+        """
+        Extracts the modelled observations for all members of a consolidated ensemble store
+        :param store: consolidated ensemble store, see ensemble_store.EnsembleStore (obj)
+        :return: ensemble of modelled observations, one member per row (arr)
+        """
+        return np.concatenate(self.apply(self.read_store(store)), axis=1)
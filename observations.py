@@ -1,84 +1,69 @@
+# core python modules:
+import os
+import json
+import multiprocessing as mp
 # 3rd party modules:
 import numpy as np
-import netCDF4 as nc
-import random
 # local modules:
 import experiment_setup as es
+import ensemble_store
+import instrument
+import obs_error
+import scheduler
 
 
-def extract_twin_data(mod_truth='output/model_truth/mod_truth.daily.nc', seed_val=0):
+@instrument.traced()
+def extract_twin_data(mod_truth='output/model_truth/mod_truth.daily.nc', seed_val=0, obs_op=None):
     """
     Function for extracting observations to be assimilated in data assimilation experiments. Here we are running a twin
     experiment using a "model truth" to draw observations from.
     :param mod_truth: location of netCDF file containing "model truth" output (str)
     :param seed_val: seed value for adding random noise to the observations (int)
+    :param obs_op: observation operator to extract observations with, default es.obs_op (obj)
     :return: dictionary containing observations and observation errors (dictionary)
     """
-    # open model truth netCDF file
-    mod_dat = nc.Dataset(mod_truth, 'r')
-    # set position of observations
-    gpp_obs_position = np.array([141, 143, 146, 148, 155, 157, 158, 160, 161, 162,
-       163, 164, 165, 166, 167, 168, 169, 170, 171, 172, 173, 175, 176,
-       177, 179, 180, 182, 183, 184, 186, 187, 190, 191, 194, 196, 197,
-       198, 199, 200, 201, 202, 203, 204, 206, 207, 208, 209, 210, 211,
-       213, 214, 215, 218, 219, 220, 222, 223, 225, 228, 229, 230, 231,
-       233, 234, 239, 240, 241, 242, 243, 244, 245, 247, 248, 249, 251,
-       252, 259, 260])
-    lai_obs_position = np.array([167, 187, 198, 209, 225])
-    canht_obs_position = np.array([167, 187, 198, 225, 248, 262])
+    if obs_op is None:
+        obs_op = es.obs_op
     # extract observations from netCDF file
-    gpp_obs_tr = 1000 * 60 * 60 * 24 * mod_dat.variables['gpp'][gpp_obs_position, 7, 0, 0]
-    lai_obs_tr = mod_dat.variables['lai'][lai_obs_position, 7, 0, 0]
-    canht_obs_tr = mod_dat.variables['canht'][canht_obs_position, 7, 0, 0]
-    # set error with which to perturb extracted observations
-    gpp_err = np.mean(gpp_obs_tr[gpp_obs_tr > 0]) * 0.01
-    lai_err = np.mean(lai_obs_tr[lai_obs_tr > 0]) * 0.01
-    canht_err = np.mean(canht_obs_tr[canht_obs_tr > 0]) * 0.01
-    # perturb "model truth" observations
-    np.random.seed(seed_val)
-    gpp_obs = np.array([gpp + np.random.normal(0.0, gpp_err) for gpp in gpp_obs_tr])
-    np.random.seed(seed_val)
-    lai_obs = np.array([lai + np.random.normal(0.0, lai_err) for lai in lai_obs_tr])
-    np.random.seed(seed_val)
-    canht_obs = np.array([canht + np.random.normal(0.0, canht_err) for canht in canht_obs_tr])
-    # define observation errors to use within data assimilation (will be used to create observation error covariance
-    # matrix)
-    gpp_err = np.ones(len(gpp_obs)) * np.mean(gpp_obs[gpp_obs > 0]) * 0.1  # 2% error in mod obs
-    lai_err = np.ones(len(lai_obs)) * np.mean(lai_obs[lai_obs > 0]) * 0.05
-    canht_err = np.ones(len(canht_obs)) * np.mean(canht_obs[canht_obs > 0]) * 0.05
-    # close netCDF file
-    mod_dat.close()
-    return {'obs': (gpp_obs, lai_obs, canht_obs), 'obs_err': (gpp_err, lai_err, canht_err), 'gpp_obs': gpp_obs,
-            'gpp_pos': gpp_obs_position, 'gpp_err': gpp_err, 'lai_obs': lai_obs, 'lai_pos': lai_obs_position,
-            'lai_err': lai_err, 'canht_obs': canht_obs, 'canht_pos': canht_obs_position, 'canht_err': canht_err}
+    obs_tr = obs_op.extract(mod_truth)['obs']
+    obs_dic = {'obs': [], 'obs_err': []}
+    r_blocks = []
+    for ob, ob_tr in zip(obs_op.obs_vars, obs_tr):
+        # perturb "model truth" observations
+        np.random.seed(seed_val)
+        ob_obs = ob_tr + np.random.normal(0.0, np.mean(ob_tr[ob_tr > 0]) * ob.noise, len(ob_tr))
+        # define observation error covariance block of observed variable to use within data assimilation, with
+        # observation errors giving the standard deviation of each observation
+        ob_scale = np.mean(ob_obs[ob_obs > 0])
+        r_blocks.append(obs_error.obs_var_cov(np.ones(len(ob_obs)) * ob_scale * ob.err, ob.pos, corr_len=ob.corr_len,
+                                              bias_err=None if ob.bias_err is None else ob_scale * ob.bias_err))
+        ob_err = np.sqrt(r_blocks[-1].variances())
+        obs_dic['obs'].append(ob_obs)
+        obs_dic['obs_err'].append(ob_err)
+        obs_dic[ob.name + '_obs'] = ob_obs
+        obs_dic[ob.name + '_pos'] = ob.pos
+        obs_dic[ob.name + '_err'] = ob_err
+    obs_dic['obs'] = tuple(obs_dic['obs'])
+    obs_dic['obs_err'] = tuple(obs_dic['obs_err'])
+    # observation error covariance matrix, block diagonal with errors only correlated within an observed variable
+    obs_dic['r_cov'] = obs_error.BlockDiagCov(r_blocks)
+    return obs_dic
 
 
-def extract_jules_hx(nc_file):
+@instrument.traced()
+def extract_jules_hx(nc_file, obs_op=None):
     """
     Function extracting the modelled observations from JULES netCDF files
     :param nc_file: netCDF file to extract observations from (str)
+    :param obs_op: observation operator to extract observations with, default es.obs_op (obj)
     :return: dictionary containing observations (dict)
     """
-    nc_dat = nc.Dataset(nc_file, 'r')
-    # set position of observations to correspond with assimilated observations
-    gpp_ob_position = np.array([141, 143, 146, 148, 155, 157, 158, 160, 161, 162,
-       163, 164, 165, 166, 167, 168, 169, 170, 171, 172, 173, 175, 176,
-       177, 179, 180, 182, 183, 184, 186, 187, 190, 191, 194, 196, 197,
-       198, 199, 200, 201, 202, 203, 204, 206, 207, 208, 209, 210, 211,
-       213, 214, 215, 218, 219, 220, 222, 223, 225, 228, 229, 230, 231,
-       233, 234, 239, 240, 241, 242, 243, 244, 245, 247, 248, 249, 251,
-       252, 259, 260])
-    lai_ob_position = np.array([167, 187, 198, 209, 225])
-    canht_ob_position = np.array([167, 187, 198, 225, 248, 262])
-    # extract observations from netCDF file
-    gpp_hx = 1000 * 60 * 60 * 24 * nc_dat.variables['gpp'][gpp_ob_position, 7, 0, 0]
-    lai_hx = nc_dat.variables['lai'][lai_ob_position, 7, 0, 0]
-    canht_hx = nc_dat.variables['canht'][canht_ob_position, 7, 0, 0]
-    # close netCDF file
-    nc_dat.close()
-    return {'obs': (gpp_hx, lai_hx, canht_hx)}
+    if obs_op is None:
+        obs_op = es.obs_op
+    return obs_op.extract(nc_file)
 
 
+@instrument.traced()
 def extract_jules_hxb():
     """
     Function to extract modelled observations for prior JULES run
@@ -87,14 +72,85 @@ def extract_jules_hxb():
     return extract_jules_hx(es.output_directory+'/background/xb0.daily.nc')
 
 
-def extract_jules_hxb_ens():
+@instrument.traced()
+def extract_jules_hxb_ens(ens_dir=None, size_ens=None, processes=None, cache=True, obs_op=None, mmap=False):
+    """
+    Function to extract ensemble of modelled observations from prior model ensemble. Files are read in parallel and
+    the result is cached in a .npy file alongside the ensemble directory, keyed on the modification times of the
+    ensemble files and the observation operator, so that only new or changed members are read again. If the ensemble
+    has been consolidated (see ensemble_store.consolidate) members are read from the memory mapped store instead
+    :param ens_dir: directory of ensemble output, default es.output_directory/ensemble{es.seed_value} (str)
+    :param size_ens: size of ensemble, default es.ensemble_size (int)
+    :param processes: number of processes to use for reading files, default derived from available cores (int)
+    :param cache: switch to use and update the cache of extracted observations (bool)
+    :param obs_op: observation operator to extract observations with, default es.obs_op (obj)
+    :param mmap: switch to return the cached memory map rather than a copy in memory, requires cache (bool)
+    :return: ensemble of modelled observations, one member per row (arr)
+    """
+    if ens_dir is None:
+        ens_dir = es.output_directory + '/ensemble' + str(es.seed_value)
+    if size_ens is None:
+        size_ens = es.ensemble_size
+    if obs_op is None:
+        obs_op = es.obs_op
+    nc_files = [ens_dir + '/ens' + str(i) + '.daily.nc' for i in range(size_ens)]
+    stamps = [ensemble_store.file_stamp(f) for f in nc_files]
+    cache_file = ens_dir.rstrip('/') + '_hxb.npy'
+    meta_file = ens_dir.rstrip('/') + '_hxb.json'
+    hm_xbs = None
+    stale = list(range(size_ens))
+    if cache is True and os.path.exists(meta_file) and os.path.exists(cache_file):
+        with open(meta_file, 'r') as f:
+            meta = json.load(f)
+        if meta['key'] == obs_op.key():
+            hm_xbs = np.lib.format.open_memmap(cache_file, mode='r+')
+            old_stamps = meta['stamps']
+            if hm_xbs.shape == (size_ens, obs_op.n_obs):
+                stale = [i for i in range(size_ens) if i >= len(old_stamps) or old_stamps[i] != stamps[i]]
+            else:
+                hm_xbs = None
+    if hm_xbs is None:
+        if cache is True:
+            hm_xbs = np.lib.format.open_memmap(cache_file, mode='w+', shape=(size_ens, obs_op.n_obs))
+        else:
+            hm_xbs = np.empty((size_ens, obs_op.n_obs))
+    if len(stale) > 0:
+        if cache is True and os.path.exists(meta_file):
+            # invalidate cache while it is being updated
+            os.remove(meta_file)
+        store = ensemble_store.open_store(ens_dir, size_ens)
+        if store is not None and all(var in store for var in obs_op.variables()):
+            hm_xbs[stale] = obs_op.extract_store(store)[stale]
+            jobs = []
+        else:
+            jobs = [(i, nc_files[i], obs_op) for i in stale]
+        if processes is None:
+            processes = scheduler.default_workers(len(jobs), max_workers=es.num_processes)
+        if processes > 1 and len(jobs) > 1:
+            pool = mp.Pool(processes=min(processes, len(jobs)))
+            for i, hxbi in pool.imap_unordered(extract_member_hx, jobs):
+                hm_xbs[i] = hxbi
+            pool.close()
+            pool.join()
+        else:
+            for job in jobs:
+                i, hxbi = extract_member_hx(job)
+                hm_xbs[i] = hxbi
+        if cache is True:
+            hm_xbs.flush()
+            with open(meta_file + '.tmp', 'w') as f:
+                json.dump({'key': obs_op.key(), 'stamps': stamps}, f)
+            os.rename(meta_file + '.tmp', meta_file)
+    if mmap is True and cache is True:
+        return np.load(cache_file, mmap_mode='r')
+    return np.array(hm_xbs)
+
+
+def extract_member_hx(job):
     """
-    Function to extract ensemble of modelled observations from prior model ensemble
-    :return: ensemble of modelled observations (lst)
+    Function to extract modelled observations for a single ensemble member, used by extract_jules_hxb_ens
+    :param job: tuple of ensemble member number (int), netCDF file (str) and observation operator (obj)
+    :return: tuple of ensemble member number (int) and modelled observations (arr)
     """
-    hm_xbs = []
-    for xb_fname in xrange(0, es.ensemble_size):
-        hxbi_dic = extract_jules_hx(es.output_directory + '/ensemble0/ens' + str(xb_fname) + '.daily.nc')
-        hxbi = np.concatenate(hxbi_dic['obs'])
-        hm_xbs.append(hxbi)
-    return hm_xbs
+    i, nc_file, obs_op = job
+    return i, obs_op.extract_vec(nc_file)
@@ -0,0 +1,176 @@
+# core python modules:
+import types
+# 3rd party modules:
+import numpy as np
+# local modules:
+import experiment_setup as es
+
+_default_space = None
+
+
+class ParamSpace:
+    """
+    Immutable registry of the parameters being optimised, built once from a nested dictionary of parameters such as
+    es.opt_params. Each position in a parameter vector is mapped to the nml file, namelist, name and level/pft index of
+    the parameter, and bounded parameters can be mapped to and from an unbounded space with log (lower bound only) or
+    logit (lower and upper bound) transforms
+    :param p_dict: dictionary of parameters, {nml file: {namelist: {name: [index or 'None', prior value, (low, high)
+                   bounds, transform !optional!]}}}, where transform is 'log', 'logit' or 'none' and defaults to logit
+                   for parameters bounded on both sides, log for parameters with only a lower bound and none otherwise
+                   (dict)
+    """
+    def __init__(self, p_dict):
+        locs = []
+        xb = []
+        bnds = []
+        kinds = []
+        for filename in p_dict.keys():
+            for nml in p_dict[filename].keys():
+                for param, entry in p_dict[filename][nml].items():
+                    idx = None if entry[0] is None or entry[0] == 'None' else entry[0]
+                    low, high = (-np.inf if entry[2][0] is None else entry[2][0],
+                                 np.inf if entry[2][1] is None else entry[2][1])
+                    if len(entry) > 3:
+                        kind = entry[3]
+                    elif np.isfinite(low) and np.isfinite(high):
+                        kind = 'logit'
+                    elif np.isfinite(low):
+                        kind = 'log'
+                    else:
+                        kind = 'none'
+                    if kind not in ('log', 'logit', 'none'):
+                        raise ValueError('Unknown transform for ' + param + ': ' + str(kind))
+                    locs.append((filename, nml, param, idx))
+                    xb.append(entry[1])
+                    bnds.append((low, high))
+                    kinds.append(kind)
+        xb = np.array(xb, dtype=float)
+        bnds = np.array(bnds, dtype=float).reshape(-1, 2)
+        for arr in (xb, bnds):
+            arr.flags.writeable = False
+        kinds = np.array(kinds)
+        names = tuple(loc[2] for loc in locs)
+        for name in names:
+            if names.count(name) > 1:
+                raise ValueError('Parameter ' + name + ' is defined more than once, parameter names must be unique')
+        is_log = kinds == 'log'
+        is_logit = kinds == 'logit'
+        for arr in (is_log, is_logit):
+            arr.flags.writeable = False
+        object.__setattr__(self, 'locs', tuple(locs))
+        object.__setattr__(self, 'names', names)
+        object.__setattr__(self, 'index', types.MappingProxyType({name: i for i, name in enumerate(self.names)}))
+        object.__setattr__(self, 'xb', xb)
+        object.__setattr__(self, 'bnds', bnds)
+        object.__setattr__(self, 'val_bnds', tuple(tuple(bnd) for bnd in bnds.tolist()))
+        object.__setattr__(self, 'kinds', tuple(kinds.tolist()))
+        object.__setattr__(self, '_log', is_log)
+        object.__setattr__(self, '_logit', is_logit)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ParamSpace is immutable')
+
+    def __len__(self):
+        return len(self.names)
+
+    def values(self, params=None, values=None):
+        """
+        Returns a full parameter vector with the given parameters set and all others at their prior values
+        :param params: names of parameters to set, default all parameters in registry order (lst)
+        :param values: values of parameters to set, default the prior values (arr)
+        :return: parameter vector in registry order (arr)
+        """
+        x = self.xb.copy()
+        if values is None:
+            return x
+        if params is None or tuple(params) == self.names:
+            x[:] = values
+        else:
+            x[[self.index[param] for param in params]] = values
+        return x
+
+    def inside_bnds(self, x):
+        """
+        Moves parameter values on or outside a bound just inside it, so that the log and logit transforms are finite
+        :param x: parameter vector or ensemble of parameter vectors, one per row (arr)
+        :return: clipped parameter vector or ensemble (arr)
+        """
+        low, high = self.bnds[:, 0], self.bnds[:, 1]
+        eps = 1e-12 * np.where(np.isfinite(high - low), high - low, 1.)
+        return np.clip(x, low + eps, high - eps)
+
+    def to_unbounded(self, x):
+        """
+        Maps parameter values to the unbounded space of the transforms, values on a bound are moved just inside it
+        :param x: parameter vector or ensemble of parameter vectors, one per row (arr)
+        :return: transformed parameter vector or ensemble (arr)
+        """
+        x = np.array(x, dtype=float)
+        low, high = self.bnds[:, 0], self.bnds[:, 1]
+        x_in = self.inside_bnds(x)
+        z = x.copy()
+        z[..., self._log] = np.log(x_in[..., self._log] - low[self._log])
+        z[..., self._logit] = np.log((x_in[..., self._logit] - low[self._logit]) /
+                                     (high[self._logit] - x_in[..., self._logit]))
+        return z
+
+    def to_model(self, z):
+        """
+        Maps transformed parameter values back to parameter values, which are always within the bounds of log and logit
+        transformed parameters, log transformed parameters with an upper bound are clipped to it
+        :param z: transformed parameter vector or ensemble of parameter vectors, one per row (arr)
+        :return: parameter vector or ensemble (arr)
+        """
+        z = np.array(z, dtype=float)
+        low, high = self.bnds[:, 0], self.bnds[:, 1]
+        x = z.copy()
+        x[..., self._log] = np.minimum(low[self._log] + np.exp(z[..., self._log]), high[self._log])
+        x[..., self._logit] = low[self._logit] + (high[self._logit] - low[self._logit]) / \
+            (1. + np.exp(-z[..., self._logit]))
+        return x
+
+    def jacobian(self, x):
+        """
+        Returns the derivative of the transformed parameters with respect to the parameter values, used to map prior
+        standard deviations into the unbounded space. Values on a bound are moved just inside it, as in to_unbounded
+        :param x: parameter vector (arr)
+        :return: derivative of each transformed parameter (arr)
+        """
+        x = self.inside_bnds(np.asarray(x, dtype=float))
+        low, high = self.bnds[:, 0], self.bnds[:, 1]
+        jac = np.ones(len(self))
+        jac[self._log] = 1. / (x[self._log] - low[self._log])
+        jac[self._logit] = (high[self._logit] - low[self._logit]) / \
+            ((x[self._logit] - low[self._logit]) * (high[self._logit] - x[self._logit]))
+        return jac
+
+    def unbounded_bnds(self):
+        """
+        Returns the bounds of the transformed parameters, infinite for log and logit transformed parameters
+        :return: (low, high) bounds for each parameter (tuple)
+        """
+        return tuple((-np.inf, np.inf) if kind != 'none' else bnd for kind, bnd in zip(self.kinds, self.val_bnds))
+
+    def write_nml(self, j, x):
+        """
+        Writes a parameter vector into the nml files of a JULES run
+        :param j: instance of Jules class to update (jules.Jules)
+        :param x: parameter vector in registry order (arr)
+        :return: n/a
+        """
+        for (filename, nml, param, idx), value in zip(self.locs, x):
+            if idx is not None:
+                j.nml(filename)[nml][param][idx] = value
+            else:
+                j.nml(filename)[nml][param] = value
+
+
+def default_space():
+    """
+    Returns the parameter registry of the parameters in es.opt_params, built on first use and shared afterwards
+    :return: ParamSpace instance (obj)
+    """
+    global _default_space
+    if _default_space is None:
+        _default_space = ParamSpace(es.opt_params)
+    return _default_space
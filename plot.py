@@ -1,17 +1,26 @@
 # 3rd party python modules:
 import numpy as np
-import datetime as dt
 import netCDF4 as nc
 import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
 import seaborn as sns
 import glob
 import pickle
+import multiprocessing as mp
 # local modules:
 import fourdenvar
+import ensemble_store
+import instrument
+import scheduler
 import experiment_setup as es
 
 
+# variable, level index, y-axis label and file name of twin experiment plots made by save_plots
+twin_plots = [('gpp', 7, r'Gross Primary Productivity (g C m$^{-2}$ day$^{-1}$)', 'gpp.png'),
+              ('lai', 7, r'Leaf Area Index (m$^{2}$ m$^{-2}$)', 'lai.png'),
+              ('canht', 7, r'Canopy Height (m)', 'canht.png'),
+              ('cropharvc', 2, r'Harvestable Material (kg C m$^{-2}$)', 'harvc.png')]
+
+
 def extract_ens_obs(nc_dir, var, lvl_idx=7):
     """
     Function that extracts modelled observations from an ensemble of JULES outputs
@@ -20,22 +29,53 @@ def extract_ens_obs(nc_dir, var, lvl_idx=7):
     :param lvl_idx: level index for variable, if no level index exists this is ignored (int)
     :return: JULES output variable for each ensemble member (arr)
     """
-    xbs = []
+    return extract_ens_vars(nc_dir, [(var, lvl_idx)])[var]
+
+
+def extract_ens_vars(nc_dir, var_lvls):
+    """
+    Function that extracts several variables from an ensemble of JULES outputs in a single pass. If the ensemble has
+    been consolidated (see ensemble_store.consolidate) all members are sliced from the memory mapped store at once,
+    otherwise each member file is opened once
+    :param nc_dir: directory where JULES ensemble output is saved (str)
+    :param var_lvls: list of tuples of output variable (str) and level index (int) to extract (lst)
+    :return: dictionary of JULES output variable for each ensemble member (dict)
+    """
+    store = ensemble_store.open_store(nc_dir)
+    needed = set(var for var, lvl_idx in var_lvls) | set('cropreservec' for var, lvl_idx in var_lvls
+                                                         if var == 'cropstemc')
+    if store is not None and all(var in store for var in needed):
+        return {var: np.array(select_var(store.var, var, lvl_idx, n_lead=1)[store.members])
+                for var, lvl_idx in var_lvls}
+    ens_vars = {var: [] for var, lvl_idx in var_lvls}
     for xb_fname in glob.glob(nc_dir+'/*.nc'):
         xbi_nc = nc.Dataset(xb_fname, 'r')
-        if len(xbi_nc.variables[var].shape) == 3:
-            xi = xbi_nc.variables[var][:, 0, 0]
-        elif var == 'gpp':
-            xi = 1000 * 60 * 60 * 24 * xbi_nc.variables[var][:, lvl_idx, 0, 0]
-        elif var == 'cropyield':
-            xi = np.max(xbi_nc.variables[var][:, lvl_idx, 0, 0])
-        elif var == 'cropstemc':
-           xi = xbi_nc.variables['cropstemc'][:, lvl_idx, 0, 0] + xbi_nc.variables['cropreservec'][:, lvl_idx, 0, 0]
-        else:
-            xi = xbi_nc.variables[var][:, lvl_idx, 0, 0]
-        xbs.append(xi)
+        for var, lvl_idx in var_lvls:
+            ens_vars[var].append(select_var(lambda v: xbi_nc.variables[v], var, lvl_idx))
         xbi_nc.close()
-    return np.array(xbs)
+    return {var: np.array(ens_vars[var]) for var in ens_vars}
+
+
+def select_var(get_var, var, lvl_idx=7, n_lead=0):
+    """
+    Function that selects a plotted variable from JULES output
+    :param get_var: function returning a JULES output variable given its name (func)
+    :param var: output variable to select (str)
+    :param lvl_idx: level index for variable, if no level index exists this is ignored (int)
+    :param n_lead: number of leading dimensions before the time dimension, 1 for a consolidated ensemble (int)
+    :return: selected JULES output variable (arr)
+    """
+    if len(get_var(var).shape) - n_lead == 3:
+        xi = get_var(var)[..., 0, 0]
+    elif var == 'gpp':
+        xi = 1000 * 60 * 60 * 24 * get_var(var)[..., lvl_idx, 0, 0]
+    elif var == 'cropyield':
+        xi = np.max(get_var(var)[..., lvl_idx, 0, 0], axis=-1)
+    elif var == 'cropstemc':
+        xi = get_var('cropstemc')[..., lvl_idx, 0, 0] + get_var('cropreservec')[..., lvl_idx, 0, 0]
+    else:
+        xi = get_var(var)[..., lvl_idx, 0, 0]
+    return xi
 
 
 def calc_mean_upp_low(x_ens):
@@ -53,14 +93,14 @@ def calc_mean_upp_low(x_ens):
     return x_mean, up_x, low_x
 
 
-def plot_twin_spread(times, var, xb_dir, xa_dir, xt_var=None, obs=None, ob_pos=None, err=None, ylab=None,
+def plot_twin_spread(times, var, xb_ens, xa_ens, xt_var=None, obs=None, ob_pos=None, err=None, ylab=None,
                      lvl_idx=7, axes=None):
     """
     Function to plot data assimilation prior and posterior experiment output for given variable
     :param times: array of times for x-axis (arr)
     :param var: JULES model variable to plot (str)
-    :param xb_dir: directory of prior ensemble output (str)
-    :param xa_dir: directory of posterior ensemble output (str)
+    :param xb_ens: prior ensemble of output variable, or directory of prior ensemble output (arr or str)
+    :param xa_ens: posterior ensemble of output variable, or directory of posterior ensemble output (arr or str)
     :param xt_var: model truth model output for plotted variable !optional! (arr)
     :param obs: assimilated observations !optional! (arr)
     :param ob_pos: position of assimilated observations !optional! (arr)
@@ -79,8 +119,10 @@ def plot_twin_spread(times, var, xb_dir, xa_dir, xt_var=None, obs=None, ob_pos=N
     elif axes is not None:
         ax = axes
         ret_val = ax
-    xb_ens = extract_ens_obs(xb_dir, var, lvl_idx=lvl_idx)
-    xa_ens = extract_ens_obs(xa_dir, var, lvl_idx=lvl_idx)
+    if isinstance(xb_ens, str):
+        xb_ens = extract_ens_obs(xb_ens, var, lvl_idx=lvl_idx)
+    if isinstance(xa_ens, str):
+        xa_ens = extract_ens_obs(xa_ens, var, lvl_idx=lvl_idx)
     xb_mean, up_xb, low_xb = calc_mean_upp_low(xb_ens)
     xa_mean, up_xa, low_xa = calc_mean_upp_low(xa_ens)
     ax.plot(times, xb_mean, '-', color=palette[0], label='prior')
@@ -162,46 +204,71 @@ def plot_mult_dist(xa_ens, xb_ens, p_keys, x_true=None):
     return fig, ax
 
 
-def save_plots(xa_ens_pickle, out_dir):
+@instrument.traced()
+def save_plots(xa_ens_pickle, out_dir, jda=None, processes=None):
     """
-    Function saving plots from data assimilatoin experiment output
+    Function saving plots from data assimilatoin experiment output. All plotted variables are extracted in a single
+    pass over each ensemble and the figures are rendered in parallel worker processes
     :param xa_ens_pickle: location of pickled posterior ensemble arr (str)
     :param out_dir: directory to save plots in (str)
+    :param jda: FourDEnVar instance holding the prior ensemble and observations, created if not given !optional! (obj)
+    :param processes: number of processes to render figures with, default derived from available cores (int)
     :return: string confirming plots have been saved (str)
     """
+    if jda is None:
+        jda = fourdenvar.FourDEnVar()
+    obs = jda.obs_dic
+    var_lvls = [(var, lvl_idx) for var, lvl_idx, ylab, fname in twin_plots]
     dat_xt = nc.Dataset('output/model_truth/mod_truth.daily.nc', 'r')
-    jda = fourdenvar.FourDEnVar()
-    obs = es.obs_fn()
-    date = nc.num2date(dat_xt.variables['time'][:], dat_xt.variables['time'].units)
-    xb_dir = es.output_directory + '/ensemble' + str(es.seed_value)
-    xa_dir = es.output_directory + '/ensemble_xa_' + str(es.seed_value)
-    #plot GPP
-    fig, ax = plot_twin_spread(date[:], 'gpp', xb_dir, xa_dir,
-                             xt_var=1000 * 60 * 60 * 24 * dat_xt.variables['gpp'][:,7,0,0],
-                             ob_pos=obs['gpp_pos'], obs=obs['gpp_obs'], err=obs['gpp_err'],
-                             ylab=r'Gross Primary Productivity (g C m$^{-2}$ day$^{-1}$)')
-    fig.savefig(out_dir+'/gpp.png', bbox_inches='tight')
-    #plot LAI
-    fig, ax = plot_twin_spread(date[:], 'lai', xb_dir, xa_dir,
-                                 xt_var=dat_xt.variables['lai'][:,7,0,0],
-                                 ob_pos=obs['lai_pos'], obs=obs['lai_obs'], err=obs['lai_err'],
-                                 ylab=r'Leaf Area Index (m$^{2}$ m$^{-2}$)')
-    fig.savefig(out_dir + '/lai.png', bbox_inches='tight')
-    #plot Canht
-    fig, ax = plot_twin_spread(date[:], 'canht', xb_dir, xa_dir,
-                                xt_var=dat_xt.variables['canht'][:, 7, 0, 0],
-                                ob_pos=obs['canht_pos'], obs=obs['canht_obs'], err=obs['canht_err'],
-                                ylab=r'Canopy Height (m)')
-    fig.savefig(out_dir + '/canht.png', bbox_inches='tight')
-    #plot harvestable material
-    fig, ax = plot_twin_spread(date[:], 'cropharvc', xb_dir, xa_dir,
-                                   xt_var=dat_xt.variables['cropharvc'][:, 2, 0, 0],
-                                   ylab=r'Harvestable Material (kg C m$^{-2}$)', lvl_idx=2)
-    fig.savefig(out_dir + '/harvc.png', bbox_inches='tight')
+    # python datetimes, which matplotlib can plot, rather than cftime dates
+    date = nc.num2date(dat_xt.variables['time'][:], dat_xt.variables['time'].units, only_use_cftime_datetimes=False,
+                       only_use_python_datetimes=True)
+    xt_vars = {var: select_var(lambda v: dat_xt.variables[v][:], var, lvl_idx) for var, lvl_idx in var_lvls}
+    dat_xt.close()
+    xb_vars = extract_ens_vars(es.output_directory + '/ensemble' + str(es.seed_value), var_lvls)
+    xa_vars = extract_ens_vars(es.output_directory + '/ensemble_xa_' + str(es.seed_value), var_lvls)
+    tasks = []
+    for var, lvl_idx, ylab, fname in twin_plots:
+        kwargs = {'xt_var': xt_vars[var], 'ylab': ylab, 'lvl_idx': lvl_idx}
+        if var + '_obs' in obs:
+            kwargs.update({'ob_pos': obs[var + '_pos'], 'obs': obs[var + '_obs'], 'err': obs[var + '_err']})
+        tasks.append((out_dir + '/' + fname, plot_twin_spread, (date[:], var, xb_vars[var], xa_vars[var]), kwargs))
     #plot distribution
     true_params = {'alpha_io': 5.5e-02, 'neff_io': 5.7e-04, 'fd_io': 9.6e-03, 'mu_io': 2.0e-02, 'nu_io': 4.0e+00,
                    'gamma_io': 1.76e+01, 'delta_io':-3.3e-01}
     xa_ens = pickle.load(open(xa_ens_pickle, 'rb'))
-    fig, ax = plot_mult_dist(xa_ens, jda.xbs, jda.p_keys, true_params)
-    fig.savefig(out_dir + '/distributions.png', bbox_inches='tight')
-    return 'plots saved!'
\ No newline at end of file
+    tasks.append((out_dir + '/distributions.png', plot_mult_dist, (xa_ens, jda.to_model(jda.xbs), jda.p_keys,
+                                                                    true_params), {}))
+    if processes is None:
+        processes = scheduler.default_workers(len(tasks), max_workers=es.num_processes)
+    if processes > 1:
+        pool = mp.Pool(processes=processes, initializer=use_agg)
+        pool.map(render_figure, tasks)
+        pool.close()
+        pool.join()
+    else:
+        for task in tasks:
+            render_figure(task)
+    return 'plots saved!'
+
+
+def use_agg():
+    """
+    Switches matplotlib to the non-interactive Agg backend, used to initialise figure rendering worker processes
+    :return: n/a
+    """
+    plt.switch_backend('Agg')
+
+
+def render_figure(task):
+    """
+    Function rendering and saving a single figure, used by save_plots
+    :param task: tuple of file name to save figure to (str), plotting function returning figure and axis objects (func),
+                 positional arguments (tuple) and keyword arguments (dict) for plotting function
+    :return: file name of saved figure (str)
+    """
+    fname, plot_fn, args, kwargs = task
+    fig, ax = plot_fn(*args, **kwargs)
+    fig.savefig(fname, bbox_inches='tight')
+    plt.close(fig)
+    return fname
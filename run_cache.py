@@ -0,0 +1,165 @@
+# core python modules:
+import os
+import time
+import glob
+import copy
+import shutil as sh
+import hashlib
+
+
+class RunCache:
+    """
+    Content addressed cache of JULES output. Runs are keyed on a hash of the parameter values, the patched nml files and
+    the model executable, so that identical runs are never repeated. Cached output is copied into place on a hit, cached
+    files are read only so that they cannot be changed through an ensemble member's output.
+    :param cache_dir: directory to store cached JULES output in (str)
+    :param max_bytes: maximum total size of cache in bytes, None for no limit (float)
+    :param max_age: maximum time since an entry was last used in seconds, None for no limit (float)
+    """
+    def __init__(self, cache_dir, max_bytes=None, max_age=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, nml_dic, values=None, jules_exe=None):
+        """
+        Calculates the key for a JULES run. The run_id and output_dir are excluded as they do not change the output
+        :param nml_dic: dictionary of patched nml files for the run (dict)
+        :param values: parameter values for the run (arr)
+        :param jules_exe: location of JULES executable (str)
+        :return: key (str)
+        """
+        sha = hashlib.sha1()
+        for filename in sorted(nml_dic.keys()):
+            nml = nml_dic[filename]
+            if filename == 'output':
+                nml = copy.deepcopy(nml)
+                nml['jules_output']['run_id'] = ''
+                nml['jules_output']['output_dir'] = ''
+            sha.update((filename + '\n' + str(nml)).encode())
+        if values is not None:
+            sha.update(repr([float(v) for v in values]).encode())
+        if jules_exe is not None:
+            sha.update(jules_exe.encode())
+            if os.path.exists(jules_exe):
+                stat = os.stat(jules_exe)
+                sha.update(repr((stat.st_mtime, stat.st_size)).encode())
+        return sha.hexdigest()
+
+    def fetch(self, key, out_dir, run_id):
+        """
+        Copies cached output for a run into place
+        :param key: key of run (str)
+        :param out_dir: directory to copy JULES output into (str)
+        :param run_id: JULES run_id to name copied output with (str)
+        :return: Bool, True if the run was found in the cache
+        """
+        entry = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(entry):
+            return False
+        for f in glob.glob(entry + '/*.nc'):
+            dst = os.path.join(out_dir, run_id + '.' + os.path.basename(f))
+            if os.path.exists(dst):
+                os.remove(dst)
+            copy_file(f, dst)
+        # mark entry as recently used for eviction
+        os.utime(entry, None)
+        return True
+
+    def store(self, key, out_dir, run_id):
+        """
+        Stores the output of a run in the cache, dump files are not stored
+        :param key: key of run (str)
+        :param out_dir: directory containing JULES output (str)
+        :param run_id: JULES run_id of output (str)
+        :return: n/a
+        """
+        entry = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry):
+            return
+        tmp_entry = entry + '.tmp' + str(os.getpid())
+        os.makedirs(tmp_entry)
+        for f in glob.glob(os.path.join(out_dir, run_id + '.*.nc')):
+            profile = os.path.basename(f)[len(run_id) + 1:]
+            if profile.startswith('dump.'):
+                continue
+            copy_file(f, os.path.join(tmp_entry, profile), read_only=True)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # entry stored by another process in the meantime
+            sh.rmtree(tmp_entry)
+
+    def entry_file(self, key, name):
+        """
+        Returns the location of a file stored in the cache, e.g. a JULES dump file from a spin-up run
+        :param key: key of run (str)
+        :param name: name of file in cache entry (str)
+        :return: location of cached file, None if not in cache (str)
+        """
+        f = os.path.join(self.cache_dir, key, name)
+        if not os.path.exists(f):
+            return None
+        os.utime(os.path.join(self.cache_dir, key), None)
+        return f
+
+    def store_file(self, key, src, name):
+        """
+        Moves a file into the cache, e.g. a JULES dump file from a spin-up run
+        :param key: key of run (str)
+        :param src: file to store (str)
+        :param name: name of file in cache entry (str)
+        :return: location of cached file (str)
+        """
+        entry = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(entry):
+            tmp_entry = entry + '.tmp' + str(os.getpid())
+            os.makedirs(tmp_entry)
+            sh.move(src, os.path.join(tmp_entry, name))
+            os.chmod(os.path.join(tmp_entry, name), 0o444)
+            try:
+                os.rename(tmp_entry, entry)
+            except OSError:
+                # entry stored by another process in the meantime
+                sh.rmtree(tmp_entry)
+        return os.path.join(entry, name)
+
+    def evict(self):
+        """
+        Removes entries from the cache that have not been used within max_age and then the least recently used entries
+        until the cache is smaller than max_bytes
+        :return: number of entries removed (int)
+        """
+        entries = []
+        for entry in glob.glob(os.path.join(self.cache_dir, '*')):
+            if not os.path.isdir(entry) or '.tmp' in os.path.basename(entry):
+                continue
+            size = sum(os.path.getsize(f) for f in glob.glob(entry + '/*'))
+            entries.append((os.path.getmtime(entry), size, entry))
+        entries.sort()
+        total = sum(e[1] for e in entries)
+        n_removed = 0
+        for last_used, size, entry in entries:
+            too_old = self.max_age is not None and time.time() - last_used > self.max_age
+            too_big = self.max_bytes is not None and total > self.max_bytes
+            if not (too_old or too_big):
+                continue
+            sh.rmtree(entry, ignore_errors=True)
+            total -= size
+            n_removed += 1
+        return n_removed
+
+
+def copy_file(src, dst, read_only=False):
+    """
+    Copies the contents of a file, the copy never shares its data with src so that changing one leaves the other intact
+    :param src: source file (str)
+    :param dst: destination file (str)
+    :param read_only: switch to make the copy read only (bool)
+    :return: n/a
+    """
+    sh.copyfile(src, dst)
+    if read_only is True:
+        os.chmod(dst, 0o444)
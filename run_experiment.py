@@ -1,10 +1,12 @@
 # core python modules:
 import os
 import sys
+import time
+import hashlib
 from functools import partial
-from contextlib import contextmanager
 # 3rd party modules:
 import multiprocessing as mp
+import numpy as np
 import shutil as sh
 import glob
 import pickle
@@ -12,31 +14,33 @@ import pickle
 import fourdenvar
 import experiment_setup as es
 import run_jules as rjda
+import jules
+import run_cache
+import scheduler
+import ensemble_store
+import instrument
+import observations
+import emulator
+import param_space
 
 
-@contextmanager
-def poolcontext(*args, **kwargs):
-    """
-    Function to control the parallel run of other functions
-    :param args:
-    :param kwargs:
-    :return:
-    """
-    pool = mp.Pool(*args, **kwargs)
-    yield pool
-    pool.terminate()
-
-
-def ens_member_run(ens_number_xi, seed_val=0, params=None, xa=False):
+def ens_member_run(ens_number_xi, seed_val=0, params=None, xa=False, use_cache=True, out_vars=None, init_dumps=None,
+                   ens_name=None):
     """
     Function to run a prior or posterior ensemble member
     :param ens_number_xi: tuple of ensemble member number (int) and corresponding parameter vector (arr)
     :param seed_val: seed value used for any perturbations within experiment (int)
     :param params: parameters to update in ensemble member run (lst)
     :param xa: specify if this is a prior or posterior ensemble member (bool)
+    :param use_cache: switch to reuse output of identical JULES runs from the run cache (bool)
+    :param out_vars: JULES output variables to write, None to use the profile in output.nml (lst)
+    :param init_dumps: spin-up dump file to start each ensemble member from, None to use initial_conditions.nml (lst)
+    :param ens_name: name of ensemble output directory, default 'ensemble' or 'ensemble_xa_' if xa is True (str)
     :return: string confirming ensemble member has run (str)
     """
-    if xa is True:
+    if ens_name is not None:
+        ens_dir = '/' + ens_name
+    elif xa is True:
         ens_dir = '/ensemble_xa_'
     else:
         ens_dir = '/ensemble'
@@ -45,80 +49,295 @@ def ens_member_run(ens_number_xi, seed_val=0, params=None, xa=False):
     out_dir = 'output_seed' +str(seed_val) + '_ens_' + str(ens_number) + '/'
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
-    for file in glob.glob(es.nml_directory + '/*.nml'):
-        sh.copy(file, out_dir)
     try:
-        rj = rjda.RunJulesDa(params=params, values=xi, nml_dir=out_dir)
-        if not os.path.exists(es.output_directory + ens_dir + str(seed_val)):
-            os.makedirs(es.output_directory + ens_dir + str(seed_val))
-        rj.run_jules_dic(output_name='ens'+str(ens_number), out_dir=es.output_directory+ens_dir+str(seed_val))
-        dumps = glob.glob(es.output_directory+ens_dir + str(seed_val) + '/ens'+str(ens_number)+'.dump*')
-        for f in dumps:
-            os.remove(f)
-        sh.rmtree(out_dir)
-    except ValueError:
-        sh.rmtree(out_dir)
-        print 'Something went wrong at: ' + str(ens_number)
+        with instrument.span('ens_member_run', member=ens_number, xa=xa) as sp:
+            # only the nml files patched for this member are written, the rest are linked to the parsed template
+            with instrument.span('patch_nml', member=ens_number):
+                rj = rjda.RunJulesDa(params=params, values=xi, nml_dir=out_dir,
+                                     template=jules.nml_template(es.nml_directory))
+                if not os.path.exists(es.output_directory + ens_dir + str(seed_val)):
+                    os.makedirs(es.output_directory + ens_dir + str(seed_val))
+                init_dump = init_dumps[ens_number] if init_dumps is not None else None
+                j = rj.patch_nml(output_name='ens'+str(ens_number),
+                                 out_dir=es.output_directory+ens_dir+str(seed_val), out_vars=out_vars,
+                                 init_dump=init_dump)
+            # look up identical run in cache before running JULES
+            sp['cache_hit'] = False
+            if use_cache is True:
+                cache = run_cache.RunCache(es.run_cache_dir)
+                key = cache.key(j.nml_dic, values=xi, jules_exe=j.jules)
+                sp['cache_hit'] = cache.fetch(key, es.output_directory+ens_dir+str(seed_val), 'ens'+str(ens_number))
+                if sp['cache_hit'] is False:
+                    j.run_jules()
+                    cache.store(key, es.output_directory+ens_dir+str(seed_val), 'ens'+str(ens_number))
+            else:
+                j.run_jules()
+            with instrument.span('dump_cleanup', member=ens_number):
+                dumps = glob.glob(es.output_directory+ens_dir + str(seed_val) + '/ens'+str(ens_number)+'.dump*')
+                for f in dumps:
+                    os.remove(f)
+    except Exception:
+        print('Something went wrong at: ' + str(ens_number))
+        raise
+    finally:
+        sh.rmtree(out_dir, ignore_errors=True)
     return 'ensemble member '+ str(ens_number) + ' run!'
 
 
-def ens_run(x_ens, seed_val=0, xa=False, params=None):
+def spinup_member_run(key_xi, params=None):
+    """
+    Function to run a JULES spin-up and store the dumped state at the start of the main run in the spin-up cache
+    :param key_xi: tuple of spin-up key (str) and corresponding parameter vector (arr)
+    :param params: parameters to update in spin-up run (lst)
+    :return: string confirming spin-up has run (str)
+    """
+    key = key_xi[0]
+    xi = key_xi[1]
+    cache = run_cache.RunCache(es.spinup_dir)
+    if cache.entry_file(key, 'dump.nc') is not None:
+        return 'spin-up ' + key + ' cached!'
+    nml_dir = 'spinup_' + key[:12] + '/'
+    out_dir = os.path.join(es.spinup_dir, 'run_' + key[:12])
+    for d in (nml_dir, out_dir):
+        if not os.path.exists(d):
+            os.makedirs(d)
+    try:
+        with instrument.span('spinup_member_run', key=key):
+            rj = rjda.RunJulesDa(params=params, values=xi, nml_dir=nml_dir,
+                                 template=jules.nml_template(es.nml_directory))
+            cache.store_file(key, rj.run_spinup(out_dir, es.spinup_cycles), 'dump.nc')
+    except Exception:
+        print('Something went wrong at spin-up: ' + key)
+        raise
+    finally:
+        sh.rmtree(nml_dir, ignore_errors=True)
+        sh.rmtree(out_dir, ignore_errors=True)
+    return 'spin-up ' + key + ' run!'
+
+
+def prior_values(params):
+    """
+    Finds the prior values of parameters from the experiment setup
+    :param params: list of parameter names (lst)
+    :return: prior parameter values (arr)
+    """
+    space = param_space.default_space()
+    return np.array([space.xb[space.index[param]] for param in params])
+
+
+@instrument.traced()
+def spinup_ens(x_ens, params):
+    """
+    Runs the JULES spin-ups needed by an ensemble. The spin-up is run once for each distinct set of values of the
+    parameters in es.spinup_params (once with the prior parameters if None), all other parameters are held at their
+    prior values. Dumps are kept in a cache so that spin-ups are shared between ensembles and experiments
+    :param x_ens: ensemble of parameter vectors (arr)
+    :param params: list of parameters being updated in experiment (lst)
+    :return: spin-up dump file to start each ensemble member from (lst)
+    """
+    params = list(params)
+    x_prior = prior_values(params)
+    spin_idx = [params.index(p) for p in es.spinup_params if p in params] if es.spinup_params is not None else []
+    cache = run_cache.RunCache(es.spinup_dir, max_age=es.run_cache_max_age)
+    template = jules.nml_template(es.nml_directory)
+    keys = []
+    spins = {}
+    for xi in x_ens:
+        x_spin = x_prior.copy()
+        x_spin[spin_idx] = np.asarray(xi)[spin_idx]
+        # key on the base nml files, spin-up values and number of cycles so that any change forces a new spin-up
+        key = cache.key(template.nml_dic, values=list(x_spin) + [es.spinup_cycles], jules_exe=es.model_exe)
+        keys.append(key)
+        spins[key] = x_spin
+    stale = [key for key in sorted(spins.keys()) if cache.entry_file(key, 'dump.nc') is None]
+    print('Running ' + str(len(stale)) + ' of ' + str(len(spins)) + ' spin-ups')
+    if len(stale) > 0:
+        sched = scheduler.EnsembleScheduler(partial(spinup_member_run, params=params), n_workers=es.num_processes,
+                                            retries=es.member_retries, mem_per_task=es.member_memory)
+        sched.run([(num, (key, spins[key])) for num, key in enumerate(stale)])
+    cache.evict()
+    dumps = [cache.entry_file(key, 'dump.nc') for key in keys]
+    if None in dumps:
+        raise RuntimeError('Spin-up failed for ' + str(dumps.count(None)) + ' ensemble members')
+    return dumps
+
+
+@instrument.traced()
+def ens_run(x_ens, seed_val=0, xa=False, params=None, use_cache=True, out_vars=None, ens_name=None, on_result=None):
     """
-    Perform a parallel run of JULES models given an ensemble of paramter vectors
+    Perform a parallel run of JULES models given an ensemble of paramter vectors. Members are run by an ensemble
+    scheduler with per-member timeouts and retries, progress is recorded in a state file so that an interrupted ensemble
+    resumes from the members it has not finished
     :param x_ens: ensemble of paramter vectors (arr)
     :param seed_val: seed value used for any perturbations in the experiment (int)
     :param xa: switch if this is a prior or posterior ensemble run (bool)
     :param params: list of paramters being updated in experiment (lst)
-    :return: string confirming if the ensemble has been run (str)
+    :param use_cache: switch to reuse output of identical JULES runs from the run cache (bool)
+    :param out_vars: JULES output variables to write, None to use the profile in output.nml (lst)
+    :param ens_name: name of ensemble output directory, default 'ensemble' or 'ensemble_xa_' if xa is True (str)
+    :param on_result: function called with the member number as each member finishes, returning True stops further
+                      members being launched, see scheduler.EnsembleScheduler.run !optional! (func)
+    :return: summary of ensemble run (dict)
     """
-    print 'Running ensemble'
+    print('Running ensemble')
     mp.freeze_support()
-    with poolcontext(processes=es.num_processes) as pool:
-        res = pool.map(partial(ens_member_run, seed_val=seed_val, params=params, xa=xa), enumerate(x_ens))
-    pool.close()
-    pool.join()
-    return 'Ensemble has been run'
+    if ens_name is not None:
+        ens_dir = es.output_directory + '/' + ens_name + str(seed_val)
+    elif xa is True:
+        ens_dir = es.output_directory + '/ensemble_xa_' + str(seed_val)
+    else:
+        ens_dir = es.output_directory + '/ensemble' + str(seed_val)
+    if not os.path.exists(ens_dir):
+        os.makedirs(ens_dir)
+    # parse nml files once before starting workers so that each worker inherits the parsed template
+    jules.nml_template(es.nml_directory)
+    init_dumps = spinup_ens(x_ens, params) if es.spinup_cycles > 0 else None
+    sched = scheduler.EnsembleScheduler(partial(ens_member_run, seed_val=seed_val, params=params, xa=xa,
+                                                use_cache=use_cache, out_vars=out_vars, init_dumps=init_dumps,
+                                                ens_name=ens_name),
+                                        n_workers=es.num_processes, timeout=es.member_timeout,
+                                        retries=es.member_retries, state_file=ens_dir + '_state.json',
+                                        mem_per_task=es.member_memory)
+    key = hashlib.sha1(np.ascontiguousarray(x_ens, dtype=float).tobytes() +
+                       repr((params, out_vars, init_dumps)).encode()).hexdigest()
+    if sched.load_state(key) is False:
+        # remove any old output in folders if not resuming a previous run of this ensemble
+        for f in glob.glob(ens_dir + '/*.nc'):
+            os.remove(f)
+    summary = sched.run([(num, (num, xi)) for num, xi in enumerate(x_ens)], key=key, on_result=on_result)
+    if len(summary['done']) > 0:
+        # pack member output into a memory mapped store for extraction and plotting
+        ensemble_store.consolidate(ens_dir, len(x_ens), x_ens=x_ens, params=params, processes=es.num_processes)
+    if use_cache is True:
+        run_cache.RunCache(es.run_cache_dir, es.run_cache_max_bytes, es.run_cache_max_age).evict()
+    return summary
+
+
+def stream_member(num, stream, ens_dir):
+    """
+    Adds a finished prior ensemble member to a streaming analysis, used as the on_result function of ens_run
+    :param num: ensemble member number (int)
+    :param stream: streaming analysis of the prior ensemble (fourdenvar.EnsembleStream)
+    :param ens_dir: directory of ensemble output (str)
+    :return: Bool, True once the posterior has stabilised and no more members need to be run
+    """
+    stream.add(num, es.obs_op.extract_vec(ens_dir + '/ens' + str(num) + '.daily.nc'))
+    converged = stream.converged(tol=es.adaptive_tol, min_size=es.adaptive_min_size, patience=es.adaptive_patience)
+    if converged is True:
+        print('Posterior converged with ' + str(len(stream.members)) + ' ensemble members')
+    return converged
+
+
+def adaptive_ens_run(jda, use_cache=True):
+    """
+    Runs the prior ensemble with members streamed into the 4DEnVar analysis as they finish, no further JULES runs are
+    launched once the posterior estimate and spread have stabilised. The prior JULES run (run_xb) must have been run
+    :param jda: FourDEnVar instance, the size of its prior ensemble is the largest ensemble that will be run (obj)
+    :param use_cache: switch to reuse output of identical JULES runs from the run cache (bool)
+    :return: FourDEnVar instance ready for running data assimilation routines with the members that were run (obj)
+    """
+    jda.make_hxb()
+    stream = fourdenvar.EnsembleStream(jda)
+    ens_dir = es.output_directory + '/ensemble' + str(jda.seed_val)
+    ens_run(jda.to_model(jda.xbs), seed_val=jda.seed_val, params=jda.p_keys, use_cache=use_cache,
+            out_vars=es.xb_output_vars, on_result=partial(stream_member, stream=stream, ens_dir=ens_dir))
+    return stream.finish()
+
+
+def outer_loop_hx(x_ens, seed_val=0, params=None, use_cache=True):
+    """
+    Runs JULES for an ensemble recentred on the current estimate in an outer loop of the 4DEnVar minimisation, see
+    fourdenvar.FourDEnVar.outer_loop_min_ens_inc. Only the output needed by the observation operator is written and
+    members already in the run cache are not run again
+    :param x_ens: ensemble of parameter vectors, with the centre of the ensemble as the first row (arr)
+    :param seed_val: seed value used for any perturbations in the experiment (int)
+    :param params: list of parameters being updated in experiment (lst)
+    :param use_cache: switch to reuse output of identical JULES runs from the run cache (bool)
+    :return: ensemble of modelled observations, one member per row (arr)
+    """
+    summary = ens_run(x_ens, seed_val=seed_val, params=params, use_cache=use_cache, out_vars=es.obs_op.variables(),
+                      ens_name='ensemble_outer_')
+    if len(summary['failed']) > 0:
+        raise RuntimeError('Outer loop ensemble members failed: ' + str(summary['failed']))
+    return observations.extract_jules_hxb_ens(ens_dir=es.output_directory + '/ensemble_outer_' + str(seed_val),
+                                              size_ens=len(x_ens))
 
 
 if __name__ == "__main__":
+    # record a trace of the stages of this experiment
+    trace_file = None
+    if es.trace_dir is not None:
+        trace_file = os.path.join(es.trace_dir, 'experiment_seed' + sys.argv[1] + '_' +
+                                  time.strftime('%Y%m%d_%H%M%S') + '.jsonl')
+        instrument.start_trace(trace_file)
     # instantiate JULES data assimilation class
     jda = fourdenvar.FourDEnVar(seed_val=int(sys.argv[1]))
     seed_val = int(sys.argv[1])
     params = jda.p_keys
+    # if '--no-cache' is in system arguments then always run JULES instead of reusing cached output
+    use_cache = '--no-cache' not in sys.argv
     # if 'run_xb' is in system arguments then run JULES with prior parameters
     if 'run_xb' in sys.argv:
         nml_dir = 'output_seed' + str(seed_val) + '_xb/'
         if not os.path.exists(nml_dir):
             os.makedirs(nml_dir)
-        for file in glob.glob(es.nml_directory + '/*.nml'):
-            sh.copy(file, nml_dir)
-        rj = rjda.RunJulesDa(params=params, values=jda.xb, nml_dir=nml_dir)
-        rj.run_jules_dic(output_name='xb' + str(jda.seed_val), out_dir=es.output_directory+'/background/')
+        rj = rjda.RunJulesDa(params=params, values=jda.to_model(jda.xb), nml_dir=nml_dir,
+                             template=jules.nml_template(es.nml_directory))
+        init_dump = spinup_ens([jda.to_model(jda.xb)], params)[0] if es.spinup_cycles > 0 else None
+        rj.run_jules_dic(output_name='xb' + str(jda.seed_val), out_dir=es.output_directory+'/background/',
+                         init_dump=init_dump)
         sh.rmtree(nml_dir)
-    # remove any old output in folders
-    old_outs = glob.glob(es.output_directory + '/ensemble' + str(seed_val) + '/*.nc')
-    for f in old_outs:
-        os.remove(f)
-    # run prior ensemble
-    ens_run(jda.xbs, seed_val=jda.seed_val, params=params)
+    # run prior ensemble, streaming members into the analysis until the posterior stabilises if set
+    if es.adaptive_ensemble is True:
+        jda = adaptive_ens_run(jda, use_cache=use_cache)
+    else:
+        ens_run(jda.to_model(jda.xbs), seed_val=jda.seed_val, params=params, use_cache=use_cache,
+                out_vars=es.xb_output_vars)
     # if 'run_xa' is in system arguments then run posterior ensemble
     if 'run_xa' in sys.argv:
-        jda = fourdenvar.FourDEnVar(assim=True, seed_val=int(sys.argv[1]))
+        if es.adaptive_ensemble is False:
+            jda = fourdenvar.FourDEnVar(assim=True, seed_val=int(sys.argv[1]))
         params = jda.p_keys
-        # find posterior estimate and posterior ensemble
-        xa = jda.find_min_ens_inc()
+        # train emulator of JULES modelled observations on prior ensemble and only use it if validated
+        emu = None
+        if es.emulator_warm_start is True or es.emulator_screen is True:
+            emu = emulator.from_fourdenvar(jda)
+            validation = emu.validate()
+            print('Emulator leave one out error: %.3f observation errors, %.1f%% within 2 sd' %
+                  (validation['rmse'], 100 * validation['coverage']))
+            if validation['rmse'] > es.emulator_max_err:
+                print('Emulator error above emulator_max_err, not using emulator')
+                emu = None
+        # find posterior estimate and posterior ensemble, relinearising around the estimate in outer loops if set
+        if es.outer_loops > 1:
+            w0 = jda.xvals2wvals(emu.find_min(jda)) if emu is not None and es.emulator_warm_start is True else None
+            xa = jda.outer_loop_min_ens_inc(partial(outer_loop_hx, seed_val=jda.seed_val, params=params,
+                                                    use_cache=use_cache),
+                                            max_outer=es.outer_loops, tol=es.outer_loop_tol,
+                                            scale=es.outer_loop_scale, w0=w0)
+            print('Outer loop costs: ' + ', '.join('%.4f' % hist['cost'] for hist in jda.outer_history))
+        else:
+            xa = jda.find_min_ens_inc(method=es.min_method)
         xa_ens = jda.a_ens(xa[1])
-        # pickle posterior parameter ensemble array
+        if emu is not None and es.emulator_screen is True:
+            # do not run posterior members outside the parameter bounds or implausible given the observations
+            keep = emu.screen(xa_ens, jda.yoblist, jda.yerr, jda.val_bnds, cut=es.implausibility_cut)
+            if np.sum(keep) > 1:
+                print('Emulator screened out ' + str(np.sum(~keep)) + ' of ' + str(len(xa_ens)) + ' posterior members')
+                xa_ens = xa_ens[keep]
+            else:
+                print('Emulator found the posterior ensemble implausible, running all members')
+        # pickle posterior parameter ensemble array of JULES parameter values
+        xa_ens = jda.to_model(xa_ens)
         f = open(es.output_directory+'/xa_ens' + str(es.ensemble_size) + '_seed' + sys.argv[1] + '.p', 'wb')
         pickle.dump(xa_ens, f)
         f.close()
-        # remove any old output in folders
-        old_outs = glob.glob(es.output_directory + '/ensemble_xa_' + str(seed_val) + '/*.nc')
-        for f in old_outs:
-            os.remove(f)
         # run posterior ensemble
-        ens_run(xa_ens, seed_val=jda.seed_val, xa=True, params=params)
+        ens_run(xa_ens, seed_val=jda.seed_val, xa=True, params=params, use_cache=use_cache,
+                out_vars=es.xa_output_vars)
     if 'plot' in sys.argv:
         es.save_plots(es.output_directory+'/xa_ens' + str(es.ensemble_size) + '_seed' + sys.argv[1] + '.p',
-                      es.plot_output_dir)
-    print 'Experiment has been run'
\ No newline at end of file
+                      es.plot_output_dir, jda=jda)
+    if trace_file is not None:
+        instrument.report(trace_file)
+    print('Experiment has been run')
\ No newline at end of file
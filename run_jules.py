@@ -1,8 +1,8 @@
-# 3rd party modules:
-import numpy as np
+# core python modules:
+import glob
 # local modules:
 import jules
-import experiment_setup as es
+import param_space
 
 
 def jules_run(parameters=['neff_io'], p_values=[5.7e-4], nml_directory='example_nml',
@@ -28,21 +28,23 @@ class RunJulesDa:
     :param values: either (str) 'default' to run with unchanged parameters or an array of paramter values (arr)
     :param nml_dir: nml directory from which to run JULES (str)
     :param year: year for which to run JULES (int)
+    :param template: parsed base nml files to patch instead of reading nml_dir, see jules.NmlTemplate (obj)
+    :param space: registry of the parameters that can be varied, default param_space.default_space() (obj)
     """
-    def __init__(self, params=['neff_io'], values='default', nml_dir='example_nml', year=2008):
+    def __init__(self, params=['neff_io'], values='default', nml_dir='example_nml', year=2008, template=None,
+                 space=None):
         self.p_keys = params
         self.nml_dir = nml_dir
         self.year = year
-        # mod_truth and background
-        self.p_dict = es.opt_params
-        if values is not 'default':
-            for filename in self.p_dict.keys():
-                for nml in self.p_dict[filename].keys():
-                    for param in self.p_dict[filename][nml].keys():
-                        if param in self.p_keys:
-                            self.p_dict[filename][nml][param][1] = values[np.where(np.array(self.p_keys)==param)[0][0]]
+        self.template = template
+        self.space = param_space.default_space() if space is None else space
+        # mod_truth and background, parameters not in params are held at their prior values
+        if isinstance(values, str) and values == 'default':
+            self.values = self.space.values()
+        else:
+            self.values = self.space.values(self.p_keys, values)
 
-    def run_jules_dic(self, output_name='test', out_dir='../output/test'):
+    def run_jules_dic(self, output_name='test', out_dir='../output/test', out_vars=None, init_dump=None):
         """
         Function that runs JULES with crop model turned on and given user defined parameters. Output is saved in folder
         and file specified within function.
@@ -51,23 +53,99 @@ class RunJulesDa:
         :type output_name: str.
         :param output_dir: Directory for writing JULES output.
         :type output_dir: str.
+        :param out_vars: JULES output variables to write, None to use the profile in the nml files.
+        :type out_vars: list
+        :param init_dump: JULES dump file to start from, None to use the initial conditions in the nml files.
+        :type init_dump: str
         :return: 'Done' to notify used JULES run has finished.
         :rtype: str
         """
-        j = jules.Jules(self.nml_dir)
-        j.nml_dic['output']['jules_output']['run_id'] = output_name
-        j.nml_dic['output']['jules_output']['output_dir'] = out_dir
-        j.nml_dic['timesteps']['jules_time']['main_run_start'] = str(self.year) + '-01-01 06:00:00'
-        j.nml_dic['timesteps']['jules_time']['main_run_end'] = str(self.year+1) + '-01-01 05:00:00'
-        j.nml_dic['timesteps']['jules_spinup']['max_spinup_cycles'] = 0  # 0 2  4
-
-        for filename in self.p_dict.keys():
-            for nml in self.p_dict[filename].keys():
-                for param in self.p_dict[filename][nml].keys():
-                    if self.p_dict[filename][nml][param][0] is not 'None':
-                        j.nml_dic[filename][nml][param][self.p_dict[filename][nml][param][0]] = \
-                            self.p_dict[filename][nml][param][1]
-                    else:
-                        j.nml_dic[filename][nml][param] = self.p_dict[filename][nml][param][1]
+        j = self.patch_nml(output_name=output_name, out_dir=out_dir, out_vars=out_vars, init_dump=init_dump)
         j.run_jules()
         return output_name, 'done'
+
+    def patch_nml(self, output_name='test', out_dir='../output/test', out_vars=None, init_dump=None,
+                  spinup_cycles=0):
+        """
+        Function that reads the nml files and updates them with the output location, run dates and user defined
+        parameters, without running JULES.
+
+        :param output_name: Name to use for outputted JULES netCDF file.
+        :type output_name: str.
+        :param output_dir: Directory for writing JULES output.
+        :type output_dir: str.
+        :param out_vars: JULES output variables to write, None to use the profile in the nml files.
+        :type out_vars: list
+        :param init_dump: JULES dump file to start from, None to use the initial conditions in the nml files.
+        :type init_dump: str
+        :param spinup_cycles: Number of spin-up cycles to run.
+        :type spinup_cycles: int
+        :return: instance of Jules class with updated nml files.
+        :rtype: jules.Jules
+        """
+        j = jules.Jules(self.nml_dir, template=self.template)
+        j.nml('output')['jules_output']['run_id'] = output_name
+        j.nml('output')['jules_output']['output_dir'] = out_dir
+        j.nml('timesteps')['jules_time']['main_run_start'] = str(self.year) + '-01-01 06:00:00'
+        j.nml('timesteps')['jules_time']['main_run_end'] = str(self.year+1) + '-01-01 05:00:00'
+        j.nml('timesteps')['jules_spinup']['max_spinup_cycles'] = spinup_cycles  # 0 2  4
+        if init_dump is not None:
+            j.nml('initial_conditions')['jules_initial']['dump_file'] = True
+            j.nml('initial_conditions')['jules_initial']['file'] = init_dump
+
+        self.space.write_nml(j, self.values)
+        if out_vars is not None:
+            self.set_output_profile(j, out_vars)
+        return j
+
+    def run_spinup(self, out_dir, spinup_cycles):
+        """
+        Function that runs the JULES spin-up followed by a single day of the main run, to produce a dump file of the
+        model state at the start of the main run. No diagnostic output is written.
+
+        :param out_dir: Directory for writing JULES output.
+        :type out_dir: str.
+        :param spinup_cycles: Number of spin-up cycles to run.
+        :type spinup_cycles: int
+        :return: location of dump file at the start of the main run.
+        :rtype: str
+        """
+        j = self.patch_nml(output_name='spinup', out_dir=out_dir, spinup_cycles=spinup_cycles)
+        j.nml('timesteps')['jules_time']['main_run_end'] = str(self.year) + '-01-02 06:00:00'
+        output = j.nml('output')
+        output['jules_output']['nprofiles'] = 0
+        if 'jules_output_profile' in output:
+            del output['jules_output_profile']
+        j.run_jules()
+        dumps = sorted(glob.glob(out_dir + '/spinup.dump.' + str(self.year) + '0101*.nc'))
+        if len(dumps) == 0:
+            raise jules.JulesError('*** runJules: no dump file written at start of main run by spin-up')
+        return dumps[0]
+
+    def set_output_profile(self, j, out_vars):
+        """
+        Function that rewrites the JULES output profile to only write the given variables. The output type and name of
+        each variable are taken from the existing profile where available. If several profiles are defined only the
+        first is kept.
+
+        :param j: instance of Jules class to update.
+        :type j: jules.Jules
+        :param out_vars: JULES output variables to write.
+        :type out_vars: list
+        :return: n/a
+        """
+        output = j.nml('output')
+        profile = output['jules_output_profile']
+        if isinstance(profile, list):
+            profile = profile[0]
+            output['jules_output_profile'] = profile
+            output['jules_output']['nprofiles'] = 1
+        base_vars = profile['var'] if isinstance(profile['var'], list) else [profile['var']]
+        out_types = dict(zip(base_vars, profile['output_type'] if isinstance(profile['output_type'], list)
+                             else [profile['output_type']]))
+        var_names = dict(zip(base_vars, profile['var_name'] if isinstance(profile['var_name'], list)
+                             else [profile['var_name']]))
+        profile['nvars'] = len(out_vars)
+        profile['var'] = list(out_vars)
+        profile['var_name'] = [var_names.get(var, var) for var in out_vars]
+        profile['output_type'] = [out_types.get(var, 'M') for var in out_vars]
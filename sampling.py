@@ -0,0 +1,183 @@
+# core python modules:
+import warnings
+# 3rd party modules:
+import numpy as np
+import scipy.stats as spstats
+import scipy.special as spspec
+try:
+    from scipy.stats import qmc
+except ImportError:  # scipy < 1.7
+    qmc = None
+
+
+def in_bnds(x_ens, val_bnds):
+    """
+    Tests which parameter vectors in an ensemble are within the specified bounds
+    :param x_ens: ensemble of parameter vectors, one per row (arr)
+    :param val_bnds: list of (low, high) bounds for each parameter (lst)
+    :return: boolean mask that is True for parameter vectors within bounds (arr)
+    """
+    bnds = np.asarray(val_bnds, dtype=float)
+    x_ens = np.atleast_2d(x_ens)
+    return np.all((x_ens >= bnds[:, 0]) & (x_ens <= bnds[:, 1]), axis=1)
+
+
+def is_diag(mat):
+    """
+    Tests if a matrix is diagonal
+    :param mat: matrix to test (arr)
+    :return: Bool
+    """
+    return np.count_nonzero(mat - np.diag(np.diagonal(mat))) == 0
+
+
+def rejection_mvn(rng, x, b_mat, size_ens, val_bnds, block_size=1024, max_draws=10**7):
+    """
+    Draws a bounded ensemble from a multivariate normal distribution by rejection. Draws are made in blocks and
+    tested against the bounds with array masks, the block size is adapted to the observed acceptance rate
+    :param rng: random number generator (np.random.Generator)
+    :param x: mean of distribution to draw from (arr)
+    :param b_mat: covariance matrix of distribution to draw from (arr)
+    :param size_ens: size of ensemble to generate (int)
+    :param val_bnds: list of (low, high) bounds for each parameter (lst)
+    :param block_size: minimum number of vectors to draw at once (int)
+    :param max_draws: maximum number of vectors to draw before giving up (int)
+    :return: ensemble of parameter vectors (arr)
+    """
+    chol = np.linalg.cholesky(b_mat)
+    ens = np.empty((size_ens, len(x)))
+    n_acc = 0
+    n_draws = 0
+    acc_rate = 1.
+    while n_acc < size_ens:
+        if n_draws >= max_draws:
+            raise ValueError('Acceptance rate of bounded prior sampling too low (%.2e), consider a diagonal b_mat '
+                             'with the truncnorm design' % acc_rate)
+        n_blk = int(min(max(1.2 * (size_ens - n_acc) / acc_rate, block_size), max_draws - n_draws))
+        x_blk = x + np.dot(rng.standard_normal((n_blk, len(x))), chol.T)
+        x_blk = x_blk[in_bnds(x_blk, val_bnds)]
+        n_draws += n_blk
+        n_new = min(len(x_blk), size_ens - n_acc)
+        ens[n_acc:n_acc + n_new] = x_blk[:n_new]
+        n_acc += n_new
+        acc_rate = max(float(n_acc) / n_draws, 1. / max_draws)
+    return ens
+
+
+def truncnorm_diag(rng, x, sd, size_ens, val_bnds):
+    """
+    Draws an ensemble exactly from independent normal distributions truncated to the specified bounds
+    :param rng: random number generator (np.random.Generator)
+    :param x: mean of distribution to draw from (arr)
+    :param sd: standard deviation of distribution to draw from (arr)
+    :param size_ens: size of ensemble to generate (int)
+    :param val_bnds: list of (low, high) bounds for each parameter (lst)
+    :return: ensemble of parameter vectors (arr)
+    """
+    return truncnorm_ppf(rng.uniform(size=(size_ens, len(x))), x, sd, val_bnds)
+
+
+def truncnorm_ppf(u_ens, x, sd, val_bnds):
+    """
+    Maps points in the unit hypercube to independent normal distributions truncated to the specified bounds
+    :param u_ens: ensemble of points in the unit hypercube, one per row (arr)
+    :param x: mean of distribution (arr)
+    :param sd: standard deviation of distribution (arr)
+    :param val_bnds: list of (low, high) bounds for each parameter (lst)
+    :return: ensemble of parameter vectors (arr)
+    """
+    bnds = np.asarray(val_bnds, dtype=float)
+    a = (bnds[:, 0] - x) / sd
+    b = (bnds[:, 1] - x) / sd
+    x_ens = spstats.truncnorm.ppf(u_ens, a, b, loc=x, scale=sd)
+    # guard against round off placing values fractionally outside bounds
+    return np.clip(x_ens, bnds[:, 0], bnds[:, 1])
+
+
+def unit_design(rng, design, size_ens, n_param):
+    """
+    Generates a space filling design of points in the unit hypercube
+    :param rng: random number generator (np.random.Generator)
+    :param design: 'lhs' for a Latin hypercube, 'sobol' for a scrambled Sobol sequence, 'antithetic' for antithetic
+                   pairs (u, 1-u), with a single unpaired draw for an odd size, or 'random' for independent uniform
+                   draws (str)
+    :param size_ens: number of points to generate (int)
+    :param n_param: dimension of hypercube (int)
+    :return: points in the unit hypercube, one per row (arr)
+    """
+    if design == 'lhs':
+        strata = np.argsort(rng.uniform(size=(size_ens, n_param)), axis=0)
+        return (strata + rng.uniform(size=(size_ens, n_param))) / size_ens
+    elif design == 'sobol':
+        if qmc is None:
+            raise ImportError('sobol design requires scipy >= 1.7')
+        m = int(np.ceil(np.log2(max(size_ens, 2))))
+        if 2**m != size_ens:
+            # the balance properties of the Sobol sequence only hold for the first 2^m points
+            warnings.warn('sobol design of size %d is not balanced, use a power of 2 such as %d' % (size_ens, 2**m))
+        sobol = qmc.Sobol(n_param, scramble=True, seed=rng)
+        return sobol.random_base2(m)[:size_ens]
+    elif design == 'antithetic':
+        u_half = rng.uniform(size=((size_ens + 1) // 2, n_param))
+        return np.vstack((u_half, 1. - u_half))[:size_ens]
+    elif design == 'random':
+        return rng.uniform(size=(size_ens, n_param))
+    else:
+        raise ValueError('Unknown ensemble design: ' + str(design))
+
+
+def design_mvn(rng, design, x, b_mat, size_ens, val_bnds, max_draws=10**6):
+    """
+    Maps a space filling design through a multivariate normal distribution honouring the specified bounds. For a
+    diagonal covariance matrix the design is mapped through the truncated normal inverse CDF so no points are lost,
+    otherwise points outside the bounds are rejected and the design is enlarged until enough points are accepted
+    :param rng: random number generator (np.random.Generator)
+    :param design: design of points in the unit hypercube, see unit_design (str)
+    :param x: mean of distribution (arr)
+    :param b_mat: covariance matrix of distribution (arr)
+    :param size_ens: size of ensemble to generate (int)
+    :param val_bnds: list of (low, high) bounds for each parameter (lst)
+    :param max_draws: maximum size of design before giving up (int)
+    :return: ensemble of parameter vectors (arr)
+    """
+    if is_diag(b_mat):
+        return truncnorm_ppf(unit_design(rng, design, size_ens, len(x)), x, np.sqrt(np.diagonal(b_mat)), val_bnds)
+    chol = np.linalg.cholesky(b_mat)
+    n_design = size_ens
+    while n_design <= max_draws:
+        u_ens = np.clip(unit_design(rng, design, n_design, len(x)), 1e-12, 1. - 1e-12)
+        x_ens = x + np.dot(spspec.ndtri(u_ens), chol.T)
+        x_ens = x_ens[in_bnds(x_ens, val_bnds)]
+        if len(x_ens) >= size_ens:
+            return x_ens[:size_ens]
+        n_design *= 2
+    raise ValueError('Acceptance rate of bounded ' + design + ' design too low, consider a diagonal b_mat')
+
+
+def bounded_ens(x, b_mat, size_ens, val_bnds, seed_val=0, design='random'):
+    """
+    Generates a bounded ensemble of parameter vectors given a mean and covariance matrix
+    :param x: mean of distribution to draw from (arr)
+    :param b_mat: covariance matrix of distribution to draw from (arr)
+    :param size_ens: size of ensemble to generate (int)
+    :param val_bnds: list of (low, high) bounds for each parameter (lst)
+    :param seed_val: seed value for random number generator (int)
+    :param design: 'truncnorm' for exact truncated normal draws (diagonal b_mat only), 'rejection' for blocked
+                   rejection sampling, 'random' to pick truncnorm when b_mat is diagonal and rejection otherwise or
+                   one of the space filling designs 'lhs', 'sobol' and 'antithetic' (str)
+    :return: ensemble of parameter vectors (arr)
+    """
+    rng = np.random.default_rng(seed_val)
+    x = np.asarray(x, dtype=float)
+    if design == 'random':
+        design = 'truncnorm' if is_diag(b_mat) else 'rejection'
+    if design == 'truncnorm':
+        if not is_diag(b_mat):
+            raise ValueError('truncnorm design requires a diagonal b_mat')
+        return truncnorm_diag(rng, x, np.sqrt(np.diagonal(b_mat)), size_ens, val_bnds)
+    elif design == 'rejection':
+        return rejection_mvn(rng, x, b_mat, size_ens, val_bnds)
+    elif design in ('lhs', 'sobol', 'antithetic'):
+        return design_mvn(rng, design, x, b_mat, size_ens, val_bnds)
+    else:
+        raise ValueError('Unknown ensemble design: ' + str(design))
@@ -0,0 +1,202 @@
+# core python modules:
+import os
+import sys
+import time
+import json
+import signal
+import multiprocessing as mp
+from multiprocessing import connection
+
+
+def default_workers(n_tasks, mem_per_task=None, max_workers=None):
+    """
+    Derives the number of worker processes to use from the available cores and memory
+    :param n_tasks: number of tasks to run (int)
+    :param mem_per_task: memory needed by each task in bytes !optional! (float)
+    :param max_workers: upper limit on number of workers !optional! (int)
+    :return: number of workers (int)
+    """
+    n_workers = min(mp.cpu_count(), n_tasks)
+    if mem_per_task is not None:
+        try:
+            avail_mem = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+            n_workers = min(n_workers, int(avail_mem // mem_per_task))
+        except (ValueError, OSError, AttributeError):
+            pass
+    if max_workers is not None:
+        n_workers = min(n_workers, max_workers)
+    return max(n_workers, 1)
+
+
+def run_task(func, arg):
+    """
+    Runs a task in a worker process, in its own process group so that any subprocesses (e.g. JULES) are killed with it
+    :param func: function to run (func)
+    :param arg: argument to pass to function
+    :return: n/a
+    """
+    os.setpgrp()
+    func(arg)
+
+
+class EnsembleScheduler:
+    """
+    Runs the members of an ensemble in worker processes with per-member timeouts and retries. Progress is recorded in
+    a state file so that an interrupted ensemble resumes from the members it has not finished.
+    :param func: function to run for each member, called with the member task argument (func)
+    :param n_workers: number of worker processes, default derived from available cores and memory (int)
+    :param timeout: maximum runtime of a member in seconds, None for no limit (float)
+    :param retries: number of times to retry a failed or timed out member (int)
+    :param state_file: JSON file to record progress in !optional! (str)
+    :param mem_per_task: memory needed by each member in bytes, used to derive number of workers !optional! (float)
+    :param poll: longest interval in seconds between checks on running members for timeouts, a finished member is
+                 handled as soon as it exits (float)
+    """
+    def __init__(self, func, n_workers=None, timeout=None, retries=2, state_file=None, mem_per_task=None, poll=0.2):
+        self.func = func
+        self.n_workers = n_workers
+        self.timeout = timeout
+        self.retries = retries
+        self.state_file = state_file
+        self.mem_per_task = mem_per_task
+        self.poll = poll
+        self.state = {'key': None, 'members': {}}
+
+    def load_state(self, key):
+        """
+        Loads the state of a previous run of the ensemble with the same key
+        :param key: key identifying the ensemble (str)
+        :return: Bool, True if a previous state was found
+        """
+        self.state = {'key': key, 'members': {}}
+        if key is None or self.state_file is None or not os.path.exists(self.state_file):
+            return False
+        with open(self.state_file, 'r') as f:
+            state = json.load(f)
+        if state.get('key') != key:
+            return False
+        self.state = state
+        return True
+
+    def save_state(self):
+        """
+        Writes the current state of the ensemble to the state file
+        :return: n/a
+        """
+        if self.state_file is None:
+            return
+        with open(self.state_file + '.tmp', 'w') as f:
+            json.dump(self.state, f, indent=1)
+        os.rename(self.state_file + '.tmp', self.state_file)
+
+    def run(self, tasks, key=None, on_result=None):
+        """
+        Runs the ensemble, skipping members recorded as done in the state file for the same key
+        :param tasks: list of tuples of member number (int) and argument to pass to func
+        :param key: key identifying the ensemble, used to check a state file belongs to this ensemble (str)
+        :param on_result: function called with the member number of each finished member, including members already
+                          done when resuming. If it returns True no further members are launched, members already
+                          running are finished !optional! (func)
+        :return: summary of the ensemble run (dict)
+        """
+        self.load_state(key)
+        members = self.state['members']
+        queue = [(num, arg) for num, arg in tasks if members.get(str(num), {}).get('status') != 'done']
+        for num, arg in queue:
+            members[str(num)] = {'status': 'pending', 'attempts': 0, 'runtime': None}
+        n_workers = self.n_workers if self.n_workers is not None else \
+            default_workers(len(queue), mem_per_task=self.mem_per_task)
+        running = {}
+        n_total = len(tasks)
+        n_done = n_total - len(queue)
+        if n_done > 0:
+            print('Resuming ensemble, ' + str(n_done) + ' of ' + str(n_total) + ' members already done')
+        stop = False
+        if on_result is not None:
+            for num, arg in tasks:
+                if members.get(str(num), {}).get('status') == 'done':
+                    stop = on_result(num) is True or stop
+            if stop is True:
+                print('Stopping ensemble, ' + str(len(queue)) + ' members not launched')
+        try:
+            while (len(queue) > 0 and stop is False) or len(running) > 0:
+                # launch members while workers are free
+                while len(queue) > 0 and len(running) < n_workers and stop is False:
+                    num, arg = queue.pop(0)
+                    proc = mp.Process(target=run_task, args=(self.func, arg))
+                    proc.start()
+                    running[num] = (proc, arg, time.time())
+                    mem = members[str(num)]
+                    mem['status'] = 'running'
+                    mem['attempts'] += 1
+                # wake as soon as a member exits, or after poll seconds to check for timeouts
+                connection.wait([running[num][0].sentinel for num in running], timeout=self.poll)
+                for num in list(running.keys()):
+                    proc, arg, t_start = running[num]
+                    runtime = time.time() - t_start
+                    mem = members[str(num)]
+                    if proc.is_alive():
+                        if self.timeout is None or runtime < self.timeout:
+                            continue
+                        kill_group(proc)
+                        status = 'timeout'
+                    else:
+                        status = 'done' if proc.exitcode == 0 else 'failed'
+                    proc.join()
+                    del running[num]
+                    mem['runtime'] = runtime
+                    if status == 'done':
+                        mem['status'] = 'done'
+                        n_done += 1
+                        print('Member ' + str(num) + ' done in %.1fs (%d/%d)' % (runtime, n_done, n_total))
+                        if on_result is not None and on_result(num) is True and stop is False:
+                            stop = True
+                            print('Stopping ensemble, ' + str(len(queue)) + ' members not launched')
+                    elif mem['attempts'] <= self.retries:
+                        mem['status'] = 'pending'
+                        queue.append((num, arg))
+                        print('Member ' + str(num) + ' ' + status + ', retrying (attempt %d)' % (mem['attempts'] + 1))
+                    else:
+                        mem['status'] = status
+                        print('Member ' + str(num) + ' ' + status + ' after %d attempts' % mem['attempts'])
+                    self.save_state()
+        finally:
+            # do not leave orphaned members running if interrupted
+            for num in running:
+                kill_group(running[num][0])
+                running[num][0].join()
+                members[str(num)]['status'] = 'pending'
+            self.save_state()
+        return self.summary()
+
+    def summary(self, n_slowest=5):
+        """
+        Summarises the runtimes and status of ensemble members
+        :param n_slowest: number of slowest members to report (int)
+        :return: summary of the ensemble run (dict)
+        """
+        members = self.state['members']
+        runtimes = {int(num): mem['runtime'] for num, mem in members.items() if mem['status'] == 'done'}
+        summary = {'done': sorted(runtimes.keys()),
+                   'failed': sorted(int(num) for num, mem in members.items() if mem['status'] in ('failed', 'timeout')),
+                   'runtimes': runtimes,
+                   'slowest': sorted(runtimes, key=runtimes.get, reverse=True)[:n_slowest]}
+        if len(runtimes) > 0:
+            times = list(runtimes.values())
+            print('Ensemble members run: %d, failed: %d, runtime min/mean/max: %.1f/%.1f/%.1fs' %
+                  (len(times), len(summary['failed']), min(times), sum(times) / len(times), max(times)))
+        if len(summary['failed']) > 0:
+            sys.stderr.write('Failed ensemble members: ' + str(summary['failed']) + '\n')
+        return summary
+
+
+def kill_group(proc):
+    """
+    Kills a worker process and any subprocesses in its process group
+    :param proc: worker process (mp.Process)
+    :return: n/a
+    """
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        proc.terminate()
@@ -1,9 +1,35 @@
+import os
+import sys
+import time
+import signal
+import asyncio
+import multiprocessing as mp
+import shutil
+import pickle
+import pytest
 import numpy as np
+import scipy.linalg as splinal
 import matplotlib.pyplot as plt
 import netCDF4 as nc
+import f90nml
 import fourdenvar as fdj
 import seaborn as sns
-import run_jules as rj
+import benchmark as bm
+import sampling
+import obs_operator
+import observations
+import run_cache
+import scheduler
+import obs_error
+import param_space
+import ensemble_store
+import instrument
+import emulator
+import plot
+import jules
+import run_jules
+import experiment_setup as es
+import run_experiment
 
 
 def test_cost_ens_inc(jj, alph=1e-8, vect=0):
@@ -11,26 +37,30 @@ def test_cost_ens_inc(jj, alph=1e-8, vect=0):
     """
     pvals = 1.03*jj.xb
     wvals = jj.xvals2wvals(pvals)
-    print wvals
+    print(wvals)
     #wvals = np.array([0.]*jj.size_ens)
     gradj = jj.gradcost_ens_inc(wvals)
-    #print gradj
+    #print(gradj)
     if vect == 0:
         h = wvals*(np.linalg.norm(wvals))**(-1)
     elif vect == 1:
         h = gradj*(np.linalg.norm(gradj))**(-1)
     elif vect == 2:
         h = np.ones(len(wvals))*(np.sqrt(len(wvals))**-1)
-    print h
+    print(h)
     j = jj.cost_ens_inc(wvals)
-    print j
+    print(j)
     jalph = jj.cost_ens_inc(wvals + alph*h)
-    print jalph - j
-    print np.dot(alph*h.T, gradj)
-    print (jalph-j) / (np.dot(alph*h.T, gradj))
+    print(jalph - j)
+    print(np.dot(alph*h.T, gradj))
+    print((jalph-j) / (np.dot(alph*h.T, gradj)))
     return abs(jalph-j) / (np.dot(alph*h.T, gradj))
 
 
+# helper taking an instance of FourDEnVar, not a test to be collected by pytest
+test_cost_ens_inc.__test__ = False
+
+
 def plotcostone_ens_inc(vect=1):
     """Using test_cost plots convergance of cost fn gradient for decreasing
     value of alpha.
@@ -49,7 +79,7 @@ def plotcostone_ens_inc(vect=1):
     plt.xlabel(r'$\eta$')
     plt.ylabel(r'$|f(\eta)|$')
     #plt.title('test of the gradient of the cost function')
-    print tstlist
+    print(tstlist)
     #plt.show()
     return ax, fig
 
@@ -72,6 +102,957 @@ def plotcost_ens_inc(vect=1):
     plt.xlabel(r'$\eta$')
     plt.ylabel(r'$|f(\eta) - 1|$')
     #plt.title('test of the gradient of the cost function')
-    print tstlist
+    print(tstlist)
     #plt.show()
-    return ax, fig
\ No newline at end of file
+    return ax, fig
+
+
+def toy_jj(size_ens=20, n_obs=60, toy=bm.LinearToy, **kwargs):
+    """Instance of FourDEnVar for a toy model, so that the tests run without
+    JULES output.
+    """
+    return bm.toy_fourdenvar(toy(n_obs=n_obs), size_ens, **kwargs)
+
+
+def dense_cost_ens_inc(jj, wvals):
+    """Cost function and gradient as originally formed from the dense
+    ensemble matrix and inverse observation error covariance matrix.
+    """
+    hmx_mat = (1. / (np.sqrt(jj.size_ens - 1))) * np.array([hmxb - jj.hxb for hmxb in jj.hm_xbs])
+    r_inv = np.linalg.inv(jj.rmatrix)
+    innov = np.dot(hmx_mat.T, wvals) + jj.hxb - jj.yoblist
+    cost = 0.5 * np.dot(np.dot(innov, r_inv), innov.T) + 0.5 * np.dot(wvals, wvals.T)
+    grad = np.dot(hmx_mat, np.dot(r_inv, innov.T)) + wvals
+    return cost, grad
+
+
+def test_whitened_cost_matches_dense():
+    jj = toy_jj()
+    rng = np.random.default_rng(1)
+    for wvals in (np.zeros(jj.size_ens), rng.standard_normal(jj.size_ens), jj.xvals2wvals(1.03*jj.xb)):
+        cost, grad = dense_cost_ens_inc(jj, wvals)
+        assert np.isclose(jj.cost_ens_inc(wvals), cost, rtol=1e-10)
+        assert np.allclose(jj.gradcost_ens_inc(wvals), grad, rtol=1e-10, atol=1e-10)
+
+
+def test_gradcost_ens_inc():
+    jj = toy_jj(toy=bm.NonlinearToy)
+    for vect in (0, 1, 2):
+        assert abs(test_cost_ens_inc(jj, 1e-6, vect) - 1) < 1e-4
+
+
+def test_direct_matches_ncg():
+    for toy in (bm.LinearToy, bm.NonlinearToy):
+        jj = toy_jj(toy=toy)
+        find_min_ncg, xa_ncg = jj.find_min_ens_inc(dispp=0, method='ncg')
+        find_min_direct, xa_direct = jj.find_min_ens_inc(method='direct')
+        assert np.allclose(find_min_direct[0], find_min_ncg[0], atol=1e-6)
+        assert np.allclose(xa_direct, xa_ncg, rtol=1e-6)
+        assert find_min_direct[1] <= find_min_ncg[1] + 1e-10
+
+
+def test_toy_posterior():
+    # the dense minimisation reduces to the exact linear posterior without the quadratic term
+    xa_lin, xa_sd_lin = bm.LinearToy().posterior()
+    xa_nl, xa_sd_nl = bm.NonlinearToy(nonlin=0.).posterior()
+    assert np.allclose(xa_nl, xa_lin, rtol=1e-8) and np.allclose(xa_sd_nl, xa_sd_lin, rtol=1e-8)
+    # the single linearisation of the ensemble analysis leaves the nonlinear toy analysis near but not at the mode
+    toy = bm.NonlinearToy()
+    xa_ref, xa_sd_ref = toy.posterior()
+    jj = bm.toy_fourdenvar(toy, 500)
+    xa = jj.find_min_ens_inc(method='direct')[1]
+    assert np.max(np.abs(xa - xa_ref) / xa_sd_ref) < 2.
+    res = bm.bench_designs(sizes=(16,), designs=('random',), n_rep=2, toy=toy)
+    assert np.all(np.isfinite(list(res['random'][16].values())))
+
+
+def test_batch_matches_loop():
+    jdas = [bm.toy_fourdenvar(toy(n_obs=60), 15, seed_val=seed_val, prior_err=prior_err)
+            for toy in (bm.LinearToy, bm.NonlinearToy) for prior_err in (0.1, 0.5) for seed_val in range(3)]
+    wvals, xa, xa_ens = fdj.batch_find_min(jdas)
+    assert wvals.shape == (12, 15) and xa.shape == (12, 7) and xa_ens.shape == (12, 15, 7)
+    for k, jda in enumerate(jdas):
+        wvals_k, xa_k, xa_ens_k = jda.direct_min_ens_inc()
+        assert np.allclose(wvals[k], wvals_k, rtol=1e-10, atol=1e-12)
+        assert np.allclose(xa[k], xa_k, rtol=1e-12)
+        assert np.allclose(xa_ens[k], xa_ens_k, rtol=1e-12)
+
+
+def test_a_cov_matches_sqrtm():
+    jj = toy_jj()
+    hmx_mat = (1. / (np.sqrt(jj.size_ens - 1))) * np.array([hmxb - jj.hxb for hmxb in jj.hm_xbs])
+    a_cov = np.linalg.inv(splinal.sqrtm(np.eye(jj.size_ens) + np.dot(hmx_mat,
+                          np.dot(np.linalg.inv(jj.rmatrix), hmx_mat.T))))
+    assert np.allclose(jj.a_cov(), a_cov.real, atol=1e-10)
+    xa = jj.find_min_ens_inc(method='direct')[1]
+    assert np.allclose(jj.a_ens(xa), xa + np.sqrt(jj.size_ens - 1) * np.dot(a_cov.real, jj.xb_mat))
+    assert np.allclose(jj.pa_cov(), np.dot(np.dot(a_cov.real, jj.xb_mat).T, np.dot(a_cov.real, jj.xb_mat)))
+
+
+def test_bounded_ens():
+    x = np.array([1., 2., 3.])
+    val_bnds = [(0.8, 1.1), (0., 2.5), (2.9, 10.)]
+    b_diag = np.diag((0.3*x)**2)
+    b_full = b_diag + 0.5*np.outer(0.3*x, 0.3*x)*(1 - np.eye(3))
+    for b_mat, design in ((b_diag, 'random'), (b_diag, 'truncnorm'), (b_full, 'random'), (b_full, 'rejection')):
+        x_ens = sampling.bounded_ens(x, b_mat, 200, val_bnds, seed_val=3, design=design)
+        assert x_ens.shape == (200, 3)
+        assert np.all(sampling.in_bnds(x_ens, val_bnds))
+        assert np.array_equal(x_ens, sampling.bounded_ens(x, b_mat, 200, val_bnds, seed_val=3, design=design))
+        assert not np.array_equal(x_ens, sampling.bounded_ens(x, b_mat, 200, val_bnds, seed_val=4, design=design))
+    x_ens = sampling.truncnorm_diag(np.random.default_rng(0), x, 0.3*x, 200, val_bnds)
+    assert np.all(sampling.in_bnds(x_ens, val_bnds))
+
+
+def test_rejection_max_draws():
+    x = np.zeros(2)
+    # bounds 6 standard deviations from the mean are almost never hit
+    with pytest.raises(ValueError):
+        sampling.rejection_mvn(np.random.default_rng(0), x, np.eye(2), 10, [(6., 7.), (-1., 1.)], max_draws=10**4)
+
+
+def test_space_filling_designs():
+    x = np.array([1., 2., 3.])
+    val_bnds = [(0.8, 1.1), (0., 2.5), (2.9, 10.)]
+    b_diag = np.diag((0.3*x)**2)
+    b_full = b_diag + 0.5*np.outer(0.3*x, 0.3*x)*(1 - np.eye(3))
+    for b_mat in (b_diag, b_full):
+        for design in ('lhs', 'sobol'):
+            x_ens = sampling.bounded_ens(x, b_mat, 64, val_bnds, seed_val=3, design=design)
+            assert x_ens.shape == (64, 3)
+            assert np.all(sampling.in_bnds(x_ens, val_bnds))
+            assert np.array_equal(x_ens, sampling.bounded_ens(x, b_mat, 64, val_bnds, seed_val=3, design=design))
+    # each stratum of each dimension holds exactly one point of a Latin hypercube
+    u_ens = sampling.unit_design(np.random.default_rng(0), 'lhs', 10, 3)
+    assert np.all(np.sort(np.floor(u_ens * 10), axis=0) == np.arange(10)[:, np.newaxis])
+    with pytest.warns(UserWarning):
+        sampling.unit_design(np.random.default_rng(0), 'sobol', 10, 3)
+    with pytest.raises(ValueError):
+        sampling.unit_design(np.random.default_rng(0), 'halton', 10, 3)
+
+
+def test_antithetic_design():
+    x = np.array([1., 2., 3.])
+    # bounds symmetric about the prior keep the pairs symmetric
+    val_bnds = [(0.4, 1.6), (-10., 14.), (2., 4.)]
+    b_mat = np.diag((0.3*x)**2)
+    for size_ens in (2, 10, 64):
+        x_ens = sampling.bounded_ens(x, b_mat, size_ens, val_bnds, seed_val=1, design='antithetic')
+        assert np.all(sampling.in_bnds(x_ens, val_bnds))
+        assert np.allclose(np.mean(x_ens, axis=0), x, rtol=0., atol=1e-12)
+        assert np.allclose(x_ens[:size_ens // 2] + x_ens[size_ens // 2:], 2 * x)
+    u_ens = sampling.unit_design(np.random.default_rng(0), 'antithetic', 7, 3)
+    assert u_ens.shape == (7, 3)
+    assert np.allclose(u_ens[:3] + u_ens[4:], 1.)
+
+
+def write_daily_nc(fname, seed_val=0, n_time=40):
+    """Writes a small file with the dimensions of JULES daily output for
+    the observation operator tests.
+    """
+    rng = np.random.default_rng(seed_val)
+    nc_dat = nc.Dataset(fname, 'w')
+    for dim, size in (('time', n_time), ('pft', 9), ('y', 1), ('x', 1)):
+        nc_dat.createDimension(dim, size)
+    time_var = nc_dat.createVariable('time', 'f8', ('time',))
+    time_var.units = 'seconds since 2008-01-01 06:00:00'
+    time_var[:] = 86400. * np.arange(1, n_time + 1)
+    for var in ('gpp', 'lai'):
+        nc_dat.createVariable(var, 'f8', ('time', 'pft', 'y', 'x'))[:] = rng.uniform(size=(n_time, 9, 1, 1))
+    nc_dat.createVariable('t1p5m', 'f8', ('time', 'y', 'x'))[:] = rng.uniform(size=(n_time, 1, 1))
+    nc_dat.close()
+
+
+def small_obs_op():
+    return obs_operator.ObsOperator([
+        obs_operator.ObsVar('gpp', [3, 5, 12], lvl_idx=7, transform=obs_operator.kg_s_to_g_day),
+        obs_operator.ObsVar('gpp_c4', [20, 4], var='gpp', lvl_idx=3),
+        obs_operator.ObsVar('lai', [6, 30], lvl_idx=7),
+        obs_operator.ObsVar('t1p5m', [0, 39], lvl_idx=None)])
+
+
+def test_obs_operator(tmp_path):
+    fname = str(tmp_path / 'xb0.daily.nc')
+    write_daily_nc(fname)
+    obs_op = small_obs_op()
+    assert obs_op.read_plan == {'gpp': (3, 21), 'lai': (6, 31), 't1p5m': (0, 40)}
+    assert obs_op.n_obs == 9
+    nc_dat = nc.Dataset(fname, 'r')
+    expect = (obs_operator.kg_s_to_g_day(nc_dat.variables['gpp'][[3, 5, 12], 7, 0, 0]),
+              nc_dat.variables['gpp'][[20, 4], 3, 0, 0], nc_dat.variables['lai'][[6, 30], 7, 0, 0],
+              nc_dat.variables['t1p5m'][[0, 39], 0, 0])
+    nc_dat.close()
+    hx = obs_op.extract(fname)['obs']
+    for hxi, expi in zip(hx, expect):
+        assert np.allclose(hxi, expi)
+    assert np.allclose(obs_op.extract_vec(fname), np.concatenate(expect))
+    assert obs_op.key() == small_obs_op().key()
+    assert obs_op.key() != obs_operator.ObsOperator(obs_op.obs_vars[:-1]).key()
+
+
+def test_extract_jules_hxb_ens(tmp_path, monkeypatch):
+    ens_dir = str(tmp_path / 'ensemble0')
+    os.mkdir(ens_dir)
+    for i in range(4):
+        write_daily_nc(ens_dir + '/ens' + str(i) + '.daily.nc', seed_val=i)
+    obs_op = small_obs_op()
+    expect = np.array([obs_op.extract_vec(ens_dir + '/ens' + str(i) + '.daily.nc') for i in range(4)])
+    hm_xbs = observations.extract_jules_hxb_ens(ens_dir, 4, processes=2, obs_op=obs_op)
+    assert np.allclose(hm_xbs, expect)
+    assert os.path.exists(ens_dir + '_hxb.npy')
+    # an up to date cache is used without reading any file
+    read = []
+    extract_member_hx = observations.extract_member_hx
+    monkeypatch.setattr(observations, 'extract_member_hx', lambda job: (read.append(job[0]), extract_member_hx(job))[1])
+    assert np.allclose(observations.extract_jules_hxb_ens(ens_dir, 4, processes=1, obs_op=obs_op), expect)
+    assert read == []
+    # only a changed member is read again
+    write_daily_nc(ens_dir + '/ens2.daily.nc', seed_val=10)
+    os.utime(ens_dir + '/ens2.daily.nc', (1e9, 1e9))
+    expect[2] = obs_op.extract_vec(ens_dir + '/ens2.daily.nc')
+    assert np.allclose(observations.extract_jules_hxb_ens(ens_dir, 4, processes=1, obs_op=obs_op), expect)
+    assert read == [2]
+    # a different observation operator invalidates the cache
+    obs_op = obs_operator.ObsOperator(obs_op.obs_vars[:2])
+    assert np.allclose(observations.extract_jules_hxb_ens(ens_dir, 4, processes=1, obs_op=obs_op), expect[:, :5])
+    assert read == [2, 0, 1, 2, 3]
+
+
+def test_run_cache_copies(tmp_path):
+    out_dir, ens_dir = str(tmp_path / 'out'), str(tmp_path / 'ens')
+    os.mkdir(out_dir)
+    os.mkdir(ens_dir)
+    write_daily_nc(out_dir + '/xb0.daily.nc')
+    write_daily_nc(out_dir + '/xb0.dump.19970101.nc')
+    cache = run_cache.RunCache(str(tmp_path / 'cache'))
+    key = cache.key({'output': {'jules_output': {'run_id': 'xb0', 'output_dir': out_dir}}}, [1., 2.])
+    assert cache.fetch(key, ens_dir, 'ens0') is False
+    cache.store(key, out_dir, 'xb0')
+    cached = str(tmp_path / 'cache' / key / 'daily.nc')
+    assert os.listdir(str(tmp_path / 'cache' / key)) == ['daily.nc']
+    assert os.stat(cached).st_mode & 0o777 == 0o444
+    assert cache.fetch(key, ens_dir, 'ens0') is True
+    fetched = ens_dir + '/ens0.daily.nc'
+    assert os.stat(fetched).st_ino != os.stat(cached).st_ino
+    # changing a member's output leaves the cache intact
+    with open(fetched, 'ab') as f:
+        f.write(b'0')
+    assert os.path.getsize(fetched) == os.path.getsize(cached) + 1
+    assert os.path.getsize(cached) == os.path.getsize(out_dir + '/xb0.daily.nc')
+    dump = cache.store_file('spin', out_dir + '/xb0.dump.19970101.nc', 'dump.nc')
+    assert cache.entry_file('spin', 'dump.nc') == dump
+    assert os.stat(dump).st_mode & 0o777 == 0o444
+    assert cache.evict() == 0
+    cache.max_bytes = 0
+    assert cache.evict() == 2
+
+
+def cached_member(work_num):
+    """Ensemble member task for the scheduler test. Member 1 is killed on
+    its first attempt and member 2 fails while the fail2 file exists.
+    """
+    work_dir, num = work_num
+    cache = run_cache.RunCache(work_dir + '/cache')
+    key = cache.key({}, values=[num])
+    if cache.fetch(key, work_dir + '/out', 'ens' + str(num)):
+        with open(work_dir + '/launches.log', 'a') as f:
+            f.write('hit ' + str(num) + '\n')
+        return
+    with open(work_dir + '/launches.log', 'a') as f:
+        f.write('run ' + str(num) + '\n')
+    if num == 1 and not os.path.exists(work_dir + '/killed1'):
+        open(work_dir + '/killed1', 'w').close()
+        os.kill(os.getpid(), signal.SIGKILL)
+    if num == 2 and os.path.exists(work_dir + '/fail2'):
+        os._exit(1)
+    with open(work_dir + '/out/ens' + str(num) + '.daily.nc', 'w') as f:
+        f.write(str(num))
+    cache.store(key, work_dir + '/out', 'ens' + str(num))
+
+
+def test_scheduler_retry_resume_cache(tmp_path):
+    work_dir = str(tmp_path)
+    os.mkdir(work_dir + '/out')
+    open(work_dir + '/fail2', 'w').close()
+    tasks = [(num, (work_dir, num)) for num in range(4)]
+
+    def launches():
+        with open(work_dir + '/launches.log', 'r') as f:
+            lines = f.read().split('\n')[:-1]
+        os.remove(work_dir + '/launches.log')
+        return sorted(lines)
+
+    sched = scheduler.EnsembleScheduler(cached_member, n_workers=2, retries=1, state_file=work_dir + '/state.json',
+                                        poll=0.05)
+    summary = sched.run(tasks, key='a')
+    assert summary['done'] == [0, 1, 3] and summary['failed'] == [2]
+    assert launches() == ['run 0', 'run 1', 'run 1', 'run 2', 'run 2', 'run 3']
+    sched = scheduler.EnsembleScheduler(cached_member, n_workers=2, retries=1, state_file=work_dir + '/state.json',
+                                        poll=0.05)
+    sched.load_state('a')
+    members = sched.state['members']
+    assert (members['1']['status'], members['1']['attempts']) == ('done', 2)
+    assert (members['2']['status'], members['2']['attempts']) == ('failed', 2)
+    # a rerun with the same key resumes from the state file and only launches the failed member
+    os.remove(work_dir + '/fail2')
+    assert sched.run(tasks, key='a')['done'] == [0, 1, 2, 3]
+    assert launches() == ['run 2']
+    # a new ensemble with the same members finds them all in the run cache, finished members are handled as soon as
+    # they exit rather than after the poll interval
+    sched = scheduler.EnsembleScheduler(cached_member, n_workers=2, state_file=work_dir + '/state.json', poll=30.)
+    t0 = time.time()
+    assert sched.run(tasks, key='b')['done'] == [0, 1, 2, 3]
+    assert time.time() - t0 < 10.
+    assert launches() == ['hit 0', 'hit 1', 'hit 2', 'hit 3']
+
+
+def test_outer_loop_linear():
+    toy = bm.LinearToy(n_obs=60)
+    jj = bm.toy_fourdenvar(toy, 20)
+    find_min_direct, xa_direct = jj.find_min_ens_inc(method='direct')
+    find_min, xa = jj.outer_loop_min_ens_inc(toy.hx, max_outer=1)
+    assert np.allclose(find_min[0], find_min_direct[0])
+    assert np.allclose(xa, xa_direct)
+    assert np.isclose(find_min[1], find_min_direct[1])
+    jj = bm.toy_fourdenvar(toy, 20)
+    find_min, xa = jj.outer_loop_min_ens_inc(toy.hx, max_outer=4, tol=0.)
+    costs = [hist['cost'] for hist in jj.outer_history]
+    assert len(costs) == 4
+    assert np.all(np.diff(costs) <= 1e-8 * costs[0])
+    assert np.isclose(costs[1], find_min_direct[1])
+    assert np.allclose(xa, xa_direct)
+
+
+def test_outer_loop_rejected_step():
+    toy = bm.LinearToy(n_obs=60)
+    jj = bm.toy_fourdenvar(toy, 20)
+    calls = []
+
+    def run_fn(x_ens):
+        # the model output is made worse on the last outer loop so that its step is rejected
+        calls.append(len(x_ens))
+        return toy.hx(x_ens) + 10.
+    find_min, xa = jj.outer_loop_min_ens_inc(run_fn, max_outer=2, tol=0.)
+    costs = [hist['cost'] for hist in jj.outer_history]
+    assert len(calls) == 1 and costs[1] > costs[0]
+    # the best estimate the model was run for, the prior, is returned with its cost
+    assert np.allclose(find_min[0], 0.)
+    assert np.isclose(find_min[1], costs[0])
+    assert np.allclose(xa, jj.xb)
+
+
+def test_outer_loop_max_outer(tmp_path):
+    toy = bm.LinearToy(n_obs=60)
+    jj = bm.toy_fourdenvar(toy, 20)
+    calls = []
+
+    def run_fn(x_ens):
+        calls.append(len(x_ens))
+        return toy.hx(x_ens)
+    for max_outer in (0, -1):
+        with pytest.raises(ValueError, match='max_outer'):
+            jj.outer_loop_min_ens_inc(run_fn, max_outer=max_outer)
+    assert calls == []
+    # the cost of each outer loop is recorded in the trace rather than printed
+    trace_file = str(tmp_path / 'trace.jsonl')
+    instrument.start_trace(trace_file)
+    try:
+        jj.outer_loop_min_ens_inc(run_fn, max_outer=3, tol=0.)
+    finally:
+        instrument.start_trace(None)
+    rec = [rec for rec in instrument.read_trace(trace_file) if rec['span'] == 'outer_loop_min_ens_inc'][0]
+    assert rec['attrs']['outer_costs'] == [hist['cost'] for hist in jj.outer_history]
+    assert rec['attrs']['outer_loops'] == 3 and len(calls) == 2
+
+
+def test_ensemble_dtype_mmap(tmp_path):
+    toy = bm.LinearToy(n_obs=60)
+    jj = bm.toy_fourdenvar(toy, 20)
+    xa = jj.find_min_ens_inc(method='direct')[1]
+    for dtype, mmap_dir in (('float32', None), ('float32', str(tmp_path)), ('float64', str(tmp_path))):
+        jj32 = fdj.FourDEnVar(size_ens=20, p_dict=toy.p_dict, obs_dic=toy.obs_dic, dtype=dtype, mmap_dir=mmap_dir)
+        jj32.make_hxb(toy.hx(jj32.xb))
+        jj32.create_ensemble(toy.hx(jj32.xbs))
+        # only the whitened perturbation matrix is kept in observation space
+        assert not hasattr(jj32, 'hmx_mat')
+        assert jj32.hmx_mat_w.dtype == np.dtype(dtype)
+        assert isinstance(jj32.hmx_mat_w, np.memmap) is (mmap_dir is not None)
+        assert np.allclose(jj32.find_min_ens_inc(method='direct')[1], xa, rtol=1e-5)
+
+
+def test_obs_error_covariances():
+    rng = np.random.default_rng(0)
+    sd = rng.uniform(0.5, 2., 12)
+    times = np.arange(12) * 2. + rng.uniform(0., 1., 12)
+    exp_sorted = obs_error.ExpCorrCov(sd, times, 5.)
+    # the inverse Cholesky factor of the correlation matrix of time ordered observations is bidiagonal
+    whiten_mat = exp_sorted.whiten(np.eye(12))
+    assert np.allclose(whiten_mat, np.tril(np.triu(whiten_mat, -1)))
+    assert np.allclose(whiten_mat, obs_error.DenseCov(exp_sorted.dense()).whiten(np.eye(12)))
+    # and the inverse of the covariance matrix is tridiagonal
+    r_inv = np.linalg.inv(exp_sorted.dense())
+    assert np.allclose(r_inv, np.tril(np.triu(r_inv, -1), 1))
+    assert np.allclose(exp_sorted.solve(np.eye(12)), r_inv)
+    covs = [exp_sorted,
+            obs_error.ExpCorrCov(sd[::-1], times[rng.permutation(12)], 3.),
+            obs_error.LowRankCov(obs_error.DiagonalCov(sd**2), np.ones((12, 1)) * 0.7),
+            obs_error.LowRankCov(obs_error.ExpCorrCov(sd, times, 5.), rng.standard_normal((12, 2))),
+            obs_error.obs_var_cov(sd, times, corr_len=5., bias_err=0.3)]
+    covs.append(obs_error.BlockDiagCov([obs_error.DiagonalCov(sd[:4]**2)] + covs))
+    for cov in covs:
+        dense = obs_error.DenseCov(cov.dense())
+        r_inv = np.linalg.inv(cov.dense())
+        obs_arr = rng.standard_normal((cov.size, 3))
+        assert np.allclose(cov.solve(obs_arr), dense.solve(obs_arr))
+        assert np.allclose(cov.solve(obs_arr[:, 0]), np.dot(r_inv, obs_arr[:, 0]))
+        # any square root of R whitens, L^-T L^-1 = R^-1
+        white = cov.whiten(np.eye(cov.size))
+        assert np.allclose(np.dot(white.T, white), r_inv)
+        assert np.allclose(cov.whiten(obs_arr[:, 0]), np.dot(white, obs_arr[:, 0]))
+        assert np.allclose(cov.variances(), np.diag(cov.dense()))
+
+
+def test_structured_r_cost_matches_dense():
+    toy = bm.LinearToy(n_obs=60)
+    times = np.arange(60) % 30
+    obs_dic = dict(toy.obs_dic)
+    obs_dic['r_cov'] = obs_error.BlockDiagCov([obs_error.obs_var_cov(toy.yerr[:30], times[:30], corr_len=4.),
+                                               obs_error.obs_var_cov(toy.yerr[30:], times[30:], bias_err=0.5 *
+                                                                     toy.yerr[0])])
+    jj = fdj.FourDEnVar(size_ens=20, p_dict=toy.p_dict, obs_dic=obs_dic)
+    jj.make_hxb(toy.hx(jj.xb))
+    jj.create_ensemble(toy.hx(jj.xbs))
+    wvals = np.random.default_rng(1).standard_normal(20)
+    cost, grad = dense_cost_ens_inc(jj, wvals)
+    assert np.isclose(jj.cost_ens_inc(wvals), cost, rtol=1e-10)
+    assert np.allclose(jj.gradcost_ens_inc(wvals), grad, rtol=1e-8, atol=1e-8)
+
+
+def small_space():
+    return param_space.ParamSpace({'pft_params': {'jules_pftparm': {
+        'neff_io': [2, 8.0e-4, (5.0e-4, 1.5e-3)],
+        'alpha_io': [2, 0.05, (0.0, 0.1), 'log'],
+        'tleaf_of_io': [2, 270., (None, None)]},
+        'jules_cropparm': {'mu_io': ['None', 0.02, (0.0, 1.0)], 'tbase_io': [2, 8., (0., 20.), 'none']}}})
+
+
+def test_param_space_transforms():
+    space = small_space()
+    assert space.kinds == ('logit', 'log', 'none', 'logit', 'none')
+    assert space.locs[3] == ('pft_params', 'jules_cropparm', 'mu_io', None)
+    low, high = space.bnds[:, 0], space.bnds[:, 1]
+    width = np.where(np.isfinite(high - low), high - low, 1.)
+    for frac in (1e-9, 1e-6, 0.5, 1. - 1e-6, 1. - 1e-9):
+        x = np.where(np.isfinite(high - low), low + frac * width, space.xb)
+        assert np.allclose(space.to_model(space.to_unbounded(x)), x, rtol=0., atol=1e-12 * width.max())
+        if min(frac, 1. - frac) < 1e-6:
+            continue
+        # the Jacobian matches finite differences of the transform
+        dist = np.minimum(x - low, high - x)
+        step = 1e-3 * np.where(np.isfinite(dist), dist, 1.)
+        z0, z1 = space.to_unbounded(x - step), space.to_unbounded(x + step)
+        assert np.allclose((z1 - z0) / (2 * step), space.jacobian(x), rtol=1e-4)
+    # ensembles are mapped row by row and values on a bound are moved just inside it
+    x_ens = np.array([space.xb, np.where(np.isfinite(low), low, space.xb), np.where(np.isfinite(high), high,
+                                                                                    space.xb)])
+    z_ens = space.to_unbounded(x_ens)
+    assert np.all(np.isfinite(z_ens))
+    # the Jacobian on a bound is that just inside it, consistent with to_unbounded
+    for x in x_ens[1:]:
+        jac = space.jacobian(x)
+        assert np.all(np.isfinite(jac)) and np.allclose(jac, space.jacobian(space.inside_bnds(x)))
+    assert np.allclose(space.to_model(z_ens), x_ens, rtol=0., atol=1e-9 * width.max())
+    x_far = space.to_model(np.array([[-50.] * 5, [50.] * 5]))
+    assert np.all(sampling.in_bnds(x_far[:, space._log | space._logit],
+                                   np.array(space.val_bnds)[space._log | space._logit]))
+    assert space.unbounded_bnds()[:2] == ((-np.inf, np.inf), (-np.inf, np.inf))
+    assert space.unbounded_bnds()[4] == (0., 20.)
+    with pytest.raises(ValueError):
+        param_space.ParamSpace({'f': {'n': {'p': [None, 1., (0., 2.), 'exp']}}})
+
+
+def test_param_space_immutable():
+    space = small_space()
+    with pytest.raises(AttributeError):
+        space.xb = np.zeros(5)
+    with pytest.raises(AttributeError):
+        space.new_attr = 1
+    with pytest.raises(ValueError):
+        space.xb[0] = 1.
+    with pytest.raises(ValueError):
+        space.bnds[0, 0] = 1.
+    with pytest.raises(TypeError):
+        space.index['mu_io'] = 0
+    for mask in (space._log, space._logit):
+        with pytest.raises(ValueError):
+            mask[0] = True
+    assert space.kinds == ('logit', 'log', 'none', 'logit', 'none')
+    # parameter names are the keys of the index, so a name can not be registered twice
+    with pytest.raises(ValueError, match='alpha_io'):
+        param_space.ParamSpace({'pft_params': {'jules_pftparm': {'alpha_io': [2, 0.05, (0.0, 0.1)]}},
+                                'crop_params': {'jules_cropparm': {'alpha_io': [2, 0.05, (0.0, 0.1)]}}})
+    # values returns a copy that can be changed
+    x = space.values(['mu_io'], [0.5])
+    assert x[3] == 0.5 and space.xb[3] == 0.02
+    x[0] = 1.
+    assert space.xb[0] == 8.0e-4
+
+
+test_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+def fake_jules_run(tmp_path, name, out_vars=None, out_dir=None, values='default', run_end='2008-02-01 05:00:00'):
+    """Patches the example nml files for a fake_jules.py run in tmp_path,
+    by default a month long run writing to tmp_path/output.
+    """
+    if out_dir is None:
+        out_dir = str(tmp_path / 'output')
+    os.makedirs(out_dir, exist_ok=True)
+    rj = run_jules.RunJulesDa(params=list(param_space.default_space().names), values=values,
+                              nml_dir=str(tmp_path / name), template=jules.nml_template(test_dir + '/example_nml'))
+    j = rj.patch_nml(output_name=name, out_dir=out_dir, out_vars=out_vars,
+                     init_dump=test_dir + '/data/mod_truth.dump.20080101.nc')
+    j.nml('timesteps')['jules_time']['main_run_end'] = run_end
+    j.jules = test_dir + '/fake_jules.py'
+    return j
+
+
+def test_run_process_fatal(tmp_path, monkeypatch):
+    monkeypatch.setenv('FAKE_JULES_DUMP', '0')
+    out, err = fake_jules_run(tmp_path, 'ok').run_jules()
+    assert out[-1].strip() == '[INFO] fake_jules: run completed'
+    assert os.path.exists(tmp_path / 'output' / 'ok.daily.nc')
+    monkeypatch.setenv('FAKE_JULES_FAIL_RATE', '1')
+    with pytest.raises(jules.JulesError, match='random failure'):
+        fake_jules_run(tmp_path, 'fail').run_jules()
+    with pytest.raises(jules.JulesError, match='random failure'):
+        asyncio.run(fake_jules_run(tmp_path, 'fail_async').run_jules_async())
+    # the process is killed as soon as the fatal error is read, not left to finish
+    cmd = [sys.executable, '-c', 'import time; print("[FATAL ERROR] stop", flush=True); time.sleep(60)']
+    t0 = time.time()
+    with pytest.raises(jules.JulesError, match='stop'):
+        jules.run_process(cmd, str(tmp_path))
+    with pytest.raises(jules.JulesError, match='stop'):
+        asyncio.run(jules.run_process_async(cmd, str(tmp_path)))
+    assert time.time() - t0 < 30.
+
+
+def test_run_process_timeout(tmp_path, monkeypatch):
+    monkeypatch.setenv('FAKE_JULES_DUMP', '0')
+    monkeypatch.setenv('FAKE_JULES_RUNTIME', '60')
+    t0 = time.time()
+    with pytest.raises(jules.JulesError, match='timeout'):
+        fake_jules_run(tmp_path, 'slow').run_jules(timeout=3.)
+    with pytest.raises(jules.JulesError, match='timeout'):
+        asyncio.run(fake_jules_run(tmp_path, 'slow_async').run_jules_async(timeout=3.))
+    assert time.time() - t0 < 30.
+
+
+def test_run_jules_many(tmp_path, monkeypatch):
+    monkeypatch.setenv('FAKE_JULES_DUMP', '0')
+    monkeypatch.setenv('FAKE_JULES_RUNTIME', '4')
+    runs = [fake_jules_run(tmp_path, 'ens%d' % i) for i in range(4)]
+    # a run with a missing output directory fails without stopping the rest of the batch
+    runs[2].nml('output')['jules_output']['output_dir'] = str(tmp_path / 'missing')
+    t0 = time.time()
+    results = asyncio.run(jules.run_jules_many(runs, max_concurrent=4, timeout=30.))
+    # the runs sleep concurrently, run one after another the batch would take at least 16s
+    assert time.time() - t0 < 12.
+    assert isinstance(results[2], jules.JulesError)
+    for i in (0, 1, 3):
+        assert results[i][0][-1].strip() == '[INFO] fake_jules: run completed'
+        assert os.path.exists(tmp_path / 'output' / ('ens%d.daily.nc' % i))
+    assert not os.path.exists(tmp_path / 'output' / 'ens2.daily.nc')
+
+
+def test_nml_template_write(tmp_path):
+    base = str(tmp_path / 'base')
+    shutil.copytree(test_dir + '/example_nml', base)
+    tmpl = jules.nml_template(base)
+    assert jules.nml_template(base) is tmpl
+    run_dir = str(tmp_path / 'run')
+    j = jules.Jules(run_dir, template=tmpl)
+    j.nml('pft_params')['jules_pftparm']['alpha_io'][7] = 0.05
+    j.nml('output')['jules_output']['run_id'] = 'patched'
+    # edits are made to a copy, the cached template is unchanged
+    assert tmpl.nml_dic['pft_params']['jules_pftparm']['alpha_io'][7] == 0.0673249126
+    assert tmpl.nml_dic['output']['jules_output']['run_id'] == 'test'
+    assert jules.Jules(run_dir, template=tmpl).nml('output')['jules_output']['run_id'] == 'test'
+    j.write_nml()
+    assert sorted(os.listdir(run_dir)) == sorted(k + '.nml' for k in tmpl.files)
+    for key in tmpl.files:
+        f_nml = os.path.join(run_dir, key + '.nml')
+        if key in ('pft_params', 'output'):
+            assert not os.path.islink(f_nml)
+        else:
+            assert os.path.islink(f_nml) and os.path.realpath(f_nml) == tmpl.files[key]
+    assert f90nml.read(run_dir + '/pft_params.nml')['jules_pftparm']['alpha_io'][7] == 0.05
+    assert f90nml.read(run_dir + '/output.nml')['jules_output']['run_id'] == 'patched'
+    assert f90nml.read(run_dir + '/pft_params.nml')['jules_pftparm']['alpha_io'][:7] == \
+        tmpl.nml_dic['pft_params']['jules_pftparm']['alpha_io'][:7]
+    # reusing the run directory for a run that only patches the output file links pft_params back to the template
+    j = jules.Jules(run_dir, template=tmpl)
+    j.nml('output')['jules_output']['run_id'] = 'second'
+    j.write_nml()
+    assert os.path.realpath(run_dir + '/pft_params.nml') == tmpl.files['pft_params']
+    assert f90nml.read(run_dir + '/output.nml')['jules_output']['run_id'] == 'second'
+    assert f90nml.read(tmpl.files['output'])['jules_output']['run_id'] == 'test'
+    # the template is read again once its files change
+    os.utime(tmpl.files['output'], (time.time() + 10., time.time() + 10.))
+    assert jules.nml_template(base) is not tmpl
+
+
+def test_set_output_profile(tmp_path, monkeypatch):
+    monkeypatch.setenv('FAKE_JULES_DUMP', '0')
+    out_vars = es.obs_op.variables()
+    j = fake_jules_run(tmp_path, 'xb0', out_vars=out_vars, run_end='2009-01-01 05:00:00')
+    j.run_jules()
+    output = f90nml.read(str(tmp_path / 'xb0' / 'output.nml'))
+    profile = output['jules_output_profile']
+    assert output['jules_output']['nprofiles'] == 1
+    assert profile['nvars'] == len(out_vars) == 3
+    assert profile['var'] == profile['var_name'] == out_vars
+    assert profile['output_type'] == ['M'] * 3
+    assert profile['profile_name'] == 'daily'
+    nc_dat = nc.Dataset(str(tmp_path / 'output' / 'xb0.daily.nc'), 'r')
+    assert set(nc_dat.variables) - {'time', 'time_bounds', 'latitude', 'longitude'} == set(out_vars)
+    nc_dat.close()
+    hx = es.obs_op.extract_vec(str(tmp_path / 'output' / 'xb0.daily.nc'))
+    assert hx.shape == (es.obs_op.n_obs,) and np.all(np.isfinite(hx))
+
+
+def fake_jules_setup(tmp_path, monkeypatch):
+    """Sets up the experiment to run JULES with fake_jules.py, writing all
+    output to tmp_path.
+    """
+    monkeypatch.chdir(test_dir)
+    monkeypatch.setattr(es, 'model_exe', test_dir + '/fake_jules.py')
+    monkeypatch.setattr(jules.Jules.__init__, '__defaults__', (es.model_exe, None))
+    monkeypatch.setattr(es, 'nml_directory', test_dir + '/example_nml')
+    monkeypatch.setattr(es, 'output_directory', str(tmp_path / 'output'))
+    monkeypatch.setattr(es, 'run_cache_dir', str(tmp_path / 'run_cache'))
+    monkeypatch.setattr(es, 'spinup_dir', str(tmp_path / 'spinup'))
+    monkeypatch.setattr(es, 'num_processes', 1)
+
+
+def test_spinup_dump_cache(tmp_path, monkeypatch):
+    # spin-ups are run with fake_jules.py, which writes a dump at the start of the main run
+    fake_jules_setup(tmp_path, monkeypatch)
+    monkeypatch.setattr(es, 'spinup_cycles', 1)
+    monkeypatch.setattr(es, 'spinup_params', ['alpha_io'])
+    params = ['neff_io', 'alpha_io', 'fd_io']
+    x_prior = run_experiment.prior_values(params)
+    x_ens = x_prior * np.array([[1.1, 1., 1.], [0.9, 1., 1.2], [1., 1.2, 1.], [1., 0.8, 1.]])
+    dumps = run_experiment.spinup_ens(x_ens, params)
+    # members only differing in parameters outside spinup_params share a spin-up
+    assert dumps[0] == dumps[1] and len(set(dumps)) == 3
+    assert all(os.path.exists(f) for f in dumps)
+    assert not any(d.startswith('run_') for d in os.listdir(es.spinup_dir))
+    # a second ensemble reuses the cached dumps, fake_jules.py would fail if it were run again
+    monkeypatch.setenv('FAKE_JULES_FAIL_RATE', '1')
+    assert run_experiment.spinup_ens(x_ens[::-1], params) == dumps[::-1]
+    assert run_experiment.spinup_member_run((os.path.basename(os.path.dirname(dumps[0])), x_ens[0]),
+                                            params=params).endswith('cached!')
+    monkeypatch.delenv('FAKE_JULES_FAIL_RATE')
+    # changing the spin-up settings changes the keys, so new spin-ups are run
+    monkeypatch.setattr(es, 'spinup_cycles', 2)
+    dumps_2 = run_experiment.spinup_ens(x_ens, params)
+    assert len(set(dumps_2)) == 3 and not set(dumps_2) & set(dumps)
+    monkeypatch.setattr(es, 'spinup_params', None)
+    dumps_prior = run_experiment.spinup_ens(x_ens, params)
+    # members 0 and 1 were already spun up with the prior parameters, so no new spin-up is needed
+    assert dumps_prior == [dumps_2[0]] * 4
+    assert not any(d.startswith('spinup_') for d in os.listdir(test_dir))
+
+
+def test_ensemble_store(tmp_path):
+    ens_dir = str(tmp_path / 'ensemble0')
+    os.mkdir(ens_dir)
+    nc_files = ensemble_store.member_files(ens_dir, 4)
+    for i, fname in enumerate(nc_files):
+        write_daily_nc(fname, seed_val=i)
+    x_ens = np.arange(12.).reshape(4, 3)
+    assert ensemble_store.open_store(ens_dir) is None
+    store = ensemble_store.consolidate(ens_dir, 4, x_ens=x_ens, params=['a', 'b', 'c'], processes=2)
+
+    def check_store(store):
+        assert store.variables == ['gpp', 'lai', 't1p5m'] and store.members == [0, 1, 2, 3]
+        for i, fname in enumerate(nc_files):
+            nc_dat = nc.Dataset(fname, 'r')
+            for var in store.variables:
+                assert np.array_equal(store.var(var)[i], nc_dat.variables[var][:])
+            times = nc.num2date(nc_dat.variables['time'][:], nc_dat.variables['time'].units)
+            nc_dat.close()
+            assert np.array_equal(store.times(), times)
+        params, x_store = store.params()
+        assert params == ['a', 'b', 'c'] and np.array_equal(x_store, x_ens)
+        obs_op = small_obs_op()
+        assert np.array_equal(obs_op.extract_store(store), np.array([obs_op.extract_vec(f) for f in nc_files]))
+
+    check_store(store)
+    check_store(ensemble_store.open_store(ens_dir, 4))
+    # changed member output makes the store out of date, consolidating again only rereads that member
+    write_daily_nc(nc_files[2], seed_val=10)
+    os.utime(nc_files[2], (time.time() + 10., time.time() + 10.))
+    assert ensemble_store.open_store(ens_dir) is None
+    check_store(ensemble_store.consolidate(ens_dir, 4, processes=1))
+
+
+def test_save_plots(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('FAKE_JULES_DUMP', '0')
+    monkeypatch.setattr(es, 'output_directory', str(tmp_path / 'output'))
+    monkeypatch.setattr(es, 'seed_value', 0)
+    year = '2009-01-01 05:00:00'
+    fake_jules_run(tmp_path, 'mod_truth', out_dir=es.output_directory + '/model_truth', run_end=year).run_jules()
+    jda = fdj.FourDEnVar(size_ens=3, obs_dic=observations.extract_twin_data())
+    xa_ens = jda.xb + 0.5 * (jda.xbs - jda.xb)
+    for ens_name, x_ens in (('ensemble0', jda.xbs), ('ensemble_xa_0', xa_ens)):
+        for i, xi in enumerate(x_ens):
+            fake_jules_run(tmp_path, 'ens%d' % i, out_dir=es.output_directory + '/' + ens_name, values=xi,
+                           run_end=year).run_jules()
+    with open(str(tmp_path / 'xa_ens.p'), 'wb') as f:
+        pickle.dump(xa_ens, f)
+    # variables sliced from a consolidated store match those read from the member files
+    var_lvls = [(var, lvl_idx) for var, lvl_idx, ylab, fname in plot.twin_plots]
+    xb_files = plot.extract_ens_vars(es.output_directory + '/ensemble0', var_lvls)
+    ensemble_store.consolidate(es.output_directory + '/ensemble0', 3, processes=1)
+    xb_store = plot.extract_ens_vars(es.output_directory + '/ensemble0', var_lvls)
+    for var, lvl_idx in var_lvls:
+        assert xb_store[var].shape == (3, 365)
+        assert np.allclose(np.sort(xb_store[var], axis=0), np.sort(xb_files[var], axis=0))
+    out_dir = str(tmp_path / 'plots')
+    os.mkdir(out_dir)
+    assert plot.save_plots(str(tmp_path / 'xa_ens.p'), out_dir, jda=jda, processes=2) == 'plots saved!'
+    fnames = [fname for var, lvl_idx, ylab, fname in plot.twin_plots] + ['distributions.png']
+    assert sorted(os.listdir(out_dir)) == sorted(fnames)
+    assert all(os.path.getsize(os.path.join(out_dir, fname)) > 0 for fname in fnames)
+
+
+@instrument.traced()
+def traced_member(member):
+    with instrument.span('ens_member_run', member=member, xa=False) as sp:
+        sp['cache_hit'] = False
+        time.sleep(0.01 * member)
+    return member
+
+
+def test_instrument_trace(tmp_path):
+    trace_file = str(tmp_path / 'trace' / 'trace.jsonl')
+    with instrument.span('untraced') as sp:
+        sp['n'] = 1
+    assert not instrument.tracing()
+    instrument.start_trace(trace_file)
+    try:
+        with instrument.span('outer', seed=0) as sp:
+            with instrument.span('inner'):
+                np.ones(2 * 10**6).sum()
+            with pytest.raises(ValueError):
+                with instrument.span('inner'):
+                    raise ValueError('failed stage')
+            for member in range(3):
+                traced_member(member)
+            # spans in forked worker processes append to the same trace file
+            proc = mp.get_context('fork').Process(target=traced_member, args=(3,))
+            proc.start()
+            proc.join()
+            with instrument.span('find_min_ens_inc', method='direct') as mini:
+                mini['cost'] = 1.5
+            sp['n_members'] = 4
+    finally:
+        instrument.start_trace(None)
+    records = instrument.read_trace(trace_file)
+    assert [rec['span'] for rec in records] == ['inner', 'inner'] + ['ens_member_run', 'traced_member'] * 4 + \
+        ['find_min_ens_inc', 'outer']
+    inner, failed, outer = records[0], records[1], records[-1]
+    for rec in records:
+        assert rec['wall'] >= 0. and rec['maxrss'] > 0 and 'child_maxrss' in rec and 'cpu' in rec
+    assert (inner['parent'], inner['status']) == ('outer', 'ok')
+    assert (failed['parent'], failed['status']) == ('outer', 'ValueError')
+    assert outer['parent'] is None and outer['attrs'] == {'seed': 0, 'n_members': 4}
+    assert records[2]['parent'] == 'traced_member' and records[3]['parent'] == 'outer'
+    assert records[8]['pid'] != outer['pid']
+    assert outer['wall'] >= sum(rec['wall'] for rec in records[:-1] if rec['parent'] == 'outer')
+    assert outer['maxrss'] >= inner['maxrss']
+    result = instrument.report(trace_file, n_slowest=2)
+    stages = result['stages']
+    assert stages['inner']['count'] == 2 and stages['inner']['errors'] == 1
+    assert stages['ens_member_run']['count'] == 4
+    assert np.isclose(stages['ens_member_run']['wall'], sum(rec['wall'] for rec in records
+                                                          if rec['span'] == 'ens_member_run'))
+    assert stages['outer']['max_wall'] == outer['wall']
+    assert [mem[0] for mem in result['slowest']] == ['xb3', 'xb2']
+    assert result['minimisations'] == [{'method': 'direct', 'cost': 1.5, 'wall': records[-2]['wall']}]
+
+
+def stream_toy(toy, size_ens):
+    jda = fdj.FourDEnVar(seed_val=0, size_ens=size_ens, p_dict=toy.p_dict, obs_dic=toy.obs_dic)
+    jda.make_hxb(toy.hx(jda.xb))
+    return jda
+
+
+def test_ensemble_stream_finish():
+    toy = bm.NonlinearToy(n_obs=60)
+    jj = toy_jj(size_ens=30, toy=bm.NonlinearToy)
+    find_min, xa = jj.find_min_ens_inc(method='direct')
+    stream = fdj.EnsembleStream(stream_toy(toy, 30))
+    # members arrive in the order they finish, not the order they were drawn
+    order = np.random.default_rng(1).permutation(30)
+    for num in order:
+        stream.add(num, toy.hx(stream.jda.xbs[num]))
+    xa_stream, xa_sd_stream = stream.estimate()
+    jda = stream.finish()
+    assert np.allclose(jda.xbs, jj.xbs[order])
+    assert np.allclose(jda.gram_ens_inc, jj.gram_ens_inc[np.ix_(order, order)])
+    find_min_stream, xa_finish = jda.find_min_ens_inc(method='direct')
+    assert np.allclose(xa_finish, xa, rtol=1e-10) and np.allclose(xa_stream, xa, rtol=1e-10)
+    assert np.isclose(find_min_stream[1], find_min[1], rtol=1e-10)
+    assert np.allclose(jda.xa_sd(), jj.xa_sd(), rtol=1e-10) and np.allclose(xa_sd_stream, jj.xa_sd(), rtol=1e-10)
+
+
+def test_ensemble_stream_converged():
+    toy = bm.NonlinearToy(n_obs=60)
+    stream = fdj.EnsembleStream(stream_toy(toy, 300))
+    for num in range(300):
+        stream.add(num, toy.hx(stream.jda.xbs[num]))
+        if stream.converged(tol=0.02, min_size=20, patience=10):
+            break
+    n_stop = len(stream.members)
+    assert 20 <= n_stop < 100
+    changes = [rec['change'] for rec in stream.history]
+    assert len(changes) == n_stop - 1 and changes[0] == np.inf
+    assert max(changes[-10:]) < 0.02 and changes[-11] >= 0.02
+    # the estimate at which streaming stopped is close to that of the full ensemble
+    xa, xa_sd = stream.estimate()
+    full = fdj.EnsembleStream(stream_toy(toy, 300))
+    for num in range(300):
+        full.add(num, toy.hx(full.jda.xbs[num]))
+    xa_full, xa_sd_full = full.estimate()
+    assert np.max(np.abs(xa - xa_full) / xa_sd_full) < 0.5
+    # with no tolerance the stream never converges
+    assert not any(full.converged(tol=0., min_size=2, patience=1) for num in range(5))
+
+
+def test_adaptive_ens_run(tmp_path, monkeypatch):
+    fake_jules_setup(tmp_path, monkeypatch)
+    monkeypatch.setenv('FAKE_JULES_DUMP', '0')
+    monkeypatch.setattr(es, 'adaptive_min_size', 6)
+    monkeypatch.setattr(es, 'adaptive_patience', 3)
+    monkeypatch.setattr(es, 'adaptive_tol', 10.)
+    year = '2009-01-01 05:00:00'
+    fake_jules_run(tmp_path, 'mod_truth', out_dir=es.output_directory + '/model_truth', run_end=year).run_jules()
+    fake_jules_run(tmp_path, 'xb0', out_dir=es.output_directory + '/background', run_end=year).run_jules()
+    obs_dic = observations.extract_twin_data(es.output_directory + '/model_truth/mod_truth.daily.nc')
+    jda = fdj.FourDEnVar(size_ens=10, obs_dic=obs_dic)
+    xbs = jda.xbs.copy()
+    # with one worker streaming stops as soon as min_size members have run and changed the posterior by less than tol
+    jda = run_experiment.adaptive_ens_run(jda, use_cache=False)
+    assert jda.size_ens == 6 and np.array_equal(jda.xbs, xbs[:6])
+    ens_dir = es.output_directory + '/ensemble0'
+    assert sorted(os.listdir(ens_dir)) == sorted('ens%d.daily.nc' % i for i in range(6))
+    # the streamed analysis matches one formed from the member output files
+    ref = fdj.FourDEnVar(size_ens=6, obs_dic=obs_dic)
+    ref.xbs = xbs[:6]
+    ref.make_hxb()
+    ref.create_ensemble(np.array([es.obs_op.extract_vec(ens_dir + '/ens%d.daily.nc' % i) for i in range(6)]))
+    assert np.allclose(jda.find_min_ens_inc(method='direct')[1], ref.find_min_ens_inc(method='direct')[1])
+    assert np.allclose(jda.xa_sd(), ref.xa_sd())
+    # an ensemble that never converges stops at the number of members drawn, resuming from the members already run
+    monkeypatch.setattr(es, 'adaptive_tol', 0.)
+    jda = fdj.FourDEnVar(size_ens=10, obs_dic=obs_dic)
+    jda = run_experiment.adaptive_ens_run(jda, use_cache=False)
+    assert jda.size_ens == 10 and np.array_equal(jda.xbs, xbs)
+    assert len(os.listdir(ens_dir)) == 10
+
+
+def test_emulator_predict():
+    toy = bm.LinearToy(n_obs=60)
+    jj = bm.toy_fourdenvar(toy, 40)
+    emu = emulator.from_fourdenvar(jj)
+    assert np.array_equal(emu.y_scale, jj.yerr)
+    hx, hx_var = emu.predict(jj.xbs)
+    assert hx.shape == hx_var.shape == (40, 60)
+    assert np.allclose(hx, toy.hx(jj.xbs), rtol=0., atol=1e-8 * np.max(jj.yerr))
+    # the linear mean reproduces a linear H(x) away from the training points as well
+    x_test = jj.generate_param_ens(10)
+    assert np.allclose(emu.predict(x_test)[0], toy.hx(x_test), rtol=0., atol=1e-8 * np.max(jj.yerr))
+    hx_0, hx_var_0 = emu.predict(jj.xbs[0])
+    assert hx_0.shape == (60,) and np.allclose(hx_0, hx[0]) and np.all(hx_var_0 >= 0.)
+
+
+def test_emulator_cost_gradient():
+    toy = bm.NonlinearToy(n_obs=60)
+    jj = bm.toy_fourdenvar(toy, 40)
+    emu = emulator.from_fourdenvar(jj)
+    for xvals in (jj.xb, toy.x_true, jj.xbs[3]):
+        cost, grad = emu.cost(xvals, jj)
+        hx, hx_var = emu.predict(xvals)
+        dx = xvals - jj.xb
+        assert np.isclose(cost, 0.5 * np.dot(dx, np.linalg.solve(jj.b_mat, dx)) +
+                          0.5 * np.sum((hx - jj.yoblist)**2 / (jj.yerr**2 + hx_var)))
+        # central differences, steps much smaller than this are swamped by rounding in the emulator variance
+        step = 1e-3 * jj.xb_sd
+        fd_grad = np.array([(emu.cost(xvals + step[i] * np.eye(7)[i], jj)[0] -
+                             emu.cost(xvals - step[i] * np.eye(7)[i], jj)[0]) / (2. * step[i]) for i in range(7)])
+        assert np.allclose(grad, fd_grad, rtol=1e-4, atol=1e-4 * np.max(np.abs(grad)))
+
+
+def test_emulator_validate():
+    toy = bm.NonlinearToy(n_obs=60)
+    jj = bm.toy_fourdenvar(toy, 40)
+    emu = emulator.from_fourdenvar(jj)
+    loo = emu.validate()
+    assert loo['nrmse'] < 0.05 and loo['coverage'] > 0.9
+    x_test = jj.generate_param_ens(20)
+    held_out = emu.validate(x_test, toy.hx(x_test))
+    assert held_out['nrmse'] < 0.05 and held_out['coverage'] > 0.9
+    # closed form leave one out errors match refitting the Gaussian process without each member
+    k_mat = emu.kernel(emu.x_std, emu.x_std) + emu.nugget * np.eye(40)
+    err = emu.alpha / np.diag(emu.k_inv)[:, np.newaxis]
+    for i in (0, 17):
+        keep = np.arange(40) != i
+        pred = np.dot(k_mat[i, keep], np.linalg.solve(k_mat[np.ix_(keep, keep)], emu.resid[keep]))
+        assert np.allclose(err[i], emu.resid[i] - pred, rtol=1e-6, atol=1e-6 * np.max(np.abs(emu.resid)))
+    # a linear H(x) is emulated exactly
+    jj_lin = bm.toy_fourdenvar(bm.LinearToy(n_obs=60), 40)
+    assert emulator.from_fourdenvar(jj_lin).validate()['rmse'] < 1e-8
+
+
+def test_emulator_screen():
+    toy = bm.LinearToy(n_obs=60)
+    jj = bm.toy_fourdenvar(toy, 40)
+    emu = emulator.from_fourdenvar(jj)
+    bnds = np.array(jj.val_bnds)
+    x_out = jj.xb.copy()
+    x_out[2] = bnds[2, 1] + jj.xb_sd[2]
+    # far from the observations but within the parameter bounds
+    x_far = jj.xb + 8. * jj.xb_sd
+    xa = jj.find_min_ens_inc(method='direct')[1]
+    x_ens = np.vstack([toy.posterior()[0], x_out, x_far, jj.a_ens(xa), jj.xbs])
+    # implausibility is the largest standardised error over all 60 observations, so the cut is above 3
+    cut = 5.
+    keep = emu.screen(x_ens, jj.yoblist, jj.yerr, jj.val_bnds, cut=cut)
+    assert keep.dtype == bool and keep.shape == (83,)
+    assert keep[0] and not keep[1] and not keep[2]
+    assert sampling.in_bnds(x_far, jj.val_bnds)[0]
+    assert np.all(sampling.in_bnds(x_ens[keep], jj.val_bnds))
+    implausibility = emu.implausibility(x_ens, jj.yoblist, jj.yerr)
+    assert np.all(implausibility[keep] <= cut)
+    assert np.all(implausibility[~keep & sampling.in_bnds(x_ens, jj.val_bnds)] > cut)
+    # the prior ensemble is much further from the observations than the posterior ensemble
+    assert np.sum(keep[3:43]) > np.sum(keep[43:])
+
+
+def test_emulator_find_min():
+    toy = bm.LinearToy(n_obs=60)
+    jj = bm.toy_fourdenvar(toy, 40)
+    xa_exact, xa_sd_exact = toy.posterior()
+    find_min, xa = jj.find_min_ens_inc(method='direct')
+    emu = emulator.from_fourdenvar(jj)
+    # the emulated cost uses the prior covariance B rather than its ensemble estimate, so on a linear toy its minimum
+    # is the exact posterior and differs from the 4DEnVar estimate only by the sampling error of the ensemble
+    xa_emu = emu.find_min(jj)
+    assert np.max(np.abs(xa_emu - xa_exact) / xa_sd_exact) < 1e-3
+    assert np.max(np.abs(xa_emu - xa) / xa_sd_exact) < 0.25
+    # starting from the prior reaches the same minimum
+    assert np.allclose(emu.find_min(jj, x0=jj.xb), xa_emu, rtol=0., atol=1e-3 * np.max(xa_sd_exact))